@@ -0,0 +1,74 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Benchmark for finding the features nearest to a click on the map
+#
+# Usage: python3 benchmarks/bench_click.py [num_features]
+#
+# Places all features of a brand in a city center, which is the worst
+# case for hit testing, and reports the median time for finding the
+# nearest features to random clicks at various zoom levels.
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brandy import create_app
+from brandy.db import get_db, init_db
+from brandy.geometry import wgs84_to_pixel
+from brandy.tiles import find_nearest_features
+
+
+def main(num_features):
+    with tempfile.TemporaryDirectory() as storage_path:
+        run(num_features, storage_path)
+
+
+def run(num_features, storage_path):
+    app = create_app({
+        'DATABASE': os.path.join(storage_path, 'brandy.sqlite'),
+        'INGEST_SPOOL': os.path.join(storage_path, 'spool'),
+        'ITEMS_CACHE': os.path.join(storage_path, 'items'),
+        'MBTILES': os.path.join(storage_path, 'mbtiles'),
+        'TILE_CACHE': os.path.join(storage_path, 'tiles'),
+    })
+    rnd = random.Random(7)
+    points = [(rnd.uniform(8.51, 8.56), rnd.uniform(47.36, 47.39))
+              for _ in range(num_features)]
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.executemany(
+            'INSERT INTO brand_feature (internal_id, brand_id, feature_id,'
+            '    lng, lat, hash_hi, hash_lo, last_modified, props)'
+            " VALUES (?, 72, ?, ?, ?, 0, 0, '2022-10-23 08:15:03', x'')",
+            ((i + 1, 'F%d' % i, lng, lat) for i, (lng, lat) in enumerate(points)))
+        db.executemany(
+            'INSERT INTO brand_feature_rtree (internal_id,'
+            '    min_lng, max_lng, min_lat, max_lat, brand_id)'
+            ' VALUES (?, ?, ?, ?, ?, 72)',
+            ((i + 1, lng, lng, lat, lat) for i, (lng, lat) in enumerate(points)))
+        db.commit()
+        print('%d features in central Zurich' % num_features)
+        for zoom in (10, 13, 16, 18):
+            for k in (1, 5):
+                timings, found = [], 0
+                for _ in range(200):
+                    lng, lat = rnd.choice(points)
+                    px, py = wgs84_to_pixel(lng, lat, zoom)
+                    px, py = px + rnd.uniform(-8, 8), py + rnd.uniform(-8, 8)
+                    start = time.perf_counter()
+                    found += len(find_nearest_features(db, 72, zoom, px, py, k))
+                    timings.append(time.perf_counter() - start)
+                print('zoom %2d, k=%d: median %4.0f us, %.1f features found'
+                      % (zoom, k, statistics.median(timings) * 1e6,
+                         found / len(timings)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Benchmark for the geometry functions, scalar versus batch
+#
+# Usage: python3 benchmarks/bench_geometry.py [num_features]
+#
+# Compares computing bounding boxes and building the tile index with
+# the scalar functions, one point at a time, against the batch functions,
+# once with NumPy (if installed) and once with the plain Python fallback.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_items import make_features
+import brandy.geometry
+from brandy.geometry import (
+    feature_bboxes, halve_pixels, marker_tiles, pixel_cells, union_bbox,
+    wgs84_to_pixel, wgs84_to_pixels)
+from brandy.tiles import CLUSTER_MAX_ZOOM, MAX_MARKER_RADIUS, \
+    TILE_INDEX_MAX_ZOOM
+
+
+def scalar_bbox(features):
+    # What store_scraped did before there were batch functions.
+    bbox = None
+    for f in features:
+        b = brandy.geometry.bbox(f)
+        if bbox == None:
+            bbox = list(b)
+        else:
+            bbox[0], bbox[1] = min(bbox[0], b[0]), min(bbox[1], b[1])
+            bbox[2], bbox[3] = max(bbox[2], b[2]), max(bbox[3], b[3])
+    return bbox
+
+
+def scalar_tile_index(lngs, lats):
+    # What update_tile_index did before there were batch functions.
+    occupied = [set() for _ in range(TILE_INDEX_MAX_ZOOM + 1)]
+    cells = [{} for _ in range(CLUSTER_MAX_ZOOM + 1)]
+    r = MAX_MARKER_RADIUS
+    for lng, lat in zip(lngs, lats):
+        px, py = wgs84_to_pixel(lng, lat, TILE_INDEX_MAX_ZOOM)
+        for zoom in range(TILE_INDEX_MAX_ZOOM, -1, -1):
+            max_tile = (1 << zoom) - 1
+            x1 = min(max(int((px - r) // 256), 0), max_tile)
+            x2 = min(max(int((px + r) // 256), 0), max_tile)
+            y1 = min(max(int((py - r) // 256), 0), max_tile)
+            y2 = min(max(int((py + r) // 256), 0), max_tile)
+            tiles = occupied[zoom]
+            tiles.add((x1, y1))
+            tiles.add((x1, y2))
+            tiles.add((x2, y1))
+            tiles.add((x2, y2))
+            if zoom <= CLUSTER_MAX_ZOOM:
+                cell = (int(px), int(py))
+                cells[zoom][cell] = cells[zoom].get(cell, 0) + 1
+            px, py = px / 2, py / 2
+    return occupied, cells
+
+
+def batch_tile_index(lngs, lats):
+    occupied = [None] * (TILE_INDEX_MAX_ZOOM + 1)
+    cells = [None] * (CLUSTER_MAX_ZOOM + 1)
+    px, py = wgs84_to_pixels(lngs, lats, TILE_INDEX_MAX_ZOOM)
+    for zoom in range(TILE_INDEX_MAX_ZOOM, -1, -1):
+        occupied[zoom] = marker_tiles(px, py, MAX_MARKER_RADIUS, zoom)
+        if zoom <= CLUSTER_MAX_ZOOM:
+            cells[zoom] = pixel_cells(px, py)
+        px, py = halve_pixels(px, py)
+    return occupied, cells
+
+
+def measure(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print('%-28s %8.1f ms' % (name, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def main(num_features):
+    features, lngs, lats = [], [], []
+    for feature_id, lng, lat, props in make_features(num_features):
+        features.append({
+            'type': 'Feature',
+            'id': feature_id,
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': props
+        })
+        lngs.append(lng)
+        lats.append(lat)
+    print('%d features' % num_features)
+    expected_bbox = measure('bbox, one feature per call', scalar_bbox, features)
+    bbox = measure('bbox, batch', lambda fs: union_bbox(feature_bboxes(fs)),
+                   features)
+    assert list(bbox) == expected_bbox
+    expected = measure('tile index, scalar', scalar_tile_index, lngs, lats)
+    numpy = brandy.geometry.numpy
+    if numpy != None:
+        assert measure('tile index, batch (numpy)',
+                       batch_tile_index, lngs, lats) == expected
+    brandy.geometry.numpy = None
+    assert measure('tile index, batch (python)',
+                   batch_tile_index, lngs, lats) == expected
+    brandy.geometry.numpy = numpy
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
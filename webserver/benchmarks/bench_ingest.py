@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Benchmark for storing a scraped GeoJSON upload
+#
+# Usage: python3 benchmarks/bench_ingest.py [num_features]
+#
+# Reports the elapsed time and the peak resident memory of the process.
+# To measure memory, run the benchmark in a fresh process for each size.
+# Afterwards, the benchmark stores a rescrape where 1% of the features
+# have changed, and reports how many features got changed and how many
+# database rows got written, including rows of temporary tables.
+
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_items import make_features
+from brandy import create_app
+from brandy.collections import store_scraped
+from brandy.db import get_db, init_db
+
+
+def write_scraped(path, num_features, changed_every=0):
+    with open(path, 'w') as f:
+        f.write('{"type":"FeatureCollection","features":[')
+        for i, (feature_id, lng, lat, props) in enumerate(
+                make_features(num_features)):
+            if i > 0:
+                f.write(',')
+            if changed_every and i % changed_every == 0:
+                props['name'] += ' (changed)'
+            json.dump({
+                'type': 'Feature',
+                'id': feature_id,
+                'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                'properties': props
+            }, f, ensure_ascii=False, separators=(',', ':'))
+        f.write(']}')
+
+
+def main(num_features):
+    with tempfile.TemporaryDirectory() as storage_path:
+        run(num_features, storage_path)
+
+
+def run(num_features, storage_path):
+    app = create_app({
+        'DATABASE': os.path.join(storage_path, 'brandy.sqlite'),
+        'INGEST_SPOOL': os.path.join(storage_path, 'spool'),
+        'ITEMS_CACHE': os.path.join(storage_path, 'items'),
+        'MBTILES': os.path.join(storage_path, 'mbtiles'),
+        'TILE_CACHE': os.path.join(storage_path, 'tiles'),
+        'SERVER_NAME': 'brandy.test',
+    })
+    scraped_path = os.path.join(storage_path, 'scraped.geojson')
+    write_scraped(scraped_path, num_features)
+    size = os.path.getsize(scraped_path)
+    with app.app_context():
+        init_db()
+        db = get_db()
+        start = time.perf_counter()
+        with open(scraped_path, 'rb') as scraped:
+            store_scraped(db, 72, scraped)
+        db.commit()
+        elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('%d features, %.1f MB: %.2f s, %.0f features/s, peak RSS %.0f MB' % (
+        num_features, size / 1e6, elapsed, num_features / elapsed, peak))
+
+    write_scraped(scraped_path, num_features, changed_every=100)
+    with app.app_context():
+        db = get_db()
+        changes = db.total_changes
+        start = time.perf_counter()
+        with open(scraped_path, 'rb') as scraped:
+            _, num_changed = store_scraped(db, 72, scraped)
+        db.commit()
+        elapsed = time.perf_counter() - start
+        changes = db.total_changes - changes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('rescrape with 1%% changed: %.2f s, %d features changed, '
+          '%d rows written, peak RSS %.0f MB' % (
+              elapsed, num_changed, changes, peak))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
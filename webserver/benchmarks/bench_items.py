@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Benchmark for serving /collections/Q<id>-brand/items
+#
+# Usage: python3 benchmarks/bench_items.py [num_features]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brandy import create_app
+from brandy.db import get_db, init_db
+
+
+def make_features(n):
+    rnd = random.Random(7)
+    for i in range(n):
+        props = {
+            'brand': 'Example',
+            'brand:wikidata': 'Q72',
+            'name': 'Example %d' % i,
+            'opening_hours': 'Mo-Fr 08:00-18:30; Sa 08:00-17:00',
+            'addr:street': 'Bahnhofstrasse',
+            'addr:housenumber': str(rnd.randint(1, 200)),
+            'addr:postcode': str(rnd.randint(1000, 9999)),
+            'addr:city': 'Zürich',
+            'ref': 'F%d' % i,
+        }
+        lng, lat = rnd.uniform(5.9, 10.5), rnd.uniform(45.8, 47.8)
+        yield ('F%d' % i, lng, lat, props)
+
+
+def main(num_features):
+    with tempfile.TemporaryDirectory() as storage_path:
+        run(num_features, storage_path)
+
+
+def run(num_features, storage_path):
+    app = create_app({
+        'DATABASE': os.path.join(storage_path, 'brandy.sqlite'),
+        'INGEST_SPOOL': os.path.join(storage_path, 'spool'),
+        'ITEMS_CACHE': os.path.join(storage_path, 'items'),
+        'MBTILES': os.path.join(storage_path, 'mbtiles'),
+        'TILE_CACHE': os.path.join(storage_path, 'tiles'),
+        'SERVER_NAME': 'brandy.test',
+    })
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.execute(
+            'INSERT INTO brand (wikidata_id, last_checked, last_modified,'
+            '    min_lng, min_lat, max_lng, max_lat)'
+            " VALUES (72, '2022-10-23 08:15:03', '2022-10-23 08:15:03',"
+            '    5.9, 45.8, 10.5, 47.8)')
+        db.executemany(
+            'INSERT INTO brand_feature (brand_id, feature_id, lng, lat,'
+            '    hash_hi, hash_lo, last_modified, props)'
+            " VALUES (72, ?, ?, ?, 0, 0, '2022-10-23 08:15:03', ?)",
+            ((feature_id, lng, lat, zlib.compress(json.dumps(
+                props, ensure_ascii=False, separators=(',', ':'),
+                sort_keys=True).encode('utf-8'), level=9))
+             for feature_id, lng, lat, props in make_features(num_features)))
+        db.commit()
+
+    client = app.test_client()
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        r = client.get('/collections/Q72-brand/items')
+        size = len(r.data)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print('%d features, %.1f MB: %.2f s, %.0f features/s, %.1f MB/s' % (
+        num_features, size / 1e6, best, num_features / best,
+        size / 1e6 / best))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -12,7 +12,22 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY='dev',
+        AUTH_CACHE_ENTRIES=10000,
+        AUTH_CACHE_TTL=60,
         DATABASE=os.path.join(app.instance_path, 'brandy.sqlite'),
+        DATABASE_CACHE_SIZE=64 << 20,
+        DATABASE_MMAP_SIZE=256 << 20,
+        RENDERTILE='rendertile',
+        RENDERTILE_WORKERS=os.cpu_count() or 1,
+        INGEST_SPOOL=os.path.join(app.instance_path, 'spool'),
+        ITEMS_CACHE=os.path.join(app.instance_path, 'items'),
+        MBTILES=os.path.join(app.instance_path, 'mbtiles'),
+        METADATA_CACHE_ENTRIES=10000,
+        MVT_BUFFER=64,
+        MVT_EXTENT=4096,
+        PROPERTIES_CACHE_SIZE=64 << 20,
+        TILE_CACHE=os.path.join(app.instance_path, 'tiles'),
+        TILE_CACHE_SIZE=1 << 30,
     )
 
     # Load the configuration file, if it exists.
@@ -33,10 +48,25 @@ def create_app(test_config=None):
     app.jinja_env.keep_trailing_newline = True
 
     # Set up database connection and register Flask blueprints.
-    from . import db, collections, scrapes, tiles, users
+    from . import (assets, auth, db, codec, collections, jobs, mbtiles,
+                   metacache, propcache, render, scrapes, search, stats,
+                   tilecache, tiles, users)
     db.init_app(app)
+    assets.init_app(app)
+    auth.init_app(app)
+    codec.init_app(app)
+    jobs.init_app(app)
+    mbtiles.init_app(app)
+    metacache.init_app(app)
+    propcache.init_app(app)
+    render.init_app(app)
+    tilecache.init_app(app)
+    app.register_blueprint(assets.bp)
     app.register_blueprint(collections.bp)
+    app.register_blueprint(jobs.bp)
     app.register_blueprint(scrapes.bp)
+    app.register_blueprint(search.bp)
+    app.register_blueprint(stats.bp)
     app.register_blueprint(tiles.bp)
     app.register_blueprint(users.bp)
 
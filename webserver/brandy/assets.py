@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Flask blueprint for handling /assets/*
+#
+# Serves the files in brandy/static under URLs that contain a hash of
+# their content, such as /assets/map.0123456789abcdef.js. Because the URL
+# changes whenever the content does, browsers can cache these files
+# forever and never need to revalidate them. Templates refer to assets
+# with {{ asset_url('map.js') }}.
+#
+# The assets get loaded when the server starts up. JavaScript and CSS
+# files are minified (if rjsmin and rcssmin are installed), and we keep
+# gzip and brotli compressed variants in memory, so serving an asset
+# does not need any file system access nor compression.
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+import flask
+from werkzeug.exceptions import NotFound
+
+bp = flask.Blueprint('assets', __name__, url_prefix='/assets')
+
+# Assets never change, only their URLs do; see RFC 8246.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class Asset(object):
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = minify(filename, data)
+        self.fingerprint = hashlib.sha256(self.data).hexdigest()[:16]
+        base, ext = os.path.splitext(filename)
+        self.url_path = '%s.%s%s' % (base, self.fingerprint, ext)
+        content_type, _ = mimetypes.guess_type(filename)
+        if content_type == None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        # Compressed variants, by content encoding, in order of preference.
+        # Tiny files can get larger when compressed; we skip those.
+        self.encodings = []
+        if brotli != None:
+            self._add_encoding('br', brotli.compress(self.data))
+        self._add_encoding('gzip', gzip.compress(self.data, mtime=0))
+
+    def _add_encoding(self, encoding, data):
+        if len(data) < len(self.data):
+            self.encodings.append((encoding, data))
+
+
+class Assets(object):
+    def __init__(self, static_folder):
+        self._by_filename = {}
+        self._by_url_path = {}
+        if static_folder == None or not os.path.isdir(static_folder):
+            return
+        for dirpath, _dirnames, filenames in os.walk(static_folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                filename = os.path.relpath(path, static_folder)
+                filename = filename.replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    asset = Asset(filename, f.read())
+                self._by_filename[filename] = asset
+                self._by_url_path[asset.url_path] = asset
+
+    def find(self, url_path):
+        return self._by_url_path.get(url_path)
+
+    def url(self, filename):
+        """URL for an asset, given its path relative to brandy/static."""
+        asset = self._by_filename.get(filename)
+        if asset == None:
+            # Files that got added after startup are still reachable,
+            # just without the long-lived caching.
+            return flask.url_for('static', filename=filename)
+        return flask.url_for('assets.asset', filename=asset.url_path)
+
+
+def minify(filename, data):
+    if filename.endswith('.js') and rjsmin != None:
+        return rjsmin.jsmin(data)
+    if filename.endswith('.css') and rcssmin != None:
+        return rcssmin.cssmin(data)
+    return data
+
+
+@bp.route('/<path:filename>')
+def asset(filename):
+    asset = get_assets().find(filename)
+    if asset == None:
+        raise NotFound()
+    data, encoding = asset.data, None
+    accepted = flask.request.accept_encodings
+    for enc, enc_data in asset.encodings:
+        if accepted[enc] > 0:
+            data, encoding = enc_data, enc
+            break
+    resp = flask.Response(data, content_type=asset.content_type)
+    if encoding != None:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Cache-Control'] = CACHE_CONTROL
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.set_etag('%s-%s' % (asset.fingerprint, encoding or 'identity'))
+    return resp.make_conditional(flask.request)
+
+
+def asset_url(filename):
+    return get_assets().url(filename)
+
+
+def get_assets():
+    return flask.current_app.extensions['assets']
+
+
+def init_app(app):
+    app.extensions['assets'] = Assets(app.static_folder)
+    app.add_template_global(asset_url)
@@ -1,16 +1,74 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Authentication of users and API clients
+#
+# Clients authenticate either with HTTP Basic authentication, giving
+# the username and password of their account, or with a bearer token
+# of an account. Scrapers should use tokens: checking a password runs
+# a deliberately slow key derivation function, whereas tokens are long
+# random strings, which we can store with a fast hash and look up
+# by index.
+#
+# Verified credentials and the roles of users are kept in an in-process
+# cache for AUTH_CACHE_TTL seconds, so a burst of uploads does not check
+# the same credentials over and over. Failed checks are not cached, so
+# new credentials work right away. The cache is a MetadataCache from
+# metacache.py, whose version is a counter that gets incremented by
+# triggers on the user and api_token tables. When the version changes,
+# the cache gets emptied; thus, revoking a token takes effect in all
+# server processes right away.
 
-from flask import Flask
-from flask_httpauth import HTTPBasicAuth
+from datetime import datetime
+import hashlib
+import hmac
+import secrets
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from werkzeug.security import check_password_hash
 
 from brandy.db import get_db
+from brandy.metacache import MetadataCache
+
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+auth = MultiAuth(basic_auth, token_auth)
+
+# Prefix of API tokens, to make them recognizable in configuration files.
+TOKEN_PREFIX = 'brandy_'
+
+
+class _Rejected(Exception):
+    pass
 
-auth = HTTPBasicAuth()
 
-@auth.get_user_roles
+def _cached(key, verify):
+    db = get_db()
+    version = db.execute('SELECT version FROM auth_version').fetchone()[0]
+    # Only successful checks get cached. Raising an exception from
+    # build() tells MetadataCache to not store anything.
+    def build():
+        result = verify()
+        if result == None:
+            raise _Rejected()
+        return result
+    cache = current_app.extensions['auth']
+    try:
+        return cache.get(version, key, build)
+    except _Rejected:
+        return None
+
+
+@basic_auth.get_user_roles
+@token_auth.get_user_roles
 def get_user_roles(user):
+    return _cached(('roles', user), lambda: _find_user_roles(user))
+
+
+def _find_user_roles(user):
     db = get_db()
     capabilities = db.execute(
         'SELECT is_admin FROM user WHERE username = ?',
@@ -24,8 +82,21 @@ def get_user_roles(user):
     return roles
 
 
-@auth.verify_password
+@basic_auth.verify_password
 def verify_password(username, password):
+    if not username:
+        return None
+    # The cache key must not reveal the password. A plain hash could be
+    # attacked with precomputed tables, hence the keyed hash.
+    secret_key = current_app.secret_key
+    if isinstance(secret_key, str):
+        secret_key = secret_key.encode('utf-8')
+    key = ('password', username, hmac.new(
+        secret_key, password.encode('utf-8'), hashlib.sha256).digest())
+    return _cached(key, lambda: _check_password(username, password))
+
+
+def _check_password(username, password):
     db = get_db()
     user = db.execute(
         'SELECT password FROM user WHERE username = ?',
@@ -35,3 +106,86 @@ def verify_password(username, password):
         return username
     else:
         return None
+
+
+@token_auth.verify_token
+def verify_token(token):
+    if not token:
+        return None
+    token_hash = hash_token(token)
+    return _cached(('token', token_hash), lambda: _find_token_user(token_hash))
+
+
+def _find_token_user(token_hash):
+    db = get_db()
+    user = db.execute(
+        'SELECT u.username FROM api_token AS t, user AS u'
+        ' WHERE t.token_hash = ? AND u.id = t.user_id',
+        (token_hash,)
+    ).fetchone()
+    return user['username'] if user != None else None
+
+
+def hash_token(token):
+    # Tokens have 256 bits of randomness, so there is no need for
+    # a slow key derivation function like for passwords.
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def create_api_token(username, name):
+    """Create a new API token for a user, without committing.
+
+    Returns a tuple (token_id, token). Only the hash of the token
+    gets stored, so the token cannot be shown again later."""
+    db = get_db()
+    user = db.execute('SELECT id FROM user WHERE username = ?',
+                      (username,)).fetchone()
+    if user == None:
+        raise KeyError(username)
+    token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+    cursor = db.execute(
+        'INSERT INTO api_token (user_id, name, token_hash, created)'
+        ' VALUES (?, ?, ?, ?)',
+        (user['id'], name, hash_token(token), datetime.now()))
+    return (cursor.lastrowid, token)
+
+
+def revoke_api_token(token_id):
+    """Delete an API token, without committing. Returns False if unknown."""
+    db = get_db()
+    cursor = db.execute('DELETE FROM api_token WHERE id = ?', (token_id,))
+    return cursor.rowcount > 0
+
+
+@click.command('create-token')
+@click.argument('username')
+@click.option('--name', default='', help='What the token is used for.')
+@with_appcontext
+def create_token_command(username, name):
+    """Create an API token for a user."""
+    try:
+        token_id, token = create_api_token(username, name)
+    except KeyError:
+        raise click.ClickException('No such user: %s' % username)
+    get_db().commit()
+    click.echo('Created token %d for user "%s":' % (token_id, username))
+    click.echo(token)
+
+
+@click.command('revoke-token')
+@click.argument('token_id', type=int)
+@with_appcontext
+def revoke_token_command(token_id):
+    """Revoke an API token, given its id."""
+    if not revoke_api_token(token_id):
+        raise click.ClickException('No such token: %d' % token_id)
+    get_db().commit()
+    click.echo('Revoked token %d.' % token_id)
+
+
+def init_app(app):
+    app.extensions['auth'] = MetadataCache(
+        ttl=app.config['AUTH_CACHE_TTL'],
+        max_entries=app.config['AUTH_CACHE_ENTRIES'])
+    app.cli.add_command(create_token_command)
+    app.cli.add_command(revoke_token_command)
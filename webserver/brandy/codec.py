@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Compression of feature properties
+#
+# The properties of each brand feature are stored as compressed JSON.
+# A single feature is only a few hundred bytes, which is too little
+# for a general-purpose compressor to find much redundancy. However,
+# the features of a brand are very similar to each other, so we train
+# a zstd dictionary on the properties of each brand, and store it in
+# the compression_dictionary table. Each compressed blob starts with
+# a byte that tells its codec:
+#
+#   0x78  zlib; this is the first byte of the zlib header. Used before
+#         we had dictionaries, and for brands too small for training.
+#
+#   0x01  zstd with dictionary. Followed by the dictionary id in the
+#         database as unsigned LEB128, and a zstd frame without magic.
+#
+# Once stored, a dictionary is never modified. Therefore, it is fine to
+# cache decompressors by dictionary id.
+
+from collections import OrderedDict
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from flask import current_app
+
+from brandy.db import get_db
+
+
+CODEC_ZLIB = 0x78
+CODEC_ZSTD_DICT = 0x01
+
+# Size of the trained dictionaries, in bytes.
+DICTIONARY_SIZE = 16 * 1024
+
+# Number of decompressors that each thread keeps around.
+DECOMPRESSOR_CACHE_SIZE = 32
+
+
+class Compressor(object):
+    """Compresses feature properties for storing them in the database.
+
+    If `dictionary` is None, or if zstandard is not installed,
+    properties get compressed with zlib."""
+
+    def __init__(self, dictionary=None):
+        self.header = None  # blob prefix, or None for zlib
+        self._zstd = None
+        if dictionary != None and zstandard != None:
+            dict_id, data = dictionary
+            self.header = bytes([CODEC_ZSTD_DICT]) + _encode_varint(dict_id)
+            params = zstandard.ZstdCompressionParameters.from_level(
+                3, format=zstandard.FORMAT_ZSTD1_MAGICLESS,
+                write_checksum=0, write_content_size=1, write_dict_id=0)
+            self._zstd = zstandard.ZstdCompressor(
+                dict_data=zstandard.ZstdCompressionDict(data),
+                compression_params=params)
+
+    def compress(self, data):
+        if self._zstd == None:
+            return zlib.compress(data, level=9)
+        return self.header + self._zstd.compress(data)
+
+
+def load_dictionary(db, brand_id):
+    """Latest dictionary for a brand as (id, data), or None if missing."""
+    row = db.execute(
+        'SELECT id, data FROM compression_dictionary WHERE brand_id = ?'
+        ' ORDER BY id DESC LIMIT 1', (brand_id,)).fetchone()
+    return (row[0], row[1]) if row != None else None
+
+
+def train_dictionary(db, brand_id, samples):
+    """Train and store a dictionary for a brand, given sample properties.
+
+    Returns the new dictionary as (id, data), or None if zstandard is
+    not installed or there are too few samples for training."""
+    if zstandard == None:
+        return None
+    try:
+        data = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+    except zstandard.ZstdError:
+        return None
+    data = data.as_bytes()
+    cursor = db.execute(
+        'INSERT INTO compression_dictionary (brand_id, data) VALUES (?, ?)',
+        (brand_id, data))
+    return (cursor.lastrowid, data)
+
+
+def decompress(blob):
+    """Decompress the stored properties of a feature."""
+    codec = blob[0]
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(blob)
+    if codec == CODEC_ZSTD_DICT:
+        dict_id, pos = _decode_varint(blob, 1)
+        decompressor = current_app.extensions['codec'].get(dict_id)
+        return decompressor.decompress(blob[pos:])
+    raise ValueError('unknown codec 0x%02x' % codec)
+
+
+class DecompressorCache(object):
+    # Decompressors are not thread-safe, so each thread has its own.
+    # Dictionaries get loaded from the database by the thread that
+    # needs them; an uncommitted dictionary is never visible to readers.
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+
+    def get(self, dict_id):
+        cache = getattr(self._local, 'decompressors', None)
+        if cache == None:
+            cache = self._local.decompressors = OrderedDict()
+        decompressor = cache.get(dict_id)
+        if decompressor != None:
+            cache.move_to_end(dict_id)
+            return decompressor
+        if zstandard == None:
+            raise RuntimeError('zstandard is not installed')
+        row = get_db(readonly=True).execute(
+            'SELECT data FROM compression_dictionary WHERE id = ?',
+            (dict_id,)).fetchone()
+        if row == None:
+            raise ValueError('compression dictionary %d not found' % dict_id)
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=zstandard.ZstdCompressionDict(row[0]),
+            format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+        cache[dict_id] = decompressor
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+        return decompressor
+
+
+def _encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    n, shift = 0, 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (n, pos)
+        shift += 7
+
+
+def init_app(app):
+    app.extensions['codec'] = DecompressorCache(DECOMPRESSOR_CACHE_SIZE)
@@ -6,24 +6,50 @@
 # We implement the OGC WFS 3.0 API, see https://ogcapi.ogc.org/features/.
 
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import hashlib
 from http import HTTPStatus
 import json
+import math
+import os
 import struct
+import tempfile
 import time
 import zlib
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 import flask
 from flask_accept import accept, accept_fallback
-from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+from werkzeug.exceptions import BadRequest, Forbidden, Gone, NotFound
+from werkzeug.http import is_resource_modified
 
-import brandy.auth, brandy.geometry
+import brandy.auth, brandy.codec, brandy.geojson, brandy.geometry
+import brandy.jobs, brandy.metacache, brandy.propcache, brandy.tilecache, brandy.tiles
 from brandy.auth import auth
-from brandy.db import get_db
+from brandy.db import build_find_features_query, get_db
 
 bp = flask.Blueprint('collections', __name__, url_prefix='/collections')
 
+# Number of brands per page of the collections index, unless clients
+# ask for a different limit, and the maximal limit they can ask for.
+DEFAULT_COLLECTIONS_LIMIT = 1000
+MAX_COLLECTIONS_LIMIT = 10000
+
+# Maximal number of features that clients can ask for in one page.
+MAX_ITEMS_LIMIT = 10000
+
+# Approximate size of the chunks when streaming features, in characters.
+ITEMS_CHUNK_SIZE = 64 * 1024
+
+# Number of uploaded features that get inserted into the database at once.
+INGEST_BATCH_SIZE = 1000
+
+# How long we remember deleted features, for items?since=<timestamp>.
+TOMBSTONE_RETENTION = timedelta(days=30)
+
 
 @bp.route('')
 @accept_fallback
@@ -34,29 +60,64 @@ def index():
 @bp.route('.json')
 @index.support('application/json')
 def index_json():
-    db = get_db()
-    last_modified = None
-    collections = []
-    for brand in db.execute(
-        'SELECT wikidata_id, last_modified, min_lng, min_lat, max_lng, max_lat'
-        ' FROM brand').fetchall():
-            brand_id = brand['wikidata_id']
-            if last_modified == None or last_modified < brand['last_modified']:
-                last_modified = brand['last_modified']
-            bbox = [
-                brand['min_lng'], brand['min_lat'],
-                brand['max_lng'], brand['max_lat']
-            ]
-            collections.append(_format_brand_collection_json(brand_id, bbox))
-    resp = flask.json.jsonify({'links': [], 'collections': collections})
-    resp.headers['Content-Type'] = 'application/json'
-    if last_modified != None:
-        resp.headers['Last-Modified'] = last_modified.isoformat() + 'Z'
+    args = flask.request.args
+    limit = args.get('limit', str(DEFAULT_COLLECTIONS_LIMIT))
+    if not limit.isdigit() or not (1 <= int(limit) <= MAX_COLLECTIONS_LIMIT):
+        raise BadRequest('limit must be between 1 and %d' %
+                         MAX_COLLECTIONS_LIMIT)
+    limit = int(limit)
+    cursor = args.get('cursor', '0')
+    if not cursor.isdigit():
+        raise BadRequest('malformed cursor')
+    cursor = int(cursor)
+    # The cached document contains absolute links, so the key needs
+    # to include the host and path of the request.
+    db = get_db(readonly=True)
+    etag, last_modified, body = brandy.metacache.get_metadata_cache().get(
+        brandy.metacache.get_brand_version(db),
+        ('index', flask.request.base_url, limit, cursor),
+        lambda: _build_index_json(db, limit, cursor))
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified != None:
+        return not_modified
+    resp = flask.Response(body, content_type='application/json')
+    _set_validators(resp, etag, last_modified)
     if not flask.request.path.endswith('.json'):
         resp.headers['Vary'] = 'Accept'
     return resp
 
 
+def _build_index_json(db, limit, cursor):
+    # We fetch one extra brand to find out if there is a next page.
+    brands = db.execute(
+        'SELECT wikidata_id, last_modified, content_hash,'
+        '    min_lng, min_lat, max_lng, max_lat'
+        ' FROM brand WHERE wikidata_id > ? ORDER BY wikidata_id LIMIT ?',
+        (cursor, limit + 1)).fetchall()
+    links = []
+    if len(brands) > limit:
+        brands = brands[:limit]
+        links.append({
+            'rel': 'next',
+            'type': 'application/json',
+            'href': flask.url_for(flask.request.endpoint, _external=True,
+                                  limit=limit,
+                                  cursor=brands[-1]['wikidata_id'])
+        })
+    collections = []
+    for brand in brands:
+        brand_id = brand['wikidata_id']
+        bbox = [
+            brand['min_lng'], brand['min_lat'],
+            brand['max_lng'], brand['max_lat']
+        ]
+        collections.append(_format_brand_collection_json(brand_id, bbox))
+    body = _dump_json({'links': links, 'collections': collections})
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    last_modified = max((b['last_modified'] for b in brands), default=None)
+    return (etag, last_modified, body)
+
+
 @bp.route('/Q<int:brand_id>-brand')
 @accept_fallback
 def collection(brand_id):
@@ -66,9 +127,24 @@ def collection(brand_id):
 @bp.route('/Q<int:brand_id>-brand.json')
 @collection.support('application/json')
 def collection_json(brand_id):
-    db = get_db()
+    db = get_db(readonly=True)
+    etag, last_modified, body = brandy.metacache.get_metadata_cache().get(
+        brandy.metacache.get_brand_version(db),
+        ('collection', flask.request.url_root, brand_id),
+        lambda: _build_collection_json(db, brand_id))
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified != None:
+        return not_modified
+    resp = flask.Response(body, content_type='application/json')
+    _set_validators(resp, etag, last_modified)
+    if not flask.request.path.endswith('.json'):
+        resp.headers['Vary'] = 'Accept'
+    return resp
+
+
+def _build_collection_json(db, brand_id):
     brand = db.execute(
-        'SELECT min_lng, min_lat, max_lng, max_lat'
+        'SELECT last_modified, content_hash, min_lng, min_lat, max_lng, max_lat'
         ' FROM brand WHERE wikidata_id = ?',
         (brand_id,)).fetchone()
     if brand == None:
@@ -77,23 +153,32 @@ def collection_json(brand_id):
         brand['min_lng'], brand['min_lat'],
         brand['max_lng'], brand['max_lat']
     ]
-    resp = flask.json.jsonify(_format_brand_collection_json(brand_id, bbox))
-    if not flask.request.path.endswith('.json'):
-        resp.headers['Vary'] = 'Accept'
-    return resp
+    body = _dump_json(_format_brand_collection_json(brand_id, bbox))
+    return (_brand_etag(brand) + '-json', brand['last_modified'], body)
+
+
+def _dump_json(obj):
+    return (flask.current_app.json.dumps(obj) + '\n').encode('utf-8')
 
 
 @bp.route('/Q<int:brand_id>-brand.html')
 @collection.support('text/html')
 def collection_html(brand_id):
-    db = get_db()
+    db = get_db(readonly=True)
     brand = db.execute(
-        'SELECT last_checked, last_modified,'
+        'SELECT last_checked, last_modified, content_hash,'
         '  min_lng, min_lat, max_lng, max_lat'
         '  FROM brand WHERE wikidata_id = ?',
         (brand_id,)).fetchone()
     if brand == None:
         raise NotFound()
+    # The page shows when the brand was last checked, which changes
+    # with every scrape, even if the content stays the same.
+    etag = '%s-html-%s' % (_brand_etag(brand),
+                           brand['last_checked'].strftime('%Y%m%dT%H%M%S'))
+    not_modified = _not_modified(etag)
+    if not_modified != None:
+        return not_modified
     data = {
         'bbox': [
             brand['min_lng'], brand['min_lat'],
@@ -109,6 +194,7 @@ def collection_html(brand_id):
     rendered = flask.render_template(
         'collections/map.html', data=data, data_json=json.dumps(data))
     resp = flask.make_response(rendered)
+    _set_validators(resp, etag)
     if not flask.request.path.endswith('.html'):
         resp.headers['Vary'] = 'Accept'
     return resp
@@ -117,124 +203,557 @@ def collection_html(brand_id):
 @bp.route('/Q<int:brand_id>-brand/items', methods=('GET', 'POST'))
 @auth.login_required(optional=True)
 def items(brand_id):
-    urlpath = flask.url_for('collections.items', _external=True,
-                            brand_id=brand_id)
-    db = get_db()
     if flask.request.method == 'POST':
         user = auth.current_user()
         if user == None:
             r = flask.Response(status=HTTPStatus.UNAUTHORIZED)
-            r.headers['WWW-Authenticate'] = auth.authenticate_header()
+            r.headers['WWW-Authenticate'] = \
+                brandy.auth.basic_auth.authenticate_header()
             return r
         logfile = flask.request.files.get('log')
         # TODO: Store log.
         scraped = flask.request.files.get('scraped')
-        if scraped != None:
-            store_scraped(db, brand_id, scraped)
-        resp = flask.Response('Created', HTTPStatus.CREATED)
-        resp.headers['Location'] = urlpath
-        db.commit()
+        if scraped == None:
+            raise BadRequest('Missing file "scraped"')
+        job = brandy.jobs.submit_ingest_job(brand_id, scraped, user)
+        resp = flask.jsonify(job)
+        resp.status_code = HTTPStatus.ACCEPTED
+        resp.headers['Location'] = job['links'][0]['href']
         return resp
 
+    db = get_db(readonly=True)
     brand = db.execute(
-        'SELECT last_modified FROM brand WHERE wikidata_id = ?',
+        'SELECT last_modified, content_hash FROM brand WHERE wikidata_id = ?',
         (brand_id,)).fetchone()
     if brand == None:
         raise NotFound()
+    # Each combination of query parameters is a different representation,
+    # which needs its own entity tag; so is each content encoding.
+    etag = _brand_etag(brand)
     last_modified = brand['last_modified']
-    return generate_brand_items_json(db, brand_id), {
-        'Content-Type': 'application/geo+json',
-        'Last-Modified': last_modified.isoformat() + 'Z',
-    }
+    if flask.request.query_string:
+        etag += '-' + hashlib.sha256(
+            flask.request.query_string).hexdigest()[:16]
+    else:
+        precompressed = _find_precompressed_items(brand_id, etag)
+        if precompressed != None:
+            f, encoding = precompressed
+            etag = '%s-%s' % (etag, encoding)
+            resp = _not_modified(etag, last_modified)
+            if resp == None:
+                resp = flask.send_file(f, mimetype='application/geo+json',
+                                       etag=False, conditional=False)
+                resp.content_length = os.fstat(f.fileno()).st_size
+                resp.headers['Content-Encoding'] = encoding
+                _set_validators(resp, etag, last_modified)
+            else:
+                f.close()
+            resp.headers['Vary'] = 'Accept-Encoding'
+            return resp
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified != None:
+        return not_modified
+    bbox = parse_bbox(flask.request.args.get('bbox'))
+    limit = flask.request.args.get('limit')
+    if limit != None:
+        if not limit.isdigit() or not (1 <= int(limit) <= MAX_ITEMS_LIMIT):
+            raise BadRequest('limit must be between 1 and %d' %
+                             MAX_ITEMS_LIMIT)
+        limit = int(limit)
+    cursor = flask.request.args.get('cursor')
+    if cursor != None:
+        if not cursor.isdigit():
+            raise BadRequest('malformed cursor')
+        cursor = int(cursor)
+    since = _parse_since(flask.request.args.get('since'))
+    resp = flask.Response(
+        generate_brand_items_json(brand_id, bbox, limit, cursor, since,
+                                  last_modified),
+        content_type='application/geo+json')
+    _set_validators(resp, etag, last_modified)
+    if not flask.request.query_string:
+        resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
+
+
+def _find_precompressed_items(brand_id, etag):
+    """Find a precompressed items file acceptable to the client.
+
+    Returns a tuple (file, content_encoding) with the file opened for
+    reading, or None if the client does not accept any of our encodings,
+    or if they have not been built for the current version of the brand
+    data. Once opened, the file stays readable even if a concurrent call
+    to build_precompressed_items() removes it."""
+    accepted = flask.request.accept_encodings
+    for encoding, ext in (('br', 'br'), ('gzip', 'gz')):
+        if accepted[encoding] > 0:
+            path = _precompressed_items_path(brand_id, etag, ext)
+            try:
+                return (open(path, 'rb'), encoding)
+            except FileNotFoundError:
+                continue
+    return None
+
+
+def _precompressed_items_path(brand_id, etag, ext):
+    return os.path.join(flask.current_app.config['ITEMS_CACHE'],
+                        'Q%d-brand.%s.geojson.%s' % (brand_id, etag, ext))
+
+
+def build_precompressed_items(brand_id):
+    """Store the full items of a brand with gzip and brotli compression.
+
+    Called after storing a new scrape, so the server can send the items
+    without generating and compressing them for every request. Files
+    for older versions of the brand data get removed. If the scrape
+    did not change anything, the existing files are kept as they are."""
+    brand = get_db(readonly=True).execute(
+        'SELECT last_modified, content_hash FROM brand WHERE wikidata_id = ?',
+        (brand_id,)).fetchone()
+    if brand == None:
+        return
+    etag = _brand_etag(brand)
+    cache_dir = flask.current_app.config['ITEMS_CACHE']
+    os.makedirs(cache_dir, exist_ok=True)
+    compressors = {'gz': _GzipCompressor()}
+    if brotli != None:
+        compressors['br'] = brotli.Compressor(quality=9)
+    if all(os.path.exists(_precompressed_items_path(brand_id, etag, ext))
+           for ext in compressors):
+        return
+    files = {ext: tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+             for ext in compressors}
+    try:
+        for chunk in _iter_brand_items_json(brand_id):
+            data = chunk.encode('utf-8')
+            for ext, compressor in compressors.items():
+                files[ext].write(compressor.process(data))
+        for ext, compressor in compressors.items():
+            files[ext].write(compressor.finish())
+            files[ext].close()
+            os.replace(files[ext].name,
+                       _precompressed_items_path(brand_id, etag, ext))
+    finally:
+        for f in files.values():
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+    current = {os.path.basename(_precompressed_items_path(brand_id, etag, ext))
+               for ext in compressors}
+    prefix = 'Q%d-brand.' % brand_id
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(prefix) and filename not in current:
+            os.remove(os.path.join(cache_dir, filename))
+
+
+class _GzipCompressor(object):
+    def __init__(self):
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + 15)
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def _brand_etag(brand):
+    # Brands stored before we started keeping content hashes do not
+    # have one; for those, the modification time is the next best thing.
+    if brand['content_hash'] != None:
+        return brand['content_hash']
+    return brand['last_modified'].strftime('m%Y%m%dT%H%M%S%f')
+
+
+def _not_modified(etag, last_modified=None):
+    """Response 304 Not Modified if the client has a fresh copy, or None."""
+    if is_resource_modified(flask.request.environ, etag=etag,
+                            last_modified=last_modified):
+        return None
+    resp = flask.Response(status=HTTPStatus.NOT_MODIFIED)
+    _set_validators(resp, etag, last_modified)
+    return resp
+
+
+def _set_validators(resp, etag, last_modified=None):
+    resp.set_etag(etag)
+    if last_modified != None:
+        resp.last_modified = last_modified.replace(tzinfo=timezone.utc)
 
 
 @flask.stream_with_context
-def generate_brand_items_json(db, brand_id):
-    yield '{"type":"FeatureCollection","features":['
-    first = True
-    for f in db.execute(
-        'SELECT feature_id, lng, lat, props'
-        ' FROM brand_feature WHERE brand_id = ?',
-        (brand_id,)
-    ).fetchall():
-        feature = {
-            'type': 'Feature',
-            'id': f['feature_id'],
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [f['lng'], f['lat']]
-            },
-            'properties': json.loads(zlib.decompress(f['props']))
-        }
-        sep = '\n' if first else ',\n'
-        first = False
-        yield '%s%s' % (sep, json.dumps(feature))
-    yield ']}\n'
+def generate_brand_items_json(brand_id, bbox=None, limit=None, cursor=None,
+                              since=None, last_modified=None):
+    yield from _iter_brand_items_json(
+        brand_id, bbox, limit, cursor, since, last_modified)
+
+
+def _iter_brand_items_json(brand_id, bbox=None, limit=None, cursor=None,
+                           since=None, last_modified=None):
+    # Features are always returned in order of internal_id, so that
+    # paginated and unpaginated responses list them in the same order.
+    # For paginated responses, we use keyset pagination on internal_id,
+    # and fetch one extra feature to find out if there is a next page.
+    #
+    # When asked for the changes since some point in time, we return
+    # the features that were modified afterwards, and the ids of the
+    # features that got deleted. Deletions are only listed on the first
+    # page. To fetch the next changes, clients pass the returned
+    # timeStamp as since.
+    deleted = None
+    if since != None and cursor == None:
+        deleted = _find_deleted_features(brand_id, since)
+    if cursor == None:
+        cursor = 0
+    query, params = build_find_features_query(
+        brand_id, bbox=bbox, after=cursor, since=since,
+        limit=(limit + 1 if limit != None else None),
+        columns=['f.internal_id', 'f.feature_id', 'f.lng', 'f.lat',
+                 'f.hash_hi', 'f.hash_lo', 'f.props'])
+    # The stored properties are already serialized as canonical JSON,
+    # so we splice them into the output without parsing them again.
+    # Output gets buffered into chunks to reduce per-write overhead.
+    chunk = ['{"type":"FeatureCollection","features":[']
+    chunk_size = 0
+    num_returned, last_internal_id, has_more = 0, None, False
+    rows = get_db(readonly=True).cursor()
+    rows.row_factory = None
+    # Listing all features of a brand would only evict the popular
+    # ones from the properties cache, so full scans bypass it.
+    if limit == None and bbox == None and since == None:
+        get_props_json = lambda _id, _hi, _lo, props: \
+            brandy.codec.decompress(props).decode('utf-8')
+    else:
+        get_props_json = brandy.propcache.get_properties_cache().get_json
+    for internal_id, feature_id, lng, lat, hash_hi, hash_lo, props \
+            in rows.execute(query, params):
+        if limit != None and num_returned == limit:
+            has_more = True
+            break
+        feature = format_feature_json(
+            feature_id, lng, lat,
+            get_props_json(internal_id, hash_hi, hash_lo, props))
+        chunk.append('\n' if num_returned == 0 else ',\n')
+        chunk.append(feature)
+        chunk_size += len(feature)
+        num_returned += 1
+        last_internal_id = internal_id
+        if chunk_size >= ITEMS_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, chunk_size = [], 0
+    links = []
+    if has_more:
+        args = {'limit': limit, 'cursor': last_internal_id}
+        if bbox != None:
+            args['bbox'] = ','.join(repr(c) for c in bbox)
+        if since != None:
+            args['since'] = _format_timestamp(since)
+        links.append({
+            'rel': 'next',
+            'type': 'application/geo+json',
+            'href': flask.url_for('collections.items', _external=True,
+                                  brand_id=brand_id, **args)
+        })
+    chunk.append('],')
+    if deleted != None:
+        chunk.append('"deleted":%s,' % json.dumps(deleted, ensure_ascii=False))
+    if since != None and last_modified != None:
+        chunk.append('"timeStamp":%s,' % json.dumps(
+            _format_timestamp(last_modified)))
+    chunk.append('"numberReturned":%d,"links":%s}\n' % (
+        num_returned, json.dumps(links)))
+    yield ''.join(chunk)
+
+
+def _find_deleted_features(brand_id, since):
+    # A feature that got deleted and then re-appeared is not deleted
+    # anymore; it gets returned among the modified features.
+    return [f[0] for f in get_db(readonly=True).execute(
+        'SELECT DISTINCT t.feature_id FROM brand_feature_tombstone AS t'
+        ' WHERE t.brand_id = ? AND t.deleted > ? AND NOT EXISTS ('
+        '    SELECT 1 FROM brand_feature AS f'
+        '    WHERE f.brand_id = t.brand_id AND f.feature_id = t.feature_id)'
+        ' ORDER BY t.feature_id', (brand_id, since))]
+
+
+def _parse_since(s):
+    if s == None:
+        return None
+    try:
+        # Python 3.10 does not understand the 'Z' suffix of RFC 3339.
+        since = datetime.fromisoformat(
+            s[:-1] + '+00:00' if s.endswith('Z') else s)
+    except ValueError:
+        raise BadRequest('malformed since')
+    # Timestamps in the database are in UTC, without time zone.
+    if since.tzinfo != None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    if since < datetime.now() - TOMBSTONE_RETENTION:
+        raise Gone('since must be within the last %d days; '
+                   'fetch all items instead' % TOMBSTONE_RETENTION.days)
+    return since
+
+
+def _format_timestamp(t):
+    return t.isoformat(timespec='microseconds') + 'Z'
+
 
+def format_feature_json(feature_id, lng, lat, props_json):
+    return ('{"type":"Feature","id":%s,'
+            '"geometry":{"type":"Point","coordinates":[%r,%r]},'
+            '"properties":%s}') % (json.dumps(feature_id), lng, lat, props_json)
 
-def store_scraped(db, brand_id, scraped):
+
+def parse_bbox(s):
+    if s == None:
+        return None
+    try:
+        bbox = [float(c) for c in s.split(',')]
+    except ValueError:
+        raise BadRequest('malformed bbox')
+    if len(bbox) != 4 or not all(math.isfinite(c) for c in bbox):
+        raise BadRequest('malformed bbox')
+    return bbox
+
+
+def store_scraped(db, brand_id, scraped, progress=None):
+    """Store an uploaded scrape of a brand, without committing.
+
+    If passed, `progress` gets called after each batch of features with
+    the number of features processed and database rows changed so far.
+    Returns the final counts as a tuple."""
     now = datetime.now()
-    content = json.load(scraped)  # TODO: Use json_stream.
-    bbox = brandy.geometry.bbox(content)
-    if bbox == None:
-        raise BadRequest()
-    bbox = [float(c) for c in bbox]
     cursor = db.cursor()
 
-    old = {}
-    for f in cursor.execute(
-        'SELECT feature_id, hash_hi, hash_lo, last_modified'
-        ' FROM brand_feature WHERE brand_id = ?',
-        (brand_id,)
-    ).fetchall():
-        old[f['feature_id']] = (f['hash_hi'], f['hash_lo'], f['last_modified'])
-    last_modified = None
+    # We read the upload incrementally and process features in batches,
+    # so memory use does not depend on the size of the upload. For each
+    # batch, we compare the uploaded features against the stored ones;
+    # only new or changed features get written. Features that are
+    # not in the upload anymore get deleted at the end. To find them,
+    # the internal ids of old features that are still present get
+    # collected in a temporary table, which can be larger than memory.
+    # (Not with executescript(), which would commit the transaction.)
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS ingest_seen ('
+                   '    internal_id INTEGER PRIMARY KEY)')
+    cursor.execute('DELETE FROM temp.ingest_seen')
+    seq = cursor.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'brand_feature'"
+    ).fetchone()
+    first_new_id = (seq[0] if seq != None else 0) + 1
+    next_id = first_new_id
+    num_features, num_changed = 0, 0
+    bbox = None
+    content_hash = 0
+    compressor = None  # created for the first batch
+    features = []
+    try:
+        for feature in brandy.geojson.iter_features(scraped):
+            features.append(feature)
+            if len(features) < INGEST_BATCH_SIZE:
+                continue
+            batch = _prepare_features(features)
+            features = []
+            if compressor == None:
+                compressor = _make_compressor(db, brand_id, batch)
+            next_id, changed = _store_features(
+                cursor, brand_id, batch, first_new_id, next_id, now,
+                compressor)
+            bbox = brandy.geometry.union_bbox([bbox] + [f[6] for f in batch])
+            content_hash = _add_content_hashes(content_hash, batch)
+            num_features += len(batch)
+            num_changed += changed
+            if progress != None:
+                progress(num_features, num_changed)
+    except ValueError as e:  # malformed JSON
+        raise BadRequest('Malformed GeoJSON: %s' % e)
+    batch = _prepare_features(features)
+    bbox = brandy.geometry.union_bbox([bbox] + [f[6] for f in batch])
+    if bbox == None:
+        raise BadRequest('No features')
+    if compressor == None:
+        compressor = _make_compressor(db, brand_id, batch)
+    next_id, changed = _store_features(
+        cursor, brand_id, batch, first_new_id, next_id, now, compressor)
+    content_hash = _add_content_hashes(content_hash, batch)
+    num_features += len(batch)
+    num_changed += changed
+
+    # Deleting features happens in SQL, so the deleted features never
+    # get loaded into memory at once; this too can be the entire brand.
+    gone = ('FROM brand_feature WHERE brand_id = ? AND internal_id < ?'
+            ' AND internal_id NOT IN (SELECT internal_id FROM temp.ingest_seen)')
+    params = (brand_id, first_new_id)
+    cursor.execute(
+        'INSERT INTO brand_feature_tombstone (brand_id, feature_id, deleted)'
+        ' SELECT brand_id, feature_id, ? ' + gone, (now,) + params)
+    cursor.execute(
+        'DELETE FROM brand_feature_tombstone'
+        ' WHERE brand_id = ? AND deleted < ?',
+        (brand_id, now - TOMBSTONE_RETENTION))
+    keys = db.cursor()
+    keys.row_factory = None
+    keys.execute('SELECT internal_id, hash_hi, hash_lo ' + gone, params)
+    while True:
+        outdated = keys.fetchmany(INGEST_BATCH_SIZE)
+        if not outdated:
+            break
+        brandy.propcache.get_properties_cache().invalidate(outdated)
+    cursor.execute(
+        'DELETE FROM brand_feature_rtree'
+        ' WHERE internal_id IN (SELECT internal_id ' + gone + ')', params)
+    num_changed += cursor.execute('DELETE ' + gone, params).rowcount
+    cursor.execute('DELETE FROM temp.ingest_seen')
 
+    old_brand = cursor.execute(
+        'SELECT last_modified FROM brand WHERE wikidata_id = ?',
+        (brand_id,)).fetchone()
+    last_checked = now
+    if num_changed > 0 or old_brand == None:
+        last_modified = now
+    else:
+        last_modified = old_brand['last_modified']
     cursor.execute('DELETE FROM brand WHERE wikidata_id = ?', (brand_id,))
-    cursor.execute('DELETE FROM brand_feature WHERE brand_id = ?', (brand_id,))
-    cursor.execute('DELETE FROM brand_feature_rtree WHERE brand_id = ?',
-                   (brand_id,))
+    db.execute(
+        'INSERT INTO brand ('
+        '    wikidata_id, last_checked, last_modified, content_hash,'
+        '    min_lng, min_lat, max_lng, max_lat)'
+       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (brand_id, last_checked, last_modified, '%016x' % content_hash,
+         bbox[0], bbox[1], bbox[2], bbox[3]))
+    if num_changed > 0:
+        brandy.tiles.update_tile_index(db, brand_id)
+        brandy.tilecache.get_tile_cache().invalidate(brand_id)
+    if progress != None:
+        progress(num_features, num_changed)
+    return (num_features, num_changed)
 
-    for feature in content['features']:
-        min_lng, min_lat, max_lng, max_lat = brandy.geometry.bbox(feature)
+
+def _prepare_features(features):
+    """Turn a batch of uploaded GeoJSON features into database rows.
+
+    Returns a list of tuples (feature_id, lng, lat, hash_hi, hash_lo,
+    props_json, bbox). Features are placed at the center of their
+    bounding box."""
+    batch = []
+    bboxes = brandy.geometry.feature_bboxes(features)
+    for feature, feature_bbox in zip(features, bboxes):
+        if feature_bbox == None:
+            raise BadRequest('Feature without geometry')
+        min_lng, min_lat, max_lng, max_lat = feature_bbox
         lng, lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
         props = feature.get('properties', {})
         feature_id = str(feature.get('id') or props['ref'])
         props_json = json.dumps(props, ensure_ascii=False,
                                 separators=(',', ':'), sort_keys=True)
-        props_compressed = zlib.compress(props_json.encode('utf-8'), level=9)
-        hash_hi, hash_lo = hash_blob('%s%f%f%s' % (id, lng, lat, props_json))
-        feature_last_modified = now
-        if feature_id in old:
-            old_hash_hi, old_hash_lo, old_last_modified = old[feature_id]
+        hash_hi, hash_lo = hash_blob(
+            '%s%f%f%s' % (feature_id, lng, lat, props_json))
+        batch.append((feature_id, lng, lat, hash_hi, hash_lo,
+                      props_json, feature_bbox))
+    return batch
+
+
+def _make_compressor(db, brand_id, batch):
+    # Brands without a compression dictionary get one, trained on
+    # the properties in the first batch of uploaded features.
+    dictionary = brandy.codec.load_dictionary(db, brand_id)
+    if dictionary == None:
+        dictionary = brandy.codec.train_dictionary(
+            db, brand_id, [f[5].encode('utf-8') for f in batch])
+    return brandy.codec.Compressor(dictionary)
+
+
+def _store_features(cursor, brand_id, batch, first_new_id, next_id, now,
+                    compressor):
+    """Store a batch of uploaded features in the database.
+
+    Features whose hash has not changed since the previous upload are
+    left alone, except for re-compressing their properties if they were
+    stored with a different codec. Changed features get updated in place,
+    so they keep their internal id; new features get inserted with ids
+    starting at `next_id`. The internal ids of old features in the batch
+    get added to the temporary table ingest_seen; old features that are
+    already in there do not get matched again. Returns the next free
+    internal id and the number of changed features."""
+    if len(batch) == 0:
+        return next_id, 0
+    feature_ids = [f[0] for f in batch]
+    old = {}
+    for f in cursor.execute(
+        'SELECT internal_id, feature_id, hash_hi, hash_lo,'
+        '    substr(props, 1, 6) AS props_header'
+        ' FROM brand_feature WHERE brand_id = ? AND internal_id < ?'
+        ' AND feature_id IN (%s)'
+        ' AND internal_id NOT IN (SELECT internal_id FROM temp.ingest_seen)'
+        % ','.join('?' * len(feature_ids)),
+        [brand_id, first_new_id] + feature_ids
+    ):
+        old[f['feature_id']] = (f['internal_id'], f['hash_hi'], f['hash_lo'],
+                                f['props_header'])
+    inserted, inserted_rtree, updated, updated_rtree = [], [], [], []
+    recompressed, outdated = [], []
+    seen = set()
+    for feature_id, lng, lat, hash_hi, hash_lo, props_json, feature_bbox \
+            in batch:
+        old_id, old_hash_hi, old_hash_lo, old_header = \
+            old.get(feature_id, (0, 0, 0, None))
+        if old_id in seen:  # same id uploaded twice; keep both
+            old_id = 0
+        if old_id > 0:
+            seen.add(old_id)
             if hash_hi == old_hash_hi and hash_lo == old_hash_lo:
-                feature_last_modified = old_last_modified
-        if last_modified == None or last_modified < feature_last_modified:
-            last_modified = feature_last_modified
-        cursor.execute(
-            'INSERT INTO brand_feature ('
-            '    brand_id, feature_id, lng, lat,'
-            '    hash_hi, hash_lo, last_modified, props)'
-            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            (brand_id, feature_id, lng, lat, hash_hi, hash_lo, last_modified,
-             props_compressed))
-        internal_id = cursor.lastrowid
-        cursor.execute(
-            'INSERT INTO brand_feature_rtree ('
-            '    internal_id, min_lng, max_lng, min_lat, max_lat, brand_id)'
-			'VALUES (?, ?, ?, ?, ?, ?)',
-			(internal_id, min_lng, max_lng, min_lat, max_lat, brand_id))
+                if compressor.header != None and \
+                        not old_header.startswith(compressor.header):
+                    recompressed.append((compressor.compress(
+                        props_json.encode('utf-8')), old_id))
+                continue
+        props_compressed = compressor.compress(props_json.encode('utf-8'))
+        min_lng, min_lat, max_lng, max_lat = feature_bbox
+        if old_id > 0:
+            updated.append((lng, lat, hash_hi, hash_lo, now,
+                            props_compressed, old_id))
+            outdated.append((old_id, old_hash_hi, old_hash_lo))
+            updated_rtree.append((min_lng, max_lng, min_lat, max_lat,
+                                  old_id))
+        else:
+            inserted.append((next_id, brand_id, feature_id, lng, lat,
+                             hash_hi, hash_lo, now, props_compressed))
+            inserted_rtree.append((next_id, min_lng, max_lng,
+                                   min_lat, max_lat, brand_id))
+            next_id += 1
+    cursor.executemany(
+        'INSERT INTO brand_feature ('
+        '    internal_id, brand_id, feature_id, lng, lat,'
+        '    hash_hi, hash_lo, last_modified, props)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', inserted)
+    cursor.executemany(
+        'INSERT INTO brand_feature_rtree ('
+        '    internal_id, min_lng, max_lng, min_lat, max_lat, brand_id)'
+        ' VALUES (?, ?, ?, ?, ?, ?)', inserted_rtree)
+    cursor.executemany(
+        'UPDATE brand_feature SET lng = ?, lat = ?, hash_hi = ?, hash_lo = ?,'
+        '    last_modified = ?, props = ?'
+        ' WHERE internal_id = ?', updated)
+    cursor.executemany(
+        'UPDATE brand_feature_rtree'
+        ' SET min_lng = ?, max_lng = ?, min_lat = ?, max_lat = ?'
+        ' WHERE internal_id = ?', updated_rtree)
+    cursor.executemany(
+        'UPDATE brand_feature SET props = ? WHERE internal_id = ?',
+        recompressed)
+    cursor.executemany(
+        'INSERT INTO temp.ingest_seen (internal_id) VALUES (?)',
+        ((i,) for i in seen))
+    brandy.propcache.get_properties_cache().invalidate(outdated)
+    return next_id, len(inserted) + len(updated)
 
-    last_checked = now
-    if last_modified == None:
-        last_modified = now
-    db.execute(
-        'INSERT INTO brand ('
-        '    wikidata_id, last_checked, last_modified,'
-        '    min_lng, min_lat, max_lng, max_lat)'
-       'VALUES (?, ?, ?, ?, ?, ?, ?)',
-        (brand_id, last_checked, last_modified,
-         bbox[0], bbox[1], bbox[2], bbox[3]))
+
+def _add_content_hashes(content_hash, batch):
+    # The content hash of a brand is the sum of its feature hashes,
+    # so it does not depend on the order of features in the upload.
+    for feature_id, _lng, _lat, hash_hi, hash_lo, _props, _bbox in batch:
+        h = hash_blob('%s:%d:%d' % (feature_id, hash_hi, hash_lo))
+        content_hash += (h[0] << 32) ^ (h[1] & 0xFFFFFFFF)
+    return content_hash & 0xFFFFFFFFFFFFFFFF
 
 
 def hash_blob(b):
@@ -1,40 +1,232 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 
+from collections import OrderedDict
 import getpass
+import os
 import re
 import sqlite3
+import threading
+import urllib.parse
+import weakref
 
 import click
 from flask import current_app, g
+from flask.cli import with_appcontext
 from werkzeug.security import generate_password_hash
 
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-    return g.db
+# Number of prepared statements that get cached per database connection.
+STATEMENT_CACHE_SIZE = 256
+
+_migration_name = re.compile(r'([0-9]{4})_\w+\.sql')
+
+
+def get_db(readonly=False):
+    """Return the database connection for the current thread.
+
+    Read-only connections cannot write, but in WAL mode they also never
+    wait for a writer, such as a scrape being stored concurrently."""
+    key = 'db_ro' if readonly else 'db'
+    if key not in g:
+        setattr(g, key, current_app.extensions['db'].get(readonly))
+    return getattr(g, key)
 
 
 def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    # Connections stay open for the next request on the same thread,
+    # but any transaction that was not committed gets rolled back.
+    for key in ('db', 'db_ro'):
+        db = g.pop(key, None)
+        if db is not None and db.in_transaction:
+            db.rollback()
+
+
+class ConnectionManager(object):
+    """Keeps SQLite connections open across requests, one per thread.
+
+    Opening a connection is not free: SQLite needs to parse the schema,
+    its page cache starts out cold, and all prepared statements are gone.
+    Since waitress serves requests from a fixed set of worker threads,
+    we keep one read-write and one read-only connection per thread."""
+
+    def __init__(self, path, cache_size, mmap_size):
+        self.path = path
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+        self._num_opened = 0
+
+    def get(self, readonly):
+        key = 'readonly' if readonly else 'readwrite'
+        db = getattr(self._local, key, None)
+        if db == None:
+            db = self._open(readonly)
+            setattr(self._local, key, db)
+            with self._lock:
+                self._connections.add(db)
+                self._num_opened += 1
+        return db
+
+    def _open(self, readonly):
+        if readonly:
+            path = 'file:%s?mode=ro' % urllib.parse.quote(self.path)
+        else:
+            path = self.path
+        # We never share connections across threads, but close() can
+        # get called from any thread.
+        db = sqlite3.connect(
+            path, uri=readonly, factory=_Connection,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False)
+        # Rows can be accessed by column name. On hot paths, callers set
+        # row_factory = None on their cursor; plain tuples are faster.
+        db.row_factory = sqlite3.Row
+        if not readonly:
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA cache_size = %d' % -(self.cache_size // 1024))
+        db.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+        return db
+
+    def stats(self):
+        with self._lock:
+            connections = list(self._connections)
+            num_opened = self._num_opened
+        hits = sum(c.statement_cache_hits for c in connections)
+        misses = sum(c.statement_cache_misses for c in connections)
+        return {
+            'connections_opened': num_opened,
+            'connections_open': len(connections),
+            'statement_cache_hits': hits,
+            'statement_cache_misses': misses,
+            'statement_cache_hit_rate':
+                hits / (hits + misses) if hits + misses > 0 else None,
+        }
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for db in connections:
+            db.close()
+        self._local = threading.local()
+
+
+class _Connection(sqlite3.Connection):
+    # The sqlite3 module does not tell how well its statement cache
+    # works, so we keep track of the statements it would have cached.
+    # Like sqlite3, we evict the least recently used statement.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = OrderedDict()
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or _Cursor)
+
+    # Statements get tracked by _Cursor only. Before Python 3.11,
+    # sqlite3.Connection.execute() called self.cursor().execute(),
+    # so tracking them here too would have counted them twice.
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def track_statement(self, sql):
+        if sql in self.statements:
+            self.statements.move_to_end(sql)
+            self.statement_cache_hits += 1
+        else:
+            self.statement_cache_misses += 1
+            self.statements[sql] = True
+            if len(self.statements) > STATEMENT_CACHE_SIZE:
+                self.statements.popitem(last=False)
+
+
+class _Cursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        self.connection.track_statement(sql)
+        return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        self.connection.track_statement(sql)
+        return super().executemany(sql, *args)
 
 
 def init_db():
     db = get_db()
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf-8'))
+    migrations = _find_migrations()
+    db.execute('PRAGMA user_version = %d' % (
+        migrations[-1][0] if migrations else 0))
+
+
+def migrate_db():
+    """Upgrade the database schema to the latest version, in place.
+
+    The schema version is kept in PRAGMA user_version. Each migration
+    runs in its own transaction, together with bumping the version.
+    Databases without any tables get initialized from scratch.
+    Returns the names of the migrations that were applied."""
+    db = get_db()
+    if db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'brand'"
+                  ).fetchone()[0] == 0:
+        init_db()
+        return []
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    applied = []
+    for migration_version, name in _find_migrations():
+        if migration_version <= version:
+            continue
+        with current_app.open_resource('migrations/' + name) as f:
+            script = f.read().decode('utf-8')
+        try:
+            db.executescript('BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;'
+                             % (script, migration_version))
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(name)
+    # Collect statistics for the query planner, which helps it to pick
+    # between the indexes on brand_feature. The join order of bounding
+    # box queries does not depend on this; see build_find_features_query.
+    if applied:
+        db.execute('ANALYZE')
+        db.commit()
+    return applied
+
+
+def _find_migrations():
+    # Migrations are SQL scripts named like 0001_description.sql,
+    # sorted by the version that they upgrade the database to.
+    path = os.path.join(current_app.root_path, 'migrations')
+    migrations = []
+    for name in os.listdir(path):
+        m = _migration_name.fullmatch(name)
+        if m != None:
+            migrations.append((int(m.group(1)), name))
+    return sorted(migrations)
 
 
 def init_app(app):
+    from brandy.tiles import render_tiles_command
+    app.extensions['db'] = ConnectionManager(
+        path=app.config['DATABASE'],
+        cache_size=app.config['DATABASE_CACHE_SIZE'],
+        mmap_size=app.config['DATABASE_MMAP_SIZE'])
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(render_tiles_command)
     app.cli.add_command(add_admin_command)
 
 
@@ -45,6 +237,16 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Upgrade the database schema, keeping the existing data."""
+    for name in migrate_db():
+        click.echo('Applied migration %s' % name)
+    click.echo('Database schema is at version %d.' % get_db().execute(
+        'PRAGMA user_version').fetchone()[0])
+
+
 def create_user(username, password, is_admin=False):
     password_hash = generate_password_hash(password)
     db = get_db()
@@ -65,20 +267,44 @@ def add_admin_command():
     click.echo('Created user \"%s\" with admin rights.' % username)
 
 
-def build_find_features_query(brand_id, bbox=None, limit=None):
-    columns = ['f.feature_id', 'f.lng', 'f.lat', 'f.props']
+def build_find_features_query(brand_id, bbox=None, limit=None, columns=None,
+                              after=None, since=None):
+    if columns == None:
+        columns = ['f.feature_id', 'f.lng', 'f.lat', 'f.props']
+    # All values are passed as query parameters, so the statement text
+    # stays the same across requests and hits the statement cache.
     tables = ['brand_feature AS f']
     conditions, params = ['f.brand_id=?'], [brand_id]
+    if since != None:  # only features modified after a point in time
+        # Without this hint, SQLite walks all features of the brand
+        # in order of internal_id. Changes are usually few, so it is
+        # much cheaper to find them by index and sort them afterwards.
+        if bbox == None:
+            tables[0] += ' INDEXED BY brand_feature_last_modified'
+        conditions.append('f.last_modified>?')
+        params.append(since)
     if bbox != None:
-        tables.append('brand_feature_rtree AS r')
+        # The spatial index must drive the join, else SQLite may prefer
+        # to walk all features of the brand by the brand_id indexes and
+        # probe the rtree for each of them. CROSS JOIN fixes the order.
+        tables.insert(0, 'brand_feature_rtree AS r')
         conditions.append('f.internal_id=r.internal_id')
-        conditions.append('r.min_lng>=%g' % float(bbox[0]))
-        conditions.append('r.max_lng<=%g' % float(bbox[2]))
-        conditions.append('r.min_lat>=%g' % float(bbox[1]))
-        conditions.append('r.max_lat<=%g' % float(bbox[3]))
-        conditions.append('r.brand_id=%d' % brand_id)
+        conditions.append('r.min_lng>=?')
+        conditions.append('r.max_lng<=?')
+        conditions.append('r.min_lat>=?')
+        conditions.append('r.max_lat<=?')
+        conditions.append('r.brand_id=?')
+        params.extend([float(bbox[0]), float(bbox[2]),
+                       float(bbox[1]), float(bbox[3]), brand_id])
+    if after != None:  # keyset pagination
+        conditions.append('f.internal_id>?')
+        params.append(int(after))
     query = 'SELECT %s FROM %s WHERE %s' % (
-        ', '.join(columns), ', '.join(tables), ' AND '.join(conditions))
+        ', '.join(columns), ' CROSS JOIN '.join(tables),
+        ' AND '.join(conditions))
+    if after != None:
+        query += ' ORDER BY f.internal_id'
     if limit != None:
-        query += ' LIMIT %d' % int(limit)
+        query += ' LIMIT ?'
+        params.append(int(limit))
     return (query, tuple(params))
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Incremental reading of GeoJSON FeatureCollections
+#
+# Scrapers upload all features of a brand as one GeoJSON file, which
+# can be hundreds of megabytes for a nationwide chain. Instead of parsing
+# the whole document into memory, we walk its top-level structure by hand
+# and decode one feature at a time with the standard library's JSON
+# decoder. That decoder is implemented in C; a pure-Python streaming
+# tokenizer such as json_stream was about nine times slower.
+
+import codecs
+import json
+import re
+
+
+CHUNK_SIZE = 256 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def iter_features(f):
+    """Iterate over the features of a GeoJSON FeatureCollection.
+
+    `f` is a binary file object with UTF-8 encoded GeoJSON. Members of the
+    FeatureCollection other than "features" get skipped. Raises ValueError
+    if the input is not a well-formed JSON object."""
+    r = _Reader(f)
+    r.expect('{')
+    if r.peek() == '}':
+        r.expect('}')
+    else:
+        while True:
+            key = r.value()
+            if type(key) != str:
+                raise ValueError('expected member name at offset %d' % r.offset)
+            r.expect(':')
+            if key == 'features' and r.peek() == '[':
+                r.expect('[')
+                if r.peek() != ']':
+                    while True:
+                        yield r.value()
+                        if r.peek() != ',':
+                            break
+                        r.expect(',')
+                r.expect(']')
+            else:
+                r.value()
+            if r.peek() != ',':
+                break
+            r.expect(',')
+        r.expect('}')
+    if r.peek() != '':
+        raise ValueError('unexpected data at offset %d' % r.offset)
+
+
+class _Reader(object):
+    def __init__(self, f):
+        self._f = f
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._consumed = 0  # characters dropped from the start of _buf
+
+    @property
+    def offset(self):
+        return self._consumed + self._pos
+
+    def peek(self):
+        """Return the next non-whitespace character, or '' at the end."""
+        while True:
+            self._pos = _whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('expected %r at offset %d' % (c, self.offset))
+        self._pos += 1
+
+    def value(self):
+        """Decode the next JSON value, reading more input as needed."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer might continue
+                # in the next chunk of input.
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _fill(self):
+        """Read the next chunk of input; False if there was none left."""
+        if self._eof:
+            return False
+        data = self._f.read(CHUNK_SIZE)
+        self._eof = not data
+        text = self._utf8.decode(data, final=self._eof)
+        self._consumed += self._pos
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
@@ -2,9 +2,19 @@
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 #
 # Geometry-related utility functions
+#
+# Besides scalar functions, there are batch versions that work on many
+# points at once, for building the tile index and storing uploads. If
+# NumPy is installed, the batch functions return NumPy arrays and run
+# vectorized; otherwise they fall back to plain Python lists.
 
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def wgs84_to_tile(lng, lat, zoom):
     """WGS-84 (longitude, lat) to tile coordinates (x, y) at given zoom."""
@@ -15,6 +25,17 @@ def wgs84_to_tile(lng, lat, zoom):
     return (x, y)
 
 
+def wgs84_to_pixel(lng, lat, zoom):
+    """WGS-84 (longitude, lat) to pixel coordinates (x, y) at given zoom.
+
+    Pixel coordinates are floats, for tiles of 256 by 256 pixels."""
+    lat_rad = math.radians(lat)
+    n = float(256 << zoom)
+    x = (lng + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    return (x, y)
+
+
 def tile_to_wgs84(zoom, x, y):
     """Tile coordinates (zoom, x, y) --> WGS-84 (longitude, latitude)"""
     n = float(1 << zoom)
@@ -23,66 +44,178 @@ def tile_to_wgs84(zoom, x, y):
     return (lng, math.degrees(lat_rad))
 
 
+def wgs84_to_tiles(lngs, lats, zoom):
+    """Batch version of wgs84_to_tile(); returns arrays (xs, ys)."""
+    if numpy == None:
+        tiles = [wgs84_to_tile(lng, lat, zoom) for lng, lat in zip(lngs, lats)]
+        return ([t[0] for t in tiles], [t[1] for t in tiles])
+    xs, ys = wgs84_to_pixels(lngs, lats, zoom)
+    # Like int() in the scalar version, astype() truncates towards zero.
+    return ((xs / 256.0).astype(numpy.int64), (ys / 256.0).astype(numpy.int64))
+
+
+def wgs84_to_pixels(lngs, lats, zoom):
+    """Batch version of wgs84_to_pixel(); returns arrays (xs, ys)."""
+    if numpy == None:
+        pixels = [wgs84_to_pixel(lng, lat, zoom)
+                  for lng, lat in zip(lngs, lats)]
+        return ([p[0] for p in pixels], [p[1] for p in pixels])
+    lngs = numpy.asarray(lngs, dtype=numpy.float64)
+    lat_rad = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    n = float(256 << zoom)
+    xs = (lngs + 180.0) / 360.0 * n
+    ys = (1.0 - numpy.arcsinh(numpy.tan(lat_rad)) / math.pi) / 2.0 * n
+    return (xs, ys)
+
+
+def tiles_to_wgs84(zoom, xs, ys):
+    """Batch version of tile_to_wgs84(); returns arrays (lngs, lats)."""
+    if numpy == None:
+        points = [tile_to_wgs84(zoom, x, y) for x, y in zip(xs, ys)]
+        return ([p[0] for p in points], [p[1] for p in points])
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    n = float(1 << zoom)
+    lngs = xs / n * 360.0 - 180.0
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * ys / n))))
+    return (lngs, lats)
+
+
+def halve_pixels(xs, ys):
+    """Pixel coordinates (xs, ys) at the next lower zoom level."""
+    if numpy == None:
+        return ([x / 2 for x in xs], [y / 2 for y in ys])
+    return (xs / 2, ys / 2)
+
+
+def marker_tiles(xs, ys, radius, zoom):
+    """Tiles touched by square markers around points in pixel coordinates.
+
+    The markers extend `radius` pixels around each point. Returns the
+    set of tiles (x, y) at `zoom`, clamped to the bounds of the world."""
+    max_tile = (1 << zoom) - 1
+    if numpy == None:
+        tiles = set()
+        for px, py in zip(xs, ys):
+            x1 = min(max(int((px - radius) // 256), 0), max_tile)
+            x2 = min(max(int((px + radius) // 256), 0), max_tile)
+            y1 = min(max(int((py - radius) // 256), 0), max_tile)
+            y2 = min(max(int((py + radius) // 256), 0), max_tile)
+            tiles.update(((x1, y1), (x1, y2), (x2, y1), (x2, y2)))
+        return tiles
+    xs, ys = numpy.asarray(xs), numpy.asarray(ys)
+    x1, x2, y1, y2 = [
+        numpy.clip(c // 256, 0, max_tile).astype(numpy.int64)
+        for c in (xs - radius, xs + radius, ys - radius, ys + radius)]
+    # Markers are smaller than tiles, so the four corners suffice.
+    # Tiles get encoded into single integers, which is faster to
+    # de-duplicate than pairs.
+    n = max_tile + 1
+    keys = numpy.unique(numpy.concatenate(
+        (x1 * n + y1, x1 * n + y2, x2 * n + y1, x2 * n + y2)))
+    return set(zip((keys // n).tolist(), (keys % n).tolist()))
+
+
+def pixel_cells(xs, ys):
+    """Count the points in each pixel; returns a dict (x, y) --> count."""
+    if numpy == None:
+        cells = {}
+        for px, py in zip(xs, ys):
+            cell = (int(px), int(py))
+            cells[cell] = cells.get(cell, 0) + 1
+        return cells
+    if len(xs) == 0:
+        return {}
+    x = numpy.asarray(xs).astype(numpy.int64)
+    y = numpy.asarray(ys).astype(numpy.int64)
+    # Shift to non-negative values, so we can encode cells as integers.
+    min_x, min_y = int(x.min()), int(y.min())
+    n = int(y.max()) - min_y + 1
+    keys, counts = numpy.unique((x - min_x) * n + (y - min_y),
+                                return_counts=True)
+    return dict(zip(zip((keys // n + min_x).tolist(),
+                        (keys % n + min_y).tolist()), counts.tolist()))
+
+
+# Nesting depth of point arrays in the coordinates of GeoJSON geometries.
+_COORDINATES_DEPTH = {
+    'Point': 0,
+    'LineString': 1,
+    'MultiPoint': 1,
+    'Polygon': 2,
+    'MultiLineString': 2,
+    'MultiPolygon': 3,
+}
+
+
 def bbox(o):
     """Compute bounding box of a GeoJSON Feature, FeatureCollection or geometry"""
     if type(o) != dict:
         return None
-    t = o.get('type')
-    if t == 'Feature':
-        return bbox(o.get('geometry'))
-    if t == 'FeatureCollection':
-        features = o.get('features', [])
+    if o.get('type') == 'FeatureCollection':
         # may be empty as per RFC 7946 section 3.3
-        if features == None or len(features) == 0:
-            return None
-        min_lng, min_lat, max_lng, max_lat = bbox(features[0])
-        for f in features[1:]:
-            f_min_lng, f_min_lat, f_max_lng, f_max_lat = bbox(f)
-            min_lng = min(f_min_lng, min_lng)
-            min_lat = min(f_min_lat, min_lat)
-            max_lng = max(f_max_lng, max_lng)
-            max_lat = max(f_max_lat, max_lat)
-        return (min_lng, min_lat, max_lng, max_lat)
-    if t == 'GeometryCollection':
-        g = o['geometries']
-        if len(g) == 0:  # may be empty as per RFC 7946 section 3.1.8
-            return None
-        min_lng, min_lat, max_lng, max_lat = bbox(g[0])
-        for s in g[1:]:
-            s_min_lng, s_min_lat, s_max_lng, s_max_lat = bbox(s)
-            min_lng = min(s_min_lng, min_lng)
-            min_lat = min(s_min_lat, min_lat)
-            max_lng = max(s_max_lng, max_lng)
-            max_lat = max(s_max_lat, max_lat)
-        return (min_lng, min_lat, max_lng, max_lat)
-    c = o.get('coordinates')
-    if t == 'Point':
-        return (c[0], c[1], c[0], c[1])
-    if t == 'LineString' or t == 'MultiPoint':
-        min_lng = max_lng = c[0][0]
-        min_lat = max_lat = c[0][1]
-        for p in c[1:]:
-            lng, lat = p[0], p[1]
-            min_lng, min_lat = min(lng, min_lng), min(lat, min_lat)
-            max_lng, max_lat = max(lng, max_lng), max(lat, max_lat)
-        return (min_lng, min_lat, max_lng, max_lat)
-    if t == 'Polygon' or t == 'MultiLineString':
-        min_lng = max_lng = c[0][0][0]
-        min_lat = max_lat = c[0][0][1]
-        for r in c:
-            for p in r:
-                lng, lat = p[0], p[1]
-                min_lng, min_lat = min(lng, min_lng), min(lat, min_lat)
-                max_lng, max_lat = max(lng, max_lng), max(lat, max_lat)
-        return (min_lng, min_lat, max_lng, max_lat)
-    if t == 'MultiPolygon':
-        min_lng = max_lng = c[0][0][0][0]
-        min_lat = max_lat = c[0][0][0][1]
-        for multipoly in c:
-            for ring in multipoly:
-                for p in ring:
-                    lng, lat = p[0], p[1]
-                    min_lng, min_lat = min(lng, min_lng), min(lat, min_lat)
-                    max_lng, max_lat = max(lng, max_lng), max(lat, max_lat)
-        return (min_lng, min_lat, max_lng, max_lat)
-    return None
+        return union_bbox(feature_bboxes(o.get('features') or []))
+    return feature_bboxes([o])[0]
+
+
+def feature_bboxes(features):
+    """Compute bounding boxes of many GeoJSON Features or geometries.
+
+    Returns a list with a tuple (min_lng, min_lat, max_lng, max_lat) for
+    each feature, or None for features without a geometry. Geometries
+    get walked without recursion; their points are collected into lists,
+    so that the built-in min() and max() can scan them at C speed."""
+    result = []
+    for f in features:
+        if type(f) == dict and f.get('type') == 'Feature':
+            f = f.get('geometry')
+        # Most features of brands are points; this is the fast path.
+        if type(f) == dict and f.get('type') == 'Point':
+            c = f.get('coordinates')
+            result.append((c[0], c[1], c[0], c[1]) if c else None)
+            continue
+        points = []
+        stack = [f]
+        while stack:
+            g = stack.pop()
+            if type(g) != dict:
+                continue
+            t = g.get('type')
+            if t == 'GeometryCollection':
+                # may be empty as per RFC 7946 section 3.1.8
+                stack.extend(g.get('geometries') or [])
+                continue
+            depth = _COORDINATES_DEPTH.get(t)
+            c = g.get('coordinates')
+            if depth == None or not c:
+                continue
+            if depth == 0:
+                points.append(c)
+            elif depth == 1:
+                points.extend(c)
+            elif depth == 2:
+                for ring in c:
+                    points.extend(ring)
+            else:
+                for poly in c:
+                    for ring in poly:
+                        points.extend(ring)
+        if len(points) == 0:
+            result.append(None)
+        elif len(points) == 1:
+            lng, lat = points[0][0], points[0][1]
+            result.append((lng, lat, lng, lat))
+        else:
+            lngs = [p[0] for p in points]
+            lats = [p[1] for p in points]
+            result.append((min(lngs), min(lats), max(lngs), max(lats)))
+    return result
+
+
+def union_bbox(bboxes):
+    """Bounding box that covers all given boxes; None entries get skipped."""
+    bboxes = [b for b in bboxes if b != None]
+    if len(bboxes) == 0:
+        return None
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
@@ -0,0 +1,240 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Flask blueprint for handling /jobs/*
+#
+# Uploaded scrapes get stored in the background, so that uploading a
+# large brand does not hold a request thread for minutes. Each upload
+# becomes a job: the uploaded file is spooled to the instance volume,
+# next to a small JSON file with the status of the job. A single worker
+# thread processes one job after the other, so there is only one writer
+# to the database. Job status is not kept in the database, because the
+# database is locked for writing while a job is running.
+
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import uuid
+
+import flask
+from werkzeug.exceptions import HTTPException, NotFound
+
+import brandy.collections
+from brandy.auth import auth
+from brandy.db import get_db
+from brandy.tilecache import get_tile_cache
+
+bp = flask.Blueprint('jobs', __name__, url_prefix='/jobs')
+
+# How long to keep the status of finished jobs.
+JOB_RETENTION = timedelta(days=7)
+
+_job_id = re.compile(r'[0-9a-f]{32}')
+
+
+@bp.before_app_request
+def start_worker():
+    # Resume the jobs that were left over by a previous server process.
+    get_ingest_worker().start()
+
+
+@bp.route('/<job_id>')
+@auth.login_required()
+def job(job_id):
+    # Jobs can only be seen by the user who submitted them, because
+    # their errors may tell details about the upload. For other users,
+    # the job does not exist.
+    job = get_ingest_worker().get(job_id)
+    if job == None or job['user'] != auth.current_user():
+        raise NotFound()
+    return job_json(job)
+
+
+def job_json(job):
+    return {
+        'id': job['id'],
+        'collection': 'Q%d-brand' % job['brand_id'],
+        'user': job['user'],
+        'status': job['status'],
+        'created': job['created'],
+        'started': job['started'],
+        'finished': job['finished'],
+        'features_processed': job['features_processed'],
+        'rows_changed': job['rows_changed'],
+        'error': job['error'],
+        'links': [{
+            'rel': 'self',
+            'href': flask.url_for('jobs.job', job_id=job['id'],
+                                  _external=True),
+            'type': 'application/json'
+        }, {
+            'rel': 'items',
+            'href': flask.url_for('collections.items',
+                                  brand_id=job['brand_id'], _external=True),
+            'type': 'application/geo+json'
+        }]
+    }
+
+
+def submit_ingest_job(brand_id, scraped, user):
+    """Queue an uploaded scrape for storing; returns the job as JSON."""
+    return job_json(get_ingest_worker().submit(brand_id, scraped, user))
+
+
+class IngestWorker(object):
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._progress = {}  # job id --> (features processed, rows changed)
+
+    def start(self):
+        with self._lock:
+            if self._thread != None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            pending = []
+            for filename in os.listdir(self.path):
+                if filename.endswith('.json'):
+                    job = self.get(filename[:-len('.json')])
+                    if job != None and job['status'] in ('queued', 'running'):
+                        pending.append(job)
+            for job in sorted(pending, key=lambda j: j['created']):
+                self._queue.put(job['id'])
+            self._remove_expired()
+            self._thread = threading.Thread(
+                target=self._run, name='ingest', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread != None:
+            self._queue.put(None)
+            thread.join()
+
+    def submit(self, brand_id, scraped, user):
+        self.start()
+        job_id = uuid.uuid4().hex
+        scraped.save(self._path(job_id, 'geojson'))
+        job = {
+            'id': job_id,
+            'brand_id': brand_id,
+            'user': user,
+            'status': 'queued',
+            'created': _now(),
+            'started': None,
+            'finished': None,
+            'features_processed': 0,
+            'rows_changed': 0,
+            'error': None,
+        }
+        self._write(job)
+        self._queue.put(job_id)
+        return job
+
+    def get(self, job_id):
+        if not _job_id.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(job_id, 'json'), 'r') as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return None
+        progress = self._progress.get(job_id)
+        if progress != None and job['status'] == 'running':
+            job['features_processed'], job['rows_changed'] = progress
+        return job
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id == None:
+                return
+            with self.app.app_context():
+                self._process(job_id)
+
+    def _process(self, job_id):
+        job = self.get(job_id)
+        if job == None or job['status'] not in ('queued', 'running'):
+            return
+        job['status'], job['started'] = 'running', _now()
+        self._write(job)
+        self._progress[job_id] = (0, 0)
+        def progress(num_features, num_changed):
+            self._progress[job_id] = (num_features, num_changed)
+        db = get_db()
+        try:
+            with open(self._path(job_id, 'geojson'), 'rb') as scraped:
+                counts = brandy.collections.store_scraped(
+                    db, job['brand_id'], scraped, progress)
+            db.commit()
+            job['status'] = 'done'
+            job['features_processed'], job['rows_changed'] = counts
+        except Exception as e:
+            db.rollback()
+            job['status'] = 'failed'
+            job['features_processed'] = self._progress[job_id][0]
+            if isinstance(e, HTTPException):
+                job['error'] = e.description
+            else:
+                self.app.logger.exception('ingest job %s failed', job_id)
+                job['error'] = 'Internal error'
+        # Now that the transaction is over, we can delete the cached tiles
+        # that store_scraped() has invalidated.
+        get_tile_cache().remove_trash()
+        if job['status'] == 'done':
+            try:
+                brandy.collections.build_precompressed_items(job['brand_id'])
+            except Exception:
+                self.app.logger.exception(
+                    'compressing items of Q%d failed', job['brand_id'])
+        job['finished'] = _now()
+        self._write(job)
+        del self._progress[job_id]
+        _remove(self._path(job_id, 'geojson'))
+
+    def _remove_expired(self):
+        expiry = (datetime.now(timezone.utc) - JOB_RETENTION).isoformat(
+            timespec='seconds')
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json'):
+                continue
+            job = self.get(filename[:-len('.json')])
+            if job != None and job['finished'] != None and \
+                    job['finished'] < expiry:
+                _remove(self._path(job['id'], 'json'))
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.path, '%s.%s' % (job_id, ext))
+
+    def _write(self, job):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job['id'], 'json'))
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_ingest_worker():
+    return flask.current_app.extensions['ingest']
+
+
+def init_app(app):
+    app.extensions['ingest'] = IngestWorker(app, app.config['INGEST_SPOOL'])
@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Reading and writing MBTiles archives of pre-rendered map tiles
+#
+# https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+
+from collections import OrderedDict
+import os
+import sqlite3
+import tempfile
+import threading
+import urllib.parse
+
+from flask import current_app
+
+# Maximal number of archives that are kept open for serving tiles.
+MAX_OPEN_ARCHIVES = 64
+
+
+def write(path, metadata, tiles):
+    """Write an MBTiles archive, replacing any existing file atomically.
+
+    `tiles` is an iterable of (zoom, x, y, data) tuples in XYZ scheme;
+    the MBTiles specification wants TMS rows, so we flip y."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmp_path)
+        db.executescript(
+            'CREATE TABLE metadata (name TEXT, value TEXT);'
+            'CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,'
+            '    tile_row INTEGER, tile_data BLOB);'
+            'CREATE UNIQUE INDEX tile_index'
+            '    ON tiles (zoom_level, tile_column, tile_row);')
+        db.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                       sorted(metadata.items()))
+        db.executemany(
+            'INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)'
+            ' VALUES (?, ?, ?, ?)',
+            ((z, x, (1 << z) - 1 - y, data) for z, x, y, data in tiles))
+        db.commit()
+        db.close()
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class Reader(object):
+    def __init__(self, path):
+        # Readers get shared by the request threads, see ReaderCache.
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(path)
+        self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.metadata = dict(
+            self.db.execute('SELECT name, value FROM metadata').fetchall())
+        self._lock = threading.Lock()
+
+    def get(self, zoom, x, y):
+        with self._lock:
+            row = self.db.execute(
+                'SELECT tile_data FROM tiles'
+                ' WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (zoom, x, (1 << zoom) - 1 - y)).fetchone()
+        return row[0] if row != None else None
+
+    def close(self):
+        self.db.close()
+
+
+def open_archive(path):
+    """Open an MBTiles archive for reading, or return None if missing."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return Reader(path)
+    except sqlite3.OperationalError:  # deleted concurrently, or corrupt
+        return None
+
+
+class ReaderCache(object):
+    """Keeps archives open across requests.
+
+    Serving a tile from a freshly opened archive would need a new SQLite
+    connection and a read of the metadata table. Since `write` replaces
+    archives atomically, a change in file identity or modification time
+    tells when a cached reader is outdated. Outdated readers are not
+    closed explicitly, because other threads may still be using them;
+    their connection gets closed when the last reference goes away."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._readers = OrderedDict()  # path --> (file identity, Reader)
+
+    def get(self, path):
+        """Reader for an MBTiles archive, or None if it is missing."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._readers.pop(path, None)
+            return None
+        ident = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._readers.get(path)
+            if entry != None and entry[0] == ident:
+                self._readers.move_to_end(path)
+                return entry[1]
+        reader = open_archive(path)
+        if reader == None:
+            return None
+        with self._lock:
+            self._readers[path] = (ident, reader)
+            self._readers.move_to_end(path)
+            while len(self._readers) > self.max_entries:
+                self._readers.popitem(last=False)
+        return reader
+
+
+def get_reader_cache():
+    return current_app.extensions['mbtiles']
+
+
+def init_app(app):
+    app.extensions['mbtiles'] = ReaderCache(max_entries=MAX_OPEN_ARCHIVES)
@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# In-memory cache for the metadata documents of collections
+#
+# The /collections index and the description of each collection only
+# change when a brand gets scraped, but they are requested far more often
+# and building them takes a database scan plus several url_for calls
+# per brand. Therefore, we keep the serialized documents in memory.
+#
+# To find out whether a cached document is still current, every request
+# reads a version counter from the database. Triggers on the brand table
+# increment the counter, so the cache also notices changes that were
+# written by other processes, such as a worker storing a scrape.
+# We cannot use SQLite's PRAGMA data_version for this, because it is
+# specific to a database connection, and it does not change for commits
+# made by the connection itself; our cache is shared by all threads,
+# each with its own connection.
+
+from collections import OrderedDict
+import threading
+import time
+
+from flask import current_app
+
+
+class MetadataCache(object):
+    """LRU cache whose entries are valid for one version of some tables.
+
+    Also used by auth.py for verified credentials, with a time-to-live
+    in seconds so that entries expire even if the version stays the same."""
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = OrderedDict()  # key --> (value, expiry time or None)
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, version, key, build):
+        """Cached value for key at a version of the underlying tables.
+
+        If there is no such value, it gets computed by calling build(),
+        which may raise an exception to indicate that nothing should be
+        cached. Values may be None."""
+        now = time.monotonic()
+        with self._lock:
+            if self._version == None or version > self._version:
+                self._entries.clear()
+                self._version = version
+            if version == self._version:
+                entry = self._entries.get(key)
+                if entry != None and (entry[1] == None or entry[1] > now):
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[0]
+            self._misses += 1
+        value = build()
+        expiry = now + self.ttl if self.ttl != None else None
+        with self._lock:
+            # If the version has moved on while we were building,
+            # our value is outdated and must not be cached.
+            if version == self._version:
+                self._entries[key] = (value, expiry)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'version': self._version,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+
+def get_brand_version(db):
+    return db.execute('SELECT version FROM brand_version').fetchone()[0]
+
+
+def get_metadata_cache():
+    return current_app.extensions['metacache']
+
+
+def init_app(app):
+    app.extensions['metacache'] = MetadataCache(
+        max_entries=app.config['METADATA_CACHE_ENTRIES'])
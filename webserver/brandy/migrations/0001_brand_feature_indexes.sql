@@ -0,0 +1,13 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Indexes for finding the features of a brand. Without them, listing
+ * the items of a brand and storing scrapes had to scan the features of
+ * all brands. Neither index covers the columns needed for rendering;
+ * queries with a bounding box go through brand_feature_rtree instead,
+ * see build_find_features_query in db.py.
+ */
+
+CREATE INDEX IF NOT EXISTS brand_feature_brand_id ON brand_feature (brand_id);
+CREATE INDEX IF NOT EXISTS brand_feature_feature_id
+  ON brand_feature (brand_id, feature_id);
@@ -0,0 +1,8 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Content hash of brands, for entity tags that only change when
+ * the features of a brand have changed.
+ */
+
+ALTER TABLE brand ADD COLUMN content_hash TEXT;
@@ -0,0 +1,24 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Tile index, see tiles.update_tile_index(). Brands stored before
+ * this migration get indexed when they are scraped the next time;
+ * until then, their tiles get rendered from the features.
+ */
+
+CREATE TABLE brand_tile (
+  brand_id INT8 NOT NULL,
+  zoom INTEGER NOT NULL,
+  x INTEGER NOT NULL,
+  y INTEGER NOT NULL,
+  PRIMARY KEY (brand_id, zoom, x, y)
+) WITHOUT ROWID;
+
+CREATE TABLE brand_feature_cell (
+  brand_id INT8 NOT NULL,
+  zoom INTEGER NOT NULL,
+  x INTEGER NOT NULL,
+  y INTEGER NOT NULL,
+  weight INTEGER NOT NULL,
+  PRIMARY KEY (brand_id, zoom, x, y)
+) WITHOUT ROWID;
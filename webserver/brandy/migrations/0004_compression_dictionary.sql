@@ -0,0 +1,15 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Dictionaries for compressing feature properties, see codec.py.
+ * Existing properties stay compressed with zlib until the next scrape.
+ */
+
+CREATE TABLE compression_dictionary (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  brand_id INT8 NOT NULL,
+  data BLOB NOT NULL
+);
+
+CREATE INDEX compression_dictionary_brand_id
+  ON compression_dictionary (brand_id);
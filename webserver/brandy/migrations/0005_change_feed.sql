@@ -0,0 +1,17 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Support for fetching the changes of a brand with items?since=.
+ */
+
+CREATE INDEX brand_feature_last_modified
+  ON brand_feature (brand_id, last_modified);
+
+CREATE TABLE brand_feature_tombstone (
+  brand_id INT8 NOT NULL,
+  feature_id TEXT NOT NULL,
+  deleted TIMESTAMP NOT NULL
+);
+
+CREATE INDEX brand_feature_tombstone_deleted
+  ON brand_feature_tombstone (brand_id, deleted);
@@ -0,0 +1,26 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * Version counter for the brand table, see metacache.py.
+ */
+
+CREATE TABLE brand_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO brand_version (version) VALUES (0);
+
+CREATE TRIGGER brand_insert_version AFTER INSERT ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
+
+CREATE TRIGGER brand_update_version AFTER UPDATE ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
+
+CREATE TRIGGER brand_delete_version AFTER DELETE ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
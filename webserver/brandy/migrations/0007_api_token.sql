@@ -0,0 +1,52 @@
+/* SPDX-License-Identifier: MIT
+ * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+ *
+ * API tokens, and a version counter for credentials; see auth.py.
+ */
+
+CREATE TABLE api_token (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  token_hash BLOB NOT NULL,
+  created TIMESTAMP NOT NULL,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE UNIQUE INDEX api_token_token_hash ON api_token (token_hash);
+
+CREATE TABLE auth_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO auth_version (version) VALUES (0);
+
+CREATE TRIGGER user_insert_version AFTER INSERT ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER user_update_version AFTER UPDATE ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER user_delete_version AFTER DELETE ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_insert_version AFTER INSERT ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_update_version AFTER UPDATE ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_delete_version AFTER DELETE ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Encoder for Mapbox Vector Tiles
+#
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+#
+# We only need to encode point features, which is simple enough
+# to do by hand instead of depending on a protocol buffer library.
+
+import json
+import struct
+
+
+class Layer(object):
+    def __init__(self, name, extent=4096):
+        self.name = name
+        self.extent = extent
+        self._features = []
+        self._keys, self._values = {}, {}
+
+    def add_point(self, x, y, properties):
+        """Add a point in tile coordinates, 0 <= x, y < extent."""
+        tags = []
+        for key, value in properties.items():
+            tags.append(self._keys.setdefault(key, len(self._keys)))
+            value = _encode_value(value)
+            tags.append(self._values.setdefault(value, len(self._values)))
+        geometry = [_command(1, 1), _zigzag(x), _zigzag(y)]  # MoveTo
+        self._features.append(b''.join([
+            _packed(2, tags),
+            _varint_field(3, 1),  # GeomType.POINT
+            _packed(4, geometry)
+        ]))
+
+    def encode(self):
+        parts = [_varint_field(15, 2), _bytes_field(1, self.name.encode())]
+        parts.extend(_bytes_field(2, f) for f in self._features)
+        parts.extend(_bytes_field(3, k.encode()) for k in self._keys)
+        parts.extend(_bytes_field(4, v) for v in self._values)
+        parts.append(_varint_field(5, self.extent))
+        return b''.join(parts)
+
+
+def encode_tile(layers):
+    return b''.join(_bytes_field(3, layer.encode()) for layer in layers)
+
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _tag(3, 1) + struct.pack('<d', value)
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    return _bytes_field(1, value.encode('utf-8'))
+
+
+def _command(cmd, count):
+    return (cmd & 0x7) | (count << 3)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _varint(n):
+    n &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _tag(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _varint_field(field, n):
+    return _tag(field, 0) + _varint(n)
+
+
+def _bytes_field(field, data):
+    return _tag(field, 2) + _varint(len(data)) + data
+
+
+def _packed(field, values):
+    return _bytes_field(field, b''.join(_varint(v) for v in values))
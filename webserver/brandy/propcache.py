@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# In-memory cache for decoded feature properties
+#
+# Serving a feature needs its properties, which are stored compressed
+# in the database. Popular features, such as the stores that people
+# click on in the map, get requested over and over, so we keep their
+# decoded properties in memory. Entries are keyed by internal id and
+# the content hash of the feature; when a scrape changes a feature,
+# its hash changes too, so an outdated entry never gets served.
+# Still, store_scraped removes the entries of changed features
+# to free up their memory.
+#
+# The cache is shared by all request threads of the server process.
+# Its size is bounded in bytes; when the limit is reached, the least
+# recently used entries get evicted.
+
+from collections import OrderedDict
+import json
+import sys
+import threading
+
+from flask import current_app
+
+import brandy.codec
+
+# Rough memory use of a parsed properties dict, relative to the length
+# of its JSON text. Measured on typical brand features.
+DICT_SIZE_FACTOR = 6
+
+
+class PropertiesCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key --> [json, dict or None, size]
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get_json(self, internal_id, hash_hi, hash_lo, blob):
+        """Properties of a feature, as serialized JSON text."""
+        return self._get((internal_id, hash_hi, hash_lo), blob)[0]
+
+    def get(self, internal_id, hash_hi, hash_lo, blob):
+        """Properties of a feature, as dict.
+
+        The returned dict is shared with other requests; callers must
+        not modify it."""
+        key = (internal_id, hash_hi, hash_lo)
+        entry = self._get(key, blob)
+        if entry[1] == None:
+            # Parsing is done outside the lock. If two threads happen
+            # to parse the same entry, one of the results gets dropped.
+            props = json.loads(entry[0])
+            with self._lock:
+                if entry[1] == None:
+                    entry[1] = props
+                    extra = DICT_SIZE_FACTOR * len(entry[0])
+                    entry[2] += extra
+                    if self._entries.get(key) is entry:
+                        self._size += extra
+                        self._evict()
+        return entry[1]
+
+    def invalidate(self, keys):
+        """Remove entries, given as (internal_id, hash_hi, hash_lo)."""
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry != None:
+                    self._size -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def _get(self, key, blob):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            self._misses += 1
+        text = brandy.codec.decompress(blob).decode('utf-8')
+        entry = [text, None, sys.getsizeof(text)]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old != None:
+                self._size -= old[2]
+            self._entries[key] = entry
+            self._size += entry[2]
+            self._evict()
+        return entry
+
+    def _evict(self):
+        # Called with self._lock being held.
+        while self._size > self.max_bytes and self._entries:
+            _key, entry = self._entries.popitem(last=False)
+            self._size -= entry[2]
+
+
+def get_properties_cache():
+    return current_app.extensions['propcache']
+
+
+def init_app(app):
+    app.extensions['propcache'] = PropertiesCache(
+        max_bytes=app.config['PROPERTIES_CACHE_SIZE'])
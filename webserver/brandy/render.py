@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Pool of long-lived rendertile processes
+#
+# Starting a new rendertile process for every tile means paying for
+# fork/exec and program startup dozens of times per second while users
+# pan the map. Instead, we keep a pool of rendertile processes running
+# in --framed mode, where each process renders one tile after another.
+# The pool is shared by all threads of the webserver; a thread that
+# wants to render a tile borrows a process, sends its commands, reads
+# back the length-prefixed PNG, and returns the process to the pool.
+# Processes that crash or hang get killed and are restarted on demand.
+
+import json
+import os
+import queue
+import select
+import struct
+import subprocess
+import time
+
+from flask import current_app
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderPool(object):
+    def __init__(self, command, size, timeout=5.0):
+        self.command = command
+        self.size = size
+        self.timeout = timeout
+        # Slots hold either a running process or None, in which case
+        # a new process gets started when the slot is used next time.
+        # LIFO order keeps recently used processes warm.
+        self._slots = queue.LifoQueue()
+        for _ in range(size):
+            self._slots.put(None)
+
+    def render(self, tile, layer, points):
+        """Render a PNG tile with one layer of points (lng, lat).
+
+        Points may carry a weight as third element, (lng, lat, weight),
+        for markers that stand for several aggregated features.
+
+        Points get streamed to the rendering process, so `points` can
+        be a database cursor. If the process fails, it is killed and
+        a new process gets started for rendering the next tile.
+        """
+        proc = self._slots.get()
+        try:
+            if proc == None or proc.poll() != None:
+                proc = self._start()
+            return self._render(proc, tile, layer, points)
+        except (OSError, ValueError, RenderError) as e:
+            if proc != None:
+                _kill(proc)
+            proc = None
+            raise RenderError(str(e)) from e
+        finally:
+            self._slots.put(proc)
+
+    def close(self):
+        for _ in range(self.size):
+            proc = self._slots.get()
+            if proc != None:
+                _kill(proc)
+            self._slots.put(None)
+
+    def _start(self):
+        return subprocess.Popen(
+            [self.command, '--framed'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _render(self, proc, tile, layer, points):
+        write = proc.stdin.write
+        write(('T %s\n' % json.dumps(tile)).encode('utf-8'))
+        write(('L %s\n' % json.dumps(layer)).encode('utf-8'))
+        # Coordinates are sent in full precision; at high zoom levels,
+        # even the seventh decimal digit moves a marker by a pixel.
+        # The float() calls turn numpy scalars into plain Python floats,
+        # whose repr() is the shortest string that round-trips exactly.
+        for p in points:
+            if len(p) == 2:
+                write(b'P [%r,%r]\n' % (float(p[0]), float(p[1])))
+            else:
+                write(b'P [%r,%r,%d]\n' % (float(p[0]), float(p[1]), p[2]))
+        write(b'E\n')
+        proc.stdin.flush()
+        deadline = time.monotonic() + self.timeout
+        size = struct.unpack('>I', _read(proc.stdout, 4, deadline))[0]
+        return _read(proc.stdout, size, deadline)
+
+
+def _read(f, size, deadline):
+    fd = f.fileno()
+    chunks, remaining = [], size
+    while remaining > 0:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+            raise RenderError('timeout')
+        chunk = os.read(fd, remaining)
+        if not chunk:
+            raise RenderError('unexpected end of rendertile output')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+        proc.wait(timeout=1)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+def get_render_pool():
+    return current_app.extensions['rendertile']
+
+
+def init_app(app):
+    # Processes get started lazily, when a tile gets rendered for the
+    # first time. Therefore, creating the pool is cheap.
+    app.extensions['rendertile'] = RenderPool(
+        command=app.config['RENDERTILE'],
+        size=app.config['RENDERTILE_WORKERS'])
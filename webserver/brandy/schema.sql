@@ -2,13 +2,25 @@
  * SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
  *
  * Database schema for Brandy webserver
+ *
+ * This creates a new database with the latest schema. Existing databases
+ * get upgraded by the scripts in the migrations directory, so every change
+ * here needs a migration too.
  */
 
 DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS api_token;
+DROP TABLE IF EXISTS auth_version;
 DROP TABLE IF EXISTS scrape;
 DROP TABLE IF EXISTS scraper;
 DROP TABLE IF EXISTS brand;
+DROP TABLE IF EXISTS brand_version;
 DROP TABLE IF EXISTS brand_feature;
+DROP TABLE IF EXISTS brand_feature_tombstone;
+DROP TABLE IF EXISTS brand_feature_rtree;
+DROP TABLE IF EXISTS brand_tile;
+DROP TABLE IF EXISTS brand_feature_cell;
+DROP TABLE IF EXISTS compression_dictionary;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -17,6 +29,55 @@ CREATE TABLE user (
   is_admin TINYINT NOT NULL DEFAULT 0
 );
 
+/* Tokens for authenticating API clients, such as scrapers. We only
+ * store a hash of each token. See auth.py. */
+CREATE TABLE api_token (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  token_hash BLOB NOT NULL,
+  created TIMESTAMP NOT NULL,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE UNIQUE INDEX api_token_token_hash ON api_token (token_hash);
+
+CREATE TABLE auth_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO auth_version (version) VALUES (0);
+
+CREATE TRIGGER user_insert_version AFTER INSERT ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER user_update_version AFTER UPDATE ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER user_delete_version AFTER DELETE ON user
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_insert_version AFTER INSERT ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_update_version AFTER UPDATE ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
+CREATE TRIGGER api_token_delete_version AFTER DELETE ON api_token
+BEGIN
+  UPDATE auth_version SET version = version + 1;
+END;
+
 CREATE TABLE scraper (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   name TEXT UNIQUE NOT NULL
@@ -35,12 +96,37 @@ CREATE TABLE brand (
   wikidata_id INT8 PRIMARY KEY NOT NULL,
   last_checked TIMESTAMP NOT NULL,
   last_modified TIMESTAMP,
+  content_hash TEXT,
   min_lng REAL NOT NULL,
   min_lat REAL NOT NULL,
   max_lng REAL NOT NULL,
   max_lat REAL NOT NULL
 );
 
+/* Incremented by triggers whenever the brand table changes, so that
+ * all server processes can tell when their metadata cache is outdated.
+ * See metacache.py. */
+CREATE TABLE brand_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO brand_version (version) VALUES (0);
+
+CREATE TRIGGER brand_insert_version AFTER INSERT ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
+
+CREATE TRIGGER brand_update_version AFTER UPDATE ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
+
+CREATE TRIGGER brand_delete_version AFTER DELETE ON brand
+BEGIN
+  UPDATE brand_version SET version = version + 1;
+END;
+
 CREATE TABLE brand_feature (
   internal_id INTEGER PRIMARY KEY AUTOINCREMENT,
   brand_id INT8 NOT NULL,
@@ -53,9 +139,57 @@ CREATE TABLE brand_feature (
   props BLOB NOT NULL
 );
 
+CREATE INDEX brand_feature_brand_id ON brand_feature (brand_id);
+CREATE INDEX brand_feature_feature_id ON brand_feature (brand_id, feature_id);
+CREATE INDEX brand_feature_last_modified
+  ON brand_feature (brand_id, last_modified);
+
+/* Features that got removed from a brand, so that clients can fetch
+ * the changes since their last visit with items?since=<timestamp>. */
+CREATE TABLE brand_feature_tombstone (
+  brand_id INT8 NOT NULL,
+  feature_id TEXT NOT NULL,
+  deleted TIMESTAMP NOT NULL
+);
+
+CREATE INDEX brand_feature_tombstone_deleted
+  ON brand_feature_tombstone (brand_id, deleted);
+
 CREATE VIRTUAL TABLE brand_feature_rtree USING rtree(
    internal_id,
    min_lng, max_lng,
    min_lat, max_lat,
    +brand_id INT8
 );
+
+/* Tiles that are touched by the markers of a brand, up to some zoom level.
+ * Used for quickly serving empty tiles without rendering them. */
+CREATE TABLE brand_tile (
+  brand_id INT8 NOT NULL,
+  zoom INTEGER NOT NULL,
+  x INTEGER NOT NULL,
+  y INTEGER NOT NULL,
+  PRIMARY KEY (brand_id, zoom, x, y)
+) WITHOUT ROWID;
+
+/* Number of features per pixel, for rendering tiles at low zoom levels.
+ * The x and y columns are pixel coordinates at the given zoom level. */
+CREATE TABLE brand_feature_cell (
+  brand_id INT8 NOT NULL,
+  zoom INTEGER NOT NULL,
+  x INTEGER NOT NULL,
+  y INTEGER NOT NULL,
+  weight INTEGER NOT NULL,
+  PRIMARY KEY (brand_id, zoom, x, y)
+) WITHOUT ROWID;
+
+/* Dictionaries for compressing the properties of brand features.
+ * See codec.py for the format of compressed properties. */
+CREATE TABLE compression_dictionary (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  brand_id INT8 NOT NULL,
+  data BLOB NOT NULL
+);
+
+CREATE INDEX compression_dictionary_brand_id
+  ON compression_dictionary (brand_id);
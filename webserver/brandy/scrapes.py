@@ -12,7 +12,7 @@ bp = flask.Blueprint('scrapes', __name__, url_prefix='/scrapes')
 
 @bp.route('/')
 def index():
-    db = get_db()
+    db = get_db(readonly=True)
     scrapes = db.execute(
         'SELECT scrape.id AS id, scraped, scraper.name AS scraper_name '
 		' FROM scrape'
@@ -25,7 +25,7 @@ def index():
 
 @bp.route('/<int:id>/')
 def scrape(id):
-    db = get_db()
+    db = get_db(readonly=True)
     scrape = db.execute(
         'SELECT scrape.id AS id, scraped, scraper.name AS scraper_name, num_features, error_log'
 		' FROM scrape '
@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Flask blueprint for handling /search
+#
+# Finds the features of all brands, or of selected brands, inside
+# a bounding box. The spatial index of features is shared by all brands,
+# so this takes a single scan, instead of one request per brand.
+#
+# Example: /search?bbox=8.5,47.3,8.6,47.4&brands=Q72,Q1568346&limit=100
+#
+# The response is a JSON object with one GeoJSON FeatureCollection per
+# brand that has features in the area. For paginated responses, we use
+# keyset pagination on (brand_id, internal_id).
+
+import json
+import re
+
+import flask
+from werkzeug.exceptions import BadRequest
+
+from brandy.collections import MAX_ITEMS_LIMIT, ITEMS_CHUNK_SIZE, \
+    format_feature_json, parse_bbox
+from brandy.db import get_db
+from brandy.propcache import get_properties_cache
+
+bp = flask.Blueprint('search', __name__, url_prefix='/search')
+
+# Number of features per page, unless clients ask for a different limit.
+DEFAULT_SEARCH_LIMIT = 1000
+
+# Maximal number of brands that clients can select in one search.
+MAX_SEARCH_BRANDS = 1000
+
+_brand = re.compile(r'Q([0-9]+)(-brand)?')
+_cursor = re.compile(r'([0-9]+)-([0-9]+)')
+
+
+@bp.route('')
+def search():
+    args = flask.request.args
+    bbox = parse_bbox(args.get('bbox'))
+    if bbox == None:
+        raise BadRequest('missing bbox')
+    brands = None
+    if args.get('brands'):
+        brands = []
+        for b in args['brands'].split(','):
+            m = _brand.fullmatch(b)
+            if m == None:
+                raise BadRequest('malformed brands')
+            brands.append(int(m.group(1)))
+        if len(brands) > MAX_SEARCH_BRANDS:
+            raise BadRequest('too many brands; at most %d are allowed' %
+                             MAX_SEARCH_BRANDS)
+        brands = sorted(set(brands))
+    limit = args.get('limit', str(DEFAULT_SEARCH_LIMIT))
+    if not limit.isdigit() or not (1 <= int(limit) <= MAX_ITEMS_LIMIT):
+        raise BadRequest('limit must be between 1 and %d' % MAX_ITEMS_LIMIT)
+    limit = int(limit)
+    cursor = (0, 0)
+    if args.get('cursor') != None:
+        m = _cursor.fullmatch(args['cursor'])
+        if m == None:
+            raise BadRequest('malformed cursor')
+        cursor = (int(m.group(1)), int(m.group(2)))
+    return flask.Response(
+        generate_search_json(bbox, brands, limit, cursor),
+        content_type='application/json')
+
+
+def build_search_query(bbox, brands, limit, cursor):
+    # Like in build_find_features_query, all values are passed
+    # as query parameters, except for the number of brands.
+    conditions = [
+        'r.min_lng>=?', 'r.max_lng<=?', 'r.min_lat>=?', 'r.max_lat<=?',
+        'f.internal_id=r.internal_id',
+        '(f.brand_id, f.internal_id)>(?, ?)',
+    ]
+    params = [float(bbox[0]), float(bbox[2]), float(bbox[1]), float(bbox[3]),
+              cursor[0], cursor[1]]
+    if brands != None:
+        conditions.append('r.brand_id IN (%s)' % ','.join('?' * len(brands)))
+        params.extend(brands)
+    params.append(limit)
+    query = (
+        'SELECT f.internal_id, f.brand_id, f.feature_id, f.lng, f.lat,'
+        '    f.hash_hi, f.hash_lo, f.props'
+        ' FROM brand_feature_rtree AS r CROSS JOIN brand_feature AS f'
+        ' WHERE %s ORDER BY f.brand_id, f.internal_id LIMIT ?'
+        % ' AND '.join(conditions))
+    return (query, tuple(params))
+
+
+@flask.stream_with_context
+def generate_search_json(bbox, brands, limit, cursor):
+    # We fetch one extra feature to find out if there is a next page.
+    query, params = build_search_query(bbox, brands, limit + 1, cursor)
+    rows = get_db(readonly=True).cursor()
+    rows.row_factory = None
+    get_props_json = get_properties_cache().get_json
+    chunk, chunk_size = ['{"collections":['], 0
+    num_returned, last, has_more = 0, None, False
+    for internal_id, brand_id, feature_id, lng, lat, hash_hi, hash_lo, props \
+            in rows.execute(query, params):
+        if num_returned == limit:
+            has_more = True
+            break
+        if last == None or last[0] != brand_id:
+            if last != None:
+                chunk.append(']},')
+            chunk.append('\n{"type":"FeatureCollection","id":"Q%d-brand",'
+                         '"features":[' % brand_id)
+        else:
+            chunk.append(',')
+        feature = format_feature_json(
+            feature_id, lng, lat,
+            get_props_json(internal_id, hash_hi, hash_lo, props))
+        chunk.append('\n')
+        chunk.append(feature)
+        chunk_size += len(feature)
+        num_returned += 1
+        last = (brand_id, internal_id)
+        if chunk_size >= ITEMS_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, chunk_size = [], 0
+    if last != None:
+        chunk.append(']}')
+    links = []
+    if has_more:
+        args = {
+            'bbox': ','.join(repr(c) for c in bbox),
+            'limit': limit,
+            'cursor': '%d-%d' % last,
+        }
+        if brands != None:
+            args['brands'] = ','.join('Q%d' % b for b in brands)
+        links.append({
+            'rel': 'next',
+            'type': 'application/json',
+            'href': flask.url_for('search.search', _external=True, **args)
+        })
+    chunk.append('],"numberReturned":%d,"links":%s}\n' % (
+        num_returned, json.dumps(links)))
+    yield ''.join(chunk)
@@ -2,8 +2,6 @@
 // SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 //
 // Interactive map with store locations
-//
-// TODO: Use webpack or similar to minimize download size.
 
 export function initMap(data) {
     const tilesUrl = `/tiles/${data.brand_id}-brand`
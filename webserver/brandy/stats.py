@@ -0,0 +1,26 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Flask blueprint for handling /stats
+#
+# Internal counters of this server process, for inspecting how well
+# connection re-use and caching work in production. Only visible to
+# administrators.
+
+import flask
+
+from brandy.auth import auth
+
+bp = flask.Blueprint('stats', __name__, url_prefix='/stats')
+
+
+@bp.route('')
+@auth.login_required(role='admin')
+def index():
+    app = flask.current_app
+    return {
+        'auth_cache': app.extensions['auth'].stats(),
+        'database': app.extensions['db'].stats(),
+        'metadata_cache': app.extensions['metacache'].stats(),
+        'properties_cache': app.extensions['propcache'].stats(),
+    }
@@ -0,0 +1,154 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Cache for rendered map tiles
+#
+# Rendered tiles are stored as files on the instance volume, in a path
+# like Q72/20221023T081503123456-r2/9/268/179.png. The second component
+# is the version of the brand data, derived from brand.last_modified and
+# the renderer version, so a tile rendered from outdated data never gets
+# served. When a new scrape gets stored, all tiles of that brand get
+# removed from the cache. To not block other threads while deleting
+# many files, the brand's directory first gets moved into .trash; it
+# gets deleted later, after the new scrape has been committed.
+#
+# The total size of the cache is bounded; when the limit is reached,
+# the least recently used tiles get evicted. To preserve that order
+# across server restarts, we touch the modification time of tile files
+# when serving them.
+
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import threading
+
+from flask import current_app
+
+# Directory inside the cache for tiles that are about to be deleted.
+TRASH = '.trash'
+
+
+class TileCache(object):
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # relative path --> size in bytes; LRU order
+        self._size = 0
+        self._trash = []  # directories to be deleted by remove_trash()
+
+    def get(self, brand_id, version, zoom, x, y):
+        key = _key(brand_id, version, zoom, x, y)
+        with self._lock:
+            entries = self._load_entries()
+            if key not in entries:
+                return None
+            entries.move_to_end(key)
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, brand_id, version, zoom, x, y, data):
+        key = _key(brand_id, version, zoom, x, y)
+        path = os.path.join(self.path, key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except FileNotFoundError:
+            # The directory was moved away by a concurrent invalidate(),
+            # so the tile got rendered from outdated data. Any temporary
+            # file has been moved along, and goes away with the trash.
+            return
+        with self._lock:
+            entries = self._load_entries()
+            self._size += len(data) - entries.pop(key, 0)
+            entries[key] = len(data)
+            while self._size > self.max_bytes and entries:
+                old_key, old_size = entries.popitem(last=False)
+                self._size -= old_size
+                _remove(os.path.join(self.path, old_key))
+
+    def invalidate(self, brand_id):
+        """Remove all cached tiles for a brand.
+
+        The files only get moved out of the way; remove_trash() deletes
+        them, without blocking concurrent calls to get() and put()."""
+        prefix = 'Q%d%s' % (brand_id, os.sep)
+        with self._lock:
+            entries = self._load_entries()
+            for key in [k for k in entries if k.startswith(prefix)]:
+                self._size -= entries.pop(key)
+            trash_dir = os.path.join(self.path, TRASH)
+            os.makedirs(trash_dir, exist_ok=True)
+            trash = tempfile.mkdtemp(dir=trash_dir, prefix='Q%d-' % brand_id)
+            self._trash.append(trash)
+            try:
+                os.rename(os.path.join(self.path, 'Q%d' % brand_id),
+                          os.path.join(trash, 'Q%d' % brand_id))
+            except FileNotFoundError:
+                pass
+
+    def remove_trash(self):
+        """Delete the files of invalidated tiles."""
+        with self._lock:
+            trash, self._trash = self._trash, []
+        for path in trash:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _load_entries(self):
+        # Called with self._lock being held. When called for the first
+        # time, we scan the cache directory for files that were written
+        # before the server got (re-)started.
+        if self._entries != None:
+            return self._entries
+        # Trash left over by a previous server process.
+        shutil.rmtree(os.path.join(self.path, TRASH), ignore_errors=True)
+        found = []
+        for dirpath, _dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith('.tmp'):
+                    _remove(path)
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, self.path)
+                found.append((st.st_mtime, key, st.st_size))
+        found.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in found)
+        self._size = sum(self._entries.values())
+        return self._entries
+
+
+def _key(brand_id, version, zoom, x, y):
+    return os.path.join(
+        'Q%d' % brand_id, version, str(zoom), str(x), '%d.png' % y)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_tile_cache():
+    return current_app.extensions['tilecache']
+
+
+def init_app(app):
+    app.extensions['tilecache'] = TileCache(
+        path=app.config['TILE_CACHE'],
+        max_bytes=app.config['TILE_CACHE_SIZE'])
@@ -3,18 +3,111 @@
 #
 # Flask blueprint for handling /tiles/*
 
-import flask
-import json
-import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import math
+import os
+import struct
 import zlib
 
+import click
+import flask
+from flask.cli import with_appcontext
+from werkzeug.exceptions import BadRequest, NotFound
+
+from brandy import mbtiles, mvt
 from brandy.db import get_db, build_find_features_query
-from brandy.geometry import tile_to_wgs84
+from brandy.geometry import (
+    halve_pixels, marker_tiles, pixel_cells, tile_to_wgs84, tiles_to_wgs84,
+    wgs84_to_pixel, wgs84_to_pixels)
+from brandy.propcache import get_properties_cache
+from brandy.render import RenderPool, get_render_pool
+from brandy.tilecache import get_tile_cache
 
 bp = flask.Blueprint('tiles', __name__, url_prefix='/tiles')
 
+# Highest zoom level for which we keep track of occupied tiles.
+# For higher zoom levels, we look at the enclosing tile at this zoom.
+TILE_INDEX_MAX_ZOOM = 14
+
+# Highest zoom level for which we aggregate features into pixel cells.
+# Below this level, markers overlap so much that drawing every feature
+# would look no different from drawing one marker per pixel.
+CLUSTER_MAX_ZOOM = 8
+
+# Number of features that get read at once when building the tile index.
+TILE_INDEX_BATCH_SIZE = 50000
+
+# Largest marker radius in pixels, plus one pixel for anti-aliasing.
+MAX_MARKER_RADIUS = 9
+
+# Incremented when rendering changes in ways that make previously
+# rendered tiles wrong, so the tile cache and MBTiles archives do not
+# serve them anymore. Version 2: full-precision marker coordinates.
+RENDER_VERSION = 2
+
+# How long clients may cache empty tiles, in seconds.
+EMPTY_TILE_MAX_AGE = 24 * 3600
+
+# Map clicks find features up to this many pixels away. The search
+# starts with a small window, which doubles until enough are found.
+CLICK_MAX_DISTANCE = 16
+CLICK_MIN_WINDOW = 2
+
+# Maximal number of features that clients can ask for in a click.
+CLICK_MAX_K = 10
+
+# Maximal number of features that get ranked for a click. At low zoom
+# levels, a window of a few pixels can cover thousands of features.
+CLICK_MAX_CANDIDATES = 64
+
+
+def _make_empty_png():
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data)
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', crc)
+    header = struct.pack('>IIBBBBB', 256, 256, 8, 6, 0, 0, 0)  # 8-bit RGBA
+    pixels = zlib.compress((b'\0' + b'\0' * 256 * 4) * 256, level=9)
+    return b''.join([b'\x89PNG\r\n\x1a\n', chunk(b'IHDR', header),
+                     chunk(b'IDAT', pixels), chunk(b'IEND', b'')])
+
+
+EMPTY_PNG = _make_empty_png()
+
+
 @bp.route('/Q<int:brand_id>-brand/<int:zoom>/<int:x>/<int:y>.png')
 def tile(brand_id, zoom, x, y):
+    db = get_db(readonly=True)
+    brand = db.execute(
+        'SELECT last_modified FROM brand WHERE wikidata_id = ?',
+        (brand_id,)).fetchone()
+    if brand == None:
+        raise NotFound()
+    version = _brand_version(brand)
+
+    # Tiles that have been pre-rendered by `flask render-tiles`.
+    archive = mbtiles.get_reader_cache().get(_mbtiles_path(brand_id))
+    if archive != None:
+        meta = archive.metadata
+        if meta.get('version') == version and \
+            int(meta['minzoom']) <= zoom <= int(meta['maxzoom']):
+            png = archive.get(zoom, x, y)
+            return _png_response(png) if png != None else _empty_tile()
+
+    if not is_tile_occupied(db, brand_id, zoom, x, y):
+        return _empty_tile()
+    cache = get_tile_cache()
+    png = cache.get(brand_id, version, zoom, x, y)
+    if png != None:
+        return _png_response(png)
+    png = render_tile(db, brand_id, zoom, x, y)
+    cache.put(brand_id, version, zoom, x, y, png)
+    return _png_response(png)
+
+
+def render_tile(db, brand_id, zoom, x, y):
     tile = {'zoom': zoom, 'x': x, 'y': y}
     if zoom <= 3:
         marker_width = 5.0
@@ -28,44 +121,422 @@ def tile(brand_id, zoom, x, y):
         'marker-fill': '#4287F5',
         'marker-width': marker_width
     }
-    db = get_db()
-    with subprocess.Popen(
-        'rendertile', stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
-        proc.stdin.write(('T %s\n' % json.dumps(tile)).encode('utf-8'))
-        proc.stdin.write(('L %s\n' % json.dumps(layer)).encode('utf-8'))
-        for f in db.execute(
-            'SELECT feature_id, lng, lat'
-            ' FROM brand_feature WHERE brand_id = ?',
-            (brand_id,)
-        ).fetchall():
-           proc.stdin.write(b'P [%g,%g]\n' % (f['lng'], f['lat']))
-        png, _err = proc.communicate(timeout=5)
+    # Markers of features just outside the tile can reach into it,
+    # so we pad the tile bounds by the marker radius (plus one pixel
+    # for anti-aliasing) when looking for features to render.
+    pad = int(marker_width / 2) + 1
+    points = None
+    if zoom <= CLUSTER_MAX_ZOOM:
+        points = _find_cells(db, brand_id, zoom, x, y, pad)
+    if points == None:
+        query, params = build_find_features_query(
+            brand_id, bbox=_tile_bbox(zoom, x, y, pad),
+            columns=['f.lng', 'f.lat'])
+        points = db.execute(query, params)
+    return get_render_pool().render(tile, layer, points)
+
+
+@bp.route('/Q<int:brand_id>-brand/<int:zoom>/<int:x>/<int:y>.mvt')
+def vector_tile(brand_id, zoom, x, y):
+    # Features carry their id; clients can ask for more properties
+    # with a query parameter such as ?properties=name,opening_hours.
+    db = get_db(readonly=True)
+    brand = db.execute(
+        'SELECT last_modified FROM brand WHERE wikidata_id = ?',
+        (brand_id,)).fetchone()
+    if brand == None:
+        raise NotFound()
+    extent = flask.current_app.config['MVT_EXTENT']
+    buffer = flask.current_app.config['MVT_BUFFER']
+    prop_keys = [k for k in flask.request.args.get('properties', '').split(',')
+                 if k]
+    layer = mvt.Layer('Q%d-brand' % brand_id, extent=extent)
+    if is_tile_occupied(db, brand_id, zoom, x, y):
+        columns = ['f.feature_id', 'f.lng', 'f.lat']
+        if prop_keys:
+            columns.extend(['f.internal_id', 'f.hash_hi', 'f.hash_lo',
+                            'f.props'])
+            props_cache = get_properties_cache()
+        pad = buffer * 256.0 / extent
+        query, params = build_find_features_query(
+            brand_id, bbox=_tile_bbox(zoom, x, y, pad), columns=columns)
+        scale = extent / 256.0
+        for f in db.execute(query, params):
+            px, py = wgs84_to_pixel(f['lng'], f['lat'], zoom)
+            props = {'id': f['feature_id']}
+            if prop_keys:
+                all_props = props_cache.get(
+                    f['internal_id'], f['hash_hi'], f['hash_lo'], f['props'])
+                for key in prop_keys:
+                    if key in all_props:
+                        props[key] = all_props[key]
+            layer.add_point(round((px - x * 256) * scale),
+                            round((py - y * 256) * scale), props)
+    return flask.Response(response=mvt.encode_tile([layer]), headers={
+        'Content-Type': 'application/vnd.mapbox-vector-tile'
+    })
+
+
+def _tile_bbox(zoom, x, y, pad):
+    """Bounding box of a tile, padded by some pixels on each side."""
+    p1 = tile_to_wgs84(zoom + 8, x * 256 - pad, y * 256 - pad)
+    p2 = tile_to_wgs84(zoom + 8, (x + 1) * 256 + pad, (y + 1) * 256 + pad)
+    return (p1[0], p2[1], p2[0], p1[1])
+
+
+def _brand_version(brand):
+    return '%s-r%d' % (brand['last_modified'].strftime('%Y%m%dT%H%M%S%f'),
+                       RENDER_VERSION)
+
+
+def _mbtiles_path(brand_id):
+    return os.path.join(flask.current_app.config['MBTILES'],
+                        'Q%d-brand.mbtiles' % brand_id)
+
+
+def _empty_tile():
+    return flask.Response(response=EMPTY_PNG, headers={
+        'Content-Type': 'image/png',
+        'Cache-Control': 'public, max-age=%d' % EMPTY_TILE_MAX_AGE
+    })
+
+
+def _png_response(png):
     return flask.Response(response=png, headers={
         'Content-Type': 'image/png'
     })
 
 
+def is_tile_occupied(db, brand_id, zoom, x, y):
+    """True if any markers of the brand might be visible on a tile."""
+    if zoom > TILE_INDEX_MAX_ZOOM:
+        shift = zoom - TILE_INDEX_MAX_ZOOM
+        zoom, x, y = TILE_INDEX_MAX_ZOOM, x >> shift, y >> shift
+    if zoom == 0:
+        return True
+    # Every indexed brand has its zoom 0 tile in the index. If it is
+    # missing, the brand has no features or has not been indexed yet;
+    # in the latter case, we must not claim the tile to be empty.
+    count = db.execute(
+        'SELECT COUNT(*) FROM brand_tile WHERE brand_id = ? AND'
+        ' ((zoom = ? AND x = ? AND y = ?) OR (zoom = 0 AND x = 0 AND y = 0))',
+        (brand_id, zoom, x, y)).fetchone()[0]
+    return count != 1
+
+
+def update_tile_index(db, brand_id):
+    """Re-compute the tile index for a brand.
+
+    The index consists of two parts. The set of occupied tiles tells
+    which tiles are touched by the marker of any feature, so markers
+    that cross tile boundaries are never clipped. For low zoom levels,
+    the features are also aggregated into cells of one pixel, so that
+    rendering does not need to look at every single feature."""
+    # The new index gets built in temporary tables, reading the features
+    # in chunks, so memory use does not depend on the size of the brand.
+    # Then, we only write the differences to the previous index, which
+    # are few when a brand gets re-scraped without many changes.
+    # Not db.executescript(), which would commit the ongoing transaction.
+    db.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS new_brand_tile ('
+        '    zoom INTEGER, x INTEGER, y INTEGER,'
+        '    PRIMARY KEY (zoom, x, y)) WITHOUT ROWID')
+    db.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS new_brand_feature_cell ('
+        '    zoom INTEGER, x INTEGER, y INTEGER, weight INTEGER,'
+        '    PRIMARY KEY (zoom, x, y)) WITHOUT ROWID')
+    db.execute('DELETE FROM temp.new_brand_tile')
+    db.execute('DELETE FROM temp.new_brand_feature_cell')
+    features = db.cursor()
+    features.row_factory = None
+    features.execute(
+        'SELECT lng, lat FROM brand_feature WHERE brand_id = ?', (brand_id,))
+    while True:
+        rows = features.fetchmany(TILE_INDEX_BATCH_SIZE)
+        if not rows:
+            break
+        _add_to_new_tile_index(db, [f[0] for f in rows], [f[1] for f in rows])
+    db.execute(
+        'DELETE FROM brand_tile WHERE brand_id = ? AND NOT EXISTS ('
+        '    SELECT 1 FROM temp.new_brand_tile AS n WHERE'
+        '    n.zoom = brand_tile.zoom AND n.x = brand_tile.x'
+        '    AND n.y = brand_tile.y)', (brand_id,))
+    db.execute(
+        'INSERT INTO brand_tile (brand_id, zoom, x, y)'
+        ' SELECT ?, n.zoom, n.x, n.y FROM temp.new_brand_tile AS n'
+        ' WHERE NOT EXISTS (SELECT 1 FROM brand_tile AS t WHERE'
+        '     t.brand_id = ? AND t.zoom = n.zoom AND t.x = n.x AND t.y = n.y)',
+        (brand_id, brand_id))
+    db.execute(
+        'DELETE FROM brand_feature_cell WHERE brand_id = ? AND NOT EXISTS ('
+        '    SELECT 1 FROM temp.new_brand_feature_cell AS n WHERE'
+        '    n.zoom = brand_feature_cell.zoom AND n.x = brand_feature_cell.x'
+        '    AND n.y = brand_feature_cell.y)', (brand_id,))
+    db.execute(
+        'INSERT OR REPLACE INTO brand_feature_cell'
+        '    (brand_id, zoom, x, y, weight)'
+        ' SELECT ?, n.zoom, n.x, n.y, n.weight'
+        ' FROM temp.new_brand_feature_cell AS n'
+        ' WHERE NOT EXISTS (SELECT 1 FROM brand_feature_cell AS c WHERE'
+        '     c.brand_id = ? AND c.zoom = n.zoom AND c.x = n.x AND c.y = n.y'
+        '     AND c.weight = n.weight)',
+        (brand_id, brand_id))
+    db.execute('DELETE FROM temp.new_brand_tile')
+    db.execute('DELETE FROM temp.new_brand_feature_cell')
+
+
+def _add_to_new_tile_index(db, lngs, lats):
+    px, py = wgs84_to_pixels(lngs, lats, TILE_INDEX_MAX_ZOOM)
+    for zoom in range(TILE_INDEX_MAX_ZOOM, -1, -1):
+        db.executemany(
+            'INSERT OR IGNORE INTO temp.new_brand_tile (zoom, x, y)'
+            ' VALUES (?, ?, ?)',
+            ((zoom, x, y) for x, y in
+             marker_tiles(px, py, MAX_MARKER_RADIUS, zoom)))
+        if zoom <= CLUSTER_MAX_ZOOM:
+            db.executemany(
+                'INSERT INTO temp.new_brand_feature_cell (zoom, x, y, weight)'
+                ' VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (zoom, x, y)'
+                ' DO UPDATE SET weight = weight + excluded.weight',
+                ((zoom, x, y, w) for (x, y), w in pixel_cells(px, py).items()))
+        px, py = halve_pixels(px, py)
+
+
+def find_nearest_features(db, brand_id, zoom, px, py, k):
+    """Find the k features nearest to a pixel position at a zoom level.
+
+    Only features within CLICK_MAX_DISTANCE pixels are considered.
+    Returns a list of (distance in pixels, internal_id), closest first.
+
+    We search windows of growing size around the position. A feature
+    inside a window is not necessarily closer than one just outside its
+    corner, so we only trust the features whose distance is within the
+    window's half-width; if there are fewer than k, the window doubles.
+    In dense areas at low zoom, the first window can hold too many
+    features to rank quickly, so it shrinks until it holds fewer."""
+    window = CLICK_MIN_WINDOW
+    ranked = []  # (distance, internal_id) of the features seen so far
+    growing = False
+    while True:
+        r = min(window, CLICK_MAX_DISTANCE)
+        candidates = _find_click_candidates(db, brand_id, zoom, px, py, r)
+        overfull = len(candidates) > CLICK_MAX_CANDIDATES
+        if overfull and not growing and window > CLICK_MIN_WINDOW / 64:
+            window /= 2
+            continue
+        candidates = candidates[:CLICK_MAX_CANDIDATES]
+        xs, ys = wgs84_to_pixels([c[1] for c in candidates],
+                                 [c[2] for c in candidates], zoom)
+        ranked = sorted(set(ranked).union(
+            (math.hypot(x - px, y - py), c[0])
+            for x, y, c in zip(xs, ys, candidates)))
+        if overfull:
+            # The window ran into a dense area; the best we can do
+            # quickly is to rank the features that we have seen.
+            return [c for c in ranked if c[0] <= CLICK_MAX_DISTANCE][:k]
+        trusted = [c for c in ranked if c[0] <= r]
+        if len(trusted) >= k or r >= CLICK_MAX_DISTANCE:
+            return trusted[:k]
+        window *= 2
+        growing = True
+
+
+def _find_click_candidates(db, brand_id, zoom, px, py, r):
+    # Returns up to CLICK_MAX_CANDIDATES + 1 features as tuples
+    # (internal_id, lng, lat), so callers can tell if there were more.
+    # The rtree stores single-precision floats, which is precise to
+    # about a decimeter; plenty for measuring pixel distances.
+    min_lng, max_lat = tile_to_wgs84(zoom + 8, px - r, py - r)
+    max_lng, min_lat = tile_to_wgs84(zoom + 8, px + r, py + r)
+    cursor = db.cursor()
+    cursor.row_factory = None
+    return cursor.execute(
+        'SELECT internal_id, (min_lng+max_lng)/2, (min_lat+max_lat)/2'
+        ' FROM brand_feature_rtree'
+        ' WHERE max_lng>=? AND min_lng<=? AND max_lat>=? AND min_lat<=?'
+        ' AND brand_id=? LIMIT ?',
+        (min_lng, max_lng, min_lat, max_lat, brand_id,
+         CLICK_MAX_CANDIDATES + 1)).fetchall()
+
+
+def _find_cells(db, brand_id, zoom, x, y, pad):
+    """Find the aggregated features for rendering a low-zoom tile.
+
+    Returns an iterable of (lng, lat, weight), or None if the brand
+    has not been indexed yet."""
+    indexed = db.execute(
+        'SELECT 1 FROM brand_tile'
+        ' WHERE brand_id = ? AND zoom = 0 AND x = 0 AND y = 0',
+        (brand_id,)).fetchone()
+    if indexed == None:
+        return None
+    cells = db.execute(
+        'SELECT x, y, weight FROM brand_feature_cell'
+        ' WHERE brand_id = ? AND zoom = ?'
+        ' AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?',
+        (brand_id, zoom, x * 256 - pad, (x + 1) * 256 + pad,
+         y * 256 - pad, (y + 1) * 256 + pad))
+    cells = cells.fetchall()
+    lngs, lats = tiles_to_wgs84(zoom + 8, [c['x'] + 0.5 for c in cells],
+                                [c['y'] + 0.5 for c in cells])
+    return zip(lngs, lats, (c['weight'] for c in cells))
+
+
 @bp.route('/Q<int:brand_id>-brand/<int:zoom>/<int:x>/<int:y>/<int:i>/<int:j>.geojson')
 def clicked_feature(brand_id, zoom, x, y, i, j):  # OGC WMTS GetFeatureInfo
-    fuzz = 6  # how many pixels we allow to be off, for incaccurate clicks
-    p = tile_to_wgs84(zoom + 8, x * 256 + i, y * 256 + j)
-    p1 = tile_to_wgs84(zoom + 8, x * 256 + i - fuzz, y * 256 + j - fuzz)
-    p2 = tile_to_wgs84(zoom + 8, x * 256 + i + fuzz, y * 256 + j + fuzz)
-    bbox = (p1[0], p2[1], p2[0], p1[1])
-    query, params = build_find_features_query(brand_id, bbox=bbox, limit=1)
+    # Returns the features nearest to the click, closest first.
+    # Clients can ask for more than one feature with ?k=3.
+    k = flask.request.args.get('k', '1')
+    if not k.isdigit() or not (1 <= int(k) <= CLICK_MAX_K):
+        raise BadRequest('k must be between 1 and %d' % CLICK_MAX_K)
+    db = get_db(readonly=True)
+    nearest = find_nearest_features(
+        db, brand_id, zoom, x * 256 + i, y * 256 + j, int(k))
+    ids = [internal_id for _distance, internal_id in nearest]
+    rows = dict((f['internal_id'], f) for f in db.execute(
+        'SELECT internal_id, feature_id, lng, lat, hash_hi, hash_lo, props'
+        ' FROM brand_feature WHERE internal_id IN (%s)'
+        % ','.join('?' * len(ids)), ids))
+    props_cache = get_properties_cache()
     features = []
-    f = get_db().execute(query, params).fetchone()
-    if f != None:
+    for internal_id in ids:
+        # A concurrent scrape may have deleted the feature since we
+        # searched the spatial index.
+        f = rows.get(internal_id)
+        if f == None:
+            continue
         features.append({
             'type': 'Feature',
             'geometry': {'type': 'Point', 'coordinates': [f['lng'], f['lat']]},
             'id': f['feature_id'],
-            'properties': json.loads(zlib.decompress(f['props']))
+            'properties': props_cache.get(
+                f['internal_id'], f['hash_hi'], f['hash_lo'], f['props'])
         })
-        print(features)
     resp = flask.json.jsonify({
         'type': 'FeatureCollection',
         'features': features
     })
     resp.headers['Content-Type'] = 'application/geo+json'
     return resp
+
+
+@click.command('render-tiles')
+@click.argument('brand')
+@click.option('--max-zoom', default=12, type=click.IntRange(0, 18),
+              help='Highest zoom level to render.')
+@click.option('--workers', default=os.cpu_count() or 1,
+              type=click.IntRange(1), help='Number of rendering processes.')
+@with_appcontext
+def render_tiles_command(brand, max_zoom, workers):
+    """Pre-render the map tiles of a brand, such as Q72, into MBTiles."""
+    brand_id = int(brand.removeprefix('Q').removesuffix('-brand'))
+    app = flask.current_app._get_current_object()
+    db = get_db(readonly=True)
+    brand = db.execute(
+        'SELECT last_modified, min_lng, min_lat, max_lng, max_lat'
+        ' FROM brand WHERE wikidata_id = ?',
+        (brand_id,)).fetchone()
+    if brand == None:
+        raise click.ClickException('Brand Q%d not found' % brand_id)
+
+    # Brands stored before we had a tile index, and unchanged since then,
+    # have not been indexed yet. Without an index, we would write an
+    # archive without any tiles, and tile() would then serve empty tiles
+    # for the entire brand.
+    indexed = db.execute(
+        'SELECT 1 FROM brand_tile'
+        ' WHERE brand_id = ? AND zoom = 0 AND x = 0 AND y = 0',
+        (brand_id,)).fetchone()
+    if indexed == None:
+        click.echo('Building tile index for Q%d' % brand_id)
+        update_tile_index(get_db(), brand_id)
+        get_db().commit()
+
+    # The actual rendering happens in a pool of rendertile processes,
+    # fed by as many threads with their own database connections.
+    # The tiles to render get found lazily, and only a few batches are
+    # in flight at any time, so memory use does not depend on the number
+    # of tiles.
+    pool = RenderPool(app.config['RENDERTILE'], size=workers)
+    app.extensions['rendertile'] = pool
+    def render_batch(batch):
+        with app.app_context():
+            db = get_db(readonly=True)
+            return [(z, x, y, render_tile(db, brand_id, z, x, y))
+                    for z, x, y in batch]
+    num_tiles = 0
+    def render_tiles(executor):
+        nonlocal num_tiles
+        pending = deque()
+        tiles = _find_tiles_to_render(db, brand_id, max_zoom)
+        for batch in iter(lambda: list(itertools.islice(tiles, 64)), []):
+            pending.append(executor.submit(render_batch, batch))
+            num_tiles += len(batch)
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        path = _mbtiles_path(brand_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mbtiles.write(path, {
+            'name': 'Q%d-brand' % brand_id,
+            'format': 'png',
+            'type': 'overlay',
+            'minzoom': '0',
+            'maxzoom': str(max_zoom),
+            'bounds': '%r,%r,%r,%r' % (brand['min_lng'], brand['min_lat'],
+                                       brand['max_lng'], brand['max_lat']),
+            'version': _brand_version(brand),
+        }, render_tiles(executor))
+    pool.close()
+    click.echo('Rendered %d tiles into %s' % (num_tiles, path))
+
+
+def _find_tiles_to_render(db, brand_id, max_zoom):
+    """Yields the tiles (zoom, x, y) with markers, skipping empty ones."""
+    tiles = db.cursor()
+    tiles.row_factory = None
+    tiles.execute(
+        'SELECT zoom, x, y FROM brand_tile WHERE brand_id = ? AND zoom <= ?'
+        ' ORDER BY zoom, x, y', (brand_id, max_zoom))
+    yield from tiles
+    if max_zoom <= TILE_INDEX_MAX_ZOOM:
+        return
+    # Beyond the zoom levels of our tile index, we look at the features
+    # of each occupied tile at the highest indexed level, and find which
+    # of its descendants are touched by their markers.
+    parents = db.cursor()
+    parents.row_factory = None
+    parents.execute(
+        'SELECT x, y FROM brand_tile WHERE brand_id = ? AND zoom = ?'
+        ' ORDER BY x, y', (brand_id, TILE_INDEX_MAX_ZOOM))
+    for x, y in parents:
+        yield from _find_occupied_descendants(db, brand_id, x, y, max_zoom)
+
+
+def _find_occupied_descendants(db, brand_id, x, y, max_zoom):
+    """Tiles above TILE_INDEX_MAX_ZOOM with markers, inside an indexed tile.
+
+    The tile (x, y) must be at TILE_INDEX_MAX_ZOOM. Markers have the same
+    size in pixels at all zoom levels, so any marker reaching into a
+    descendant tile belongs to a feature within MAX_MARKER_RADIUS pixels
+    around the indexed tile."""
+    query, params = build_find_features_query(
+        brand_id, bbox=_tile_bbox(TILE_INDEX_MAX_ZOOM, x, y, MAX_MARKER_RADIUS),
+        columns=['f.lng', 'f.lat'])
+    rows = db.execute(query, params).fetchall()
+    if not rows:
+        return []
+    px, py = wgs84_to_pixels([r[0] for r in rows], [r[1] for r in rows],
+                             max_zoom)
+    tiles = []
+    for zoom in range(max_zoom, TILE_INDEX_MAX_ZOOM, -1):
+        shift = zoom - TILE_INDEX_MAX_ZOOM
+        tiles.extend(sorted(
+            (zoom, tx, ty)
+            for tx, ty in marker_tiles(px, py, MAX_MARKER_RADIUS, zoom)
+            if tx >> shift == x and ty >> shift == y))
+        px, py = halve_pixels(px, py)
+    return tiles
@@ -14,10 +14,25 @@
 //   P [8.723286, 47.499467]
 //   L {"marker-fill":"#3300FF", "marker-width": 9.0}
 //   P [8.7183005, 47.3505937]
+//
+// Points may have a third element with the number of features that
+// were aggregated into the point, such as "P [8.71, 47.35, 12]".
+// Currently, this weight does not affect rendering.
+//
+// When started with --framed, the tool keeps running and renders one tile
+// after another. Each tile starts with a "T" command and ends with an "E"
+// line; after "E", the PNG is written to stdout, preceded by its length
+// as a 4-byte big-endian integer. This lets a long-lived worker process
+// render many tiles without paying for process startup each time.
+//
+//   T {"zoom":9, "x":268, "y":179}
+//   L {"marker-fill":"#880033", "marker-width": 6.0}
+//   P [15.417046, 47.07289]
+//   E
 
 use serde_json::Value;
 use std::f64::consts::PI;
-use std::io::{self, Write};
+use std::io::{self, BufRead, Write};
 use tiny_skia::*;
 
 struct Tile {
@@ -54,6 +69,14 @@ impl Tile {
         self.layer.draw_marker(x as f32, y as f32);
     }
 
+    fn reset(&mut self, zoom: u8, x: u32, y: u32) {
+        self.zoom = zoom;
+        self.x = x;
+        self.y = y;
+        self.image.fill(Color::TRANSPARENT);
+        self.layer = Layer::default();
+    }
+
     fn start_layer(&mut self, marker_color: ColorU8, marker_width: f32) {
         self.finish_layer();
         self.layer = Layer::new(marker_color, marker_width);
@@ -123,18 +146,21 @@ impl Layer {
 }
 
 fn main() -> io::Result<()> {
+    let framed = std::env::args().skip(1).any(|arg| arg == "--framed");
     let mut tile = Tile::new(0, 0, 0);
+    let stdin = io::stdin();
+    let mut stdout = io::stdout().lock();
 
-    for line in io::stdin().lines() {
+    for line in stdin.lock().lines() {
         let l = line?;
         let (cmd, data) = l.split_at(1);
-        let v: Value = serde_json::from_str(data)?;
         match cmd {
             "T" => {
                 let params: Value = serde_json::from_str(data)?;
-                tile.zoom = params["zoom"].as_i64().unwrap_or_default() as u8;
-                tile.x = params["x"].as_i64().unwrap_or_default() as u32;
-                tile.y = params["y"].as_i64().unwrap_or_default() as u32;
+                let zoom = params["zoom"].as_i64().unwrap_or_default() as u8;
+                let x = params["x"].as_i64().unwrap_or_default() as u32;
+                let y = params["y"].as_i64().unwrap_or_default() as u32;
+                tile.reset(zoom, x, y);
             }
 
             "L" => {
@@ -146,17 +172,28 @@ fn main() -> io::Result<()> {
             }
 
             "P" => {
+                let v: Value = serde_json::from_str(data)?;
                 let lng = v[0].as_f64().unwrap_or_default();
                 let lat = v[1].as_f64().unwrap_or_default();
                 tile.draw_point(lng, lat);
             }
 
+            "E" if framed => {
+                tile.finish_layer();
+                let png = tile.encode_png()?;
+                stdout.write_all(&(png.len() as u32).to_be_bytes())?;
+                stdout.write_all(&png)?;
+                stdout.flush()?;
+            }
+
             _ => panic!("unsupported command {}", cmd),
         }
     }
-    tile.finish_layer();
-    let png = tile.encode_png()?;
-    io::stdout().write_all(&png)?;
+    if !framed {
+        tile.finish_layer();
+        let png = tile.encode_png()?;
+        stdout.write_all(&png)?;
+    }
     Ok(())
 }
 
@@ -2,7 +2,10 @@
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 
 import os
+import shutil
+import sys
 import tempfile
+import textwrap
 
 import pytest
 from brandy import create_app
@@ -18,13 +21,18 @@ def app():
     # but Flask does not make this easy; beware of threading issues.
     # https://gehrcke.de/2015/05/in-memory-sqlite-database-and-flask-a-threading-trap/
     db_fd, db_path = tempfile.mkstemp()
+    storage_path = tempfile.mkdtemp()
 
     app = create_app({
         'APPLICATION_ROOT': 't',
         'DATABASE': db_path,
         'PREFERRED_URL_SCHEME': 'https',
         'TESTING': True,
-        'SERVER_NAME': 'brandy.test'
+        'SERVER_NAME': 'brandy.test',
+        'INGEST_SPOOL': os.path.join(storage_path, 'spool'),
+        'ITEMS_CACHE': os.path.join(storage_path, 'items'),
+        'MBTILES': os.path.join(storage_path, 'mbtiles'),
+        'TILE_CACHE': os.path.join(storage_path, 'tiles'),
     })
 
     with app.app_context():
@@ -33,8 +41,11 @@ def app():
 
     yield app
 
+    app.extensions['ingest'].close()
+    app.extensions['db'].close()
     os.close(db_fd)
     os.unlink(db_path)
+    shutil.rmtree(storage_path)
 
 
 @pytest.fixture
@@ -45,3 +56,32 @@ def client(app):
 @pytest.fixture
 def runner(app):
     return app.test_cli_runner()
+
+
+# Stand-in for rendertile --framed. Instead of a PNG, the fake replies
+# with the commands it has received for the tile, plus its process id.
+# It crashes when asked to draw a point at longitude 666.
+FAKE_RENDERTILE = '''\
+    #!%s
+    import os, struct, sys
+    received = []
+    for line in sys.stdin.buffer:
+        if line.startswith(b'T'):
+            received = []
+        if line.startswith(b'P [666'):
+            os._exit(1)
+        if line.startswith(b'E'):
+            reply = b'%%d\\n' %% os.getpid() + b''.join(received)
+            sys.stdout.buffer.write(struct.pack('>I', len(reply)) + reply)
+            sys.stdout.buffer.flush()
+        else:
+            received.append(line)
+'''
+
+
+@pytest.fixture
+def rendertile(tmp_path):
+    path = tmp_path / 'rendertile'
+    path.write_text(textwrap.dedent(FAKE_RENDERTILE % sys.executable))
+    os.chmod(path, 0o755)
+    return str(path)
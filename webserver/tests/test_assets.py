@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests on url path /assets/*
+
+import gzip
+from http import HTTPStatus
+import re
+
+from brandy.assets import asset_url
+
+
+def map_js_path(app):
+    with app.test_request_context():
+        url = asset_url('map.js')
+    assert re.fullmatch(r'/t/assets/map\.[0-9a-f]{16}\.js', url), url
+    return url.removeprefix('/t')
+
+
+def test_asset(app, client):
+    r = client.get(map_js_path(app), headers={'Accept-Encoding': 'identity'})
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'text/javascript; charset=utf-8'
+    assert r.headers['Cache-Control'] == \
+        'public, max-age=31536000, immutable'
+    assert r.headers.get('Content-Encoding') == None
+    assert b'export function initMap' in r.data
+    r = client.get(map_js_path(app),
+                   headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_gzip(app, client):
+    r = client.get(map_js_path(app), headers={'Accept-Encoding': 'gzip'})
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert b'export function initMap' in gzip.decompress(r.data)
+
+
+def test_not_found(app, client):
+    path = map_js_path(app)
+    stale = re.sub(r'\.[0-9a-f]{16}\.', '.0123456789abcdef.', path)
+    assert client.get(stale).status_code == HTTPStatus.NOT_FOUND
+    assert client.get('/assets/map.js').status_code == HTTPStatus.NOT_FOUND
+
+
+def test_unknown_asset_url(app):
+    with app.test_request_context():
+        assert asset_url('unknown.png') == '/t/static/unknown.png'
+
+
+def test_templates_use_assets(app, client):
+    r = client.get('/scrapes/')
+    assert r.status_code == HTTPStatus.OK
+    assert re.search(rb'href="/t/assets/style\.[0-9a-f]{16}\.css"', r.data)
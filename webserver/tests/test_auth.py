@@ -1,11 +1,17 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 #
-# Unittests on authentication helpers
+# Unittests on authentication helpers, passwords and API tokens
+
+import base64
+from http import HTTPStatus
+import io
+import re
 
 import pytest
 
 import brandy.auth
+from brandy.auth import create_api_token, revoke_api_token
 from brandy.db import create_user, get_db
 
 
@@ -25,3 +31,119 @@ def test_verify_password(app):
         create_user('kim', 'kim-password')
         assert brandy.auth.verify_password('kim', 'kim-password') == 'kim'
         assert brandy.auth.verify_password('kim', 'bad-password') == None
+
+
+def basic_auth_header(username, password):
+    cred = '%s:%s' % (username, password)
+    cred = base64.b64encode(cred.encode('utf-8')).decode('utf-8')
+    return {'Authorization': 'Basic %s' % cred}
+
+
+def bearer_header(token):
+    return {'Authorization': 'Bearer %s' % token}
+
+
+@pytest.fixture
+def alice(app):
+    with app.app_context():
+        create_user('alice', 'wonderland')
+        token_id, token = create_api_token('alice', 'scraper')
+        get_db().commit()
+    return (token_id, token)
+
+
+def test_token(alice, client):
+    _token_id, token = alice
+    assert token.startswith('brandy_')
+    r = client.get('/users/alice/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.OK
+    assert r.json['username'] == 'alice'
+    r = client.get('/users/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.FORBIDDEN
+
+
+def test_upload_with_token(alice, client):
+    _token_id, token = alice
+    scraped = b'{"type": "FeatureCollection", "features": []}'
+    data = {'scraped': (io.BytesIO(scraped), 's.json', 'application/geo+json')}
+    r = client.post('/collections/Q72-brand/items', data=data,
+                    headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.ACCEPTED
+    data = {'scraped': (io.BytesIO(scraped), 's.json', 'application/geo+json')}
+    r = client.post('/collections/Q72-brand/items', data=data,
+                    headers=bearer_header('brandy_wrong'))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_bad_token(alice, client):
+    r = client.get('/users/alice/', headers=bearer_header('brandy_wrong'))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_revoke_token(app, alice, client):
+    token_id, token = alice
+    r = client.get('/users/alice/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.OK
+    with app.app_context():
+        assert revoke_api_token(token_id) == True
+        assert revoke_api_token(token_id) == False
+        get_db().commit()
+    r = client.get('/users/alice/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_password_cached(app, alice, client):
+    headers = basic_auth_header('alice', 'wonderland')
+    for _ in range(3):
+        r = client.get('/users/alice/', headers=headers)
+        assert r.status_code == HTTPStatus.OK
+    stats = app.extensions['auth'].stats()
+    assert stats['hits'] >= 2
+    # Changing the password must invalidate the cached credentials.
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET password = 'x' WHERE username = 'alice'")
+        db.commit()
+    r = client.get('/users/alice/', headers=headers)
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_failure_not_cached(app, alice, client):
+    r = client.get('/users/alice/',
+                   headers=basic_auth_header('alice', 'looking-glass'))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+    r = client.get('/users/alice/', headers=bearer_header('brandy_new'))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+    assert app.extensions['auth'].stats()['entries'] == 0
+
+    # Even if the auth_version did not change, a token that has been
+    # rejected earlier should work as soon as it exists.
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TRIGGER api_token_insert_version')
+        db.execute(
+            'INSERT INTO api_token (user_id, name, token_hash, created)'
+            " SELECT id, 'new', ?, CURRENT_TIMESTAMP FROM user"
+            " WHERE username = 'alice'",
+            (brandy.auth.hash_token('brandy_new'),))
+        db.commit()
+    r = client.get('/users/alice/', headers=bearer_header('brandy_new'))
+    assert r.status_code == HTTPStatus.OK
+
+
+def test_token_commands(alice, runner, client):
+    result = runner.invoke(args=['create-token', 'alice', '--name', 'test'])
+    assert result.exit_code == 0, result.output
+    token_id, token = re.match(
+        r'Created token (\d+) for user "alice":\n(\S+)\n',
+        result.output).groups()
+    r = client.get('/users/alice/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.OK
+    result = runner.invoke(args=['revoke-token', token_id])
+    assert result.exit_code == 0, result.output
+    r = client.get('/users/alice/', headers=bearer_header(token))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+    result = runner.invoke(args=['revoke-token', token_id])
+    assert result.exit_code != 0
+    result = runner.invoke(args=['create-token', 'nosuchuser'])
+    assert result.exit_code != 0
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+
+import json
+import zlib
+
+import pytest
+
+import brandy.codec
+from brandy.codec import (Compressor, decompress, load_dictionary,
+                          train_dictionary)
+from brandy.db import get_db
+
+
+def make_samples(n):
+    return [json.dumps({
+        'brand': 'Example', 'brand:wikidata': 'Q72',
+        'name': 'Example %d' % i, 'addr:housenumber': str(i * 7 % 200),
+        'opening_hours': 'Mo-Fr 08:00-%d:30' % (17 + i % 3),
+    }, sort_keys=True).encode('utf-8') for i in range(n)]
+
+
+def test_zlib(app):
+    data = make_samples(1)[0]
+    blob = Compressor(None).compress(data)
+    assert blob[0] == brandy.codec.CODEC_ZLIB
+    assert blob == zlib.compress(data, level=9)
+    with app.app_context():
+        assert decompress(blob) == data
+
+
+@pytest.mark.skipif(brandy.codec.zstandard == None,
+                    reason='zstandard not installed')
+def test_zstd_dictionary(app):
+    samples = make_samples(500)
+    with app.app_context():
+        db = get_db()
+        assert load_dictionary(db, 72) == None
+        dictionary = train_dictionary(db, 72, samples)
+        assert load_dictionary(db, 72) == dictionary
+        db.commit()
+        compressor = Compressor(dictionary)
+        blobs = [compressor.compress(s) for s in samples]
+        assert all(b.startswith(compressor.header) for b in blobs)
+        assert sum(map(len, blobs)) < \
+            sum(len(zlib.compress(s, level=9)) for s in samples) / 2
+        assert [decompress(b) for b in blobs] == samples
+
+
+@pytest.mark.skipif(brandy.codec.zstandard == None,
+                    reason='zstandard not installed')
+def test_too_few_samples(app):
+    with app.app_context():
+        assert train_dictionary(get_db(), 72, make_samples(2)) == None
+
+
+def test_unknown_codec(app):
+    with app.app_context():
+        with pytest.raises(ValueError):
+            decompress(b'\x07foo')
+
+
+def test_varint():
+    for n in [0, 1, 127, 128, 300, 1 << 40]:
+        buf = b'x' + brandy.codec._encode_varint(n) + b'y'
+        assert brandy.codec._decode_varint(buf, 1) == (n, len(buf) - 1)
@@ -5,9 +5,14 @@
 
 
 import base64
+import copy
+from datetime import datetime, timedelta, timezone
+import gzip
 import io
 from http import HTTPStatus
 import json
+import os
+import time
 
 import pytest
 
@@ -90,17 +95,37 @@ Q72_brand_items = {
 		'id': 'F2',
         'geometry': {'type': 'Point', 'coordinates': [8.6, 47.3]},
         'properties': {'brand:wikidata': 'Q72'}
-    }]
+    }],
+    'numberReturned': 2,
+    'links': []
 }
 
 
 @pytest.fixture
-def q72(basic_auth, client):
-    scraped = io.BytesIO(json.dumps(Q72_scraped).encode('utf-8'))
-    r = client.post(
-        '/collections/Q72-brand/items', headers=basic_auth('testbot'),
-        data = {'scraped': (scraped, 's.json', 'application/geo+json')})
-    assert r.status_code == HTTPStatus.CREATED
+def upload(basic_auth, client):
+    # Uploads a scrape of Q72, and waits until it has been processed.
+    def upload(scraped):
+        if type(scraped) != bytes:
+            scraped = json.dumps(scraped).encode('utf-8')
+        headers = basic_auth('testbot')
+        r = client.post(
+            '/collections/Q72-brand/items', headers=headers,
+            data = {'scraped': (io.BytesIO(scraped), 's.json',
+                                'application/geo+json')})
+        assert r.status_code == HTTPStatus.ACCEPTED
+        job_path = r.headers['Location'].removeprefix('https://brandy.test/t')
+        for _ in range(1000):
+            job = client.get(job_path, headers=headers).json
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.01)
+        raise TimeoutError(job_path)
+    return upload
+
+
+@pytest.fixture
+def q72(upload):
+    assert upload(Q72_scraped)['status'] == 'done'
 
 
 class TestIndex:
@@ -110,6 +135,31 @@ class TestIndex:
         assert r.headers['Vary'] == 'Accept'
         assert r.json == all_collections
 
+    def test_pagination(self, q72, app, client):
+        with app.app_context():
+            db = get_db()
+            db.execute(
+                'INSERT INTO brand (wikidata_id, last_checked, last_modified,'
+                '    min_lng, min_lat, max_lng, max_lat)'
+                " VALUES (73, '2022-10-23 08:15:03', '2022-10-23 08:15:03',"
+                '    1, 2, 3, 4)')
+            db.commit()
+        r = client.get('/collections?limit=1')
+        assert r.status_code == HTTPStatus.OK
+        assert [c['id'] for c in r.json['collections']] == ['Q72-brand']
+        [link] = r.json['links']
+        assert link['rel'] == 'next'
+        prefix = 'https://brandy.test/t/collections?'
+        assert link['href'].startswith(prefix)
+        r = client.get('/collections?' + link['href'].removeprefix(prefix))
+        assert [c['id'] for c in r.json['collections']] == ['Q73-brand']
+        assert r.json['links'] == []
+
+    def test_bad_pagination(self, client):
+        for query in ['limit=0', 'limit=foo', 'limit=10001', 'cursor=Q72']:
+            r = client.get('/collections?' + query)
+            assert r.status_code == HTTPStatus.BAD_REQUEST, query
+
 
 class TestGetCollection:
     def test_json(self, q72, client):
@@ -179,6 +229,203 @@ class TestGetItems:
         r = client.get('/collections/Q404-brand/items')
         assert r.status_code == HTTPStatus.NOT_FOUND
 
+    def test_bbox(self, q72, client):
+        r = client.get('/collections/Q72-brand/items?bbox=8.4,47.5,8.55,47.7')
+        assert r.status_code == HTTPStatus.OK
+        assert [f['id'] for f in r.json['features']] == ['F1']
+        assert r.json['numberReturned'] == 1
+
+    def test_bad_bbox(self, q72, client):
+        r = client.get('/collections/Q72-brand/items?bbox=1,2,3')
+        assert r.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_pagination(self, q72, client):
+        r = client.get('/collections/Q72-brand/items?limit=1')
+        assert r.status_code == HTTPStatus.OK
+        assert [f['id'] for f in r.json['features']] == ['F1']
+        assert r.json['numberReturned'] == 1
+        [link] = r.json['links']
+        assert link['rel'] == 'next'
+        prefix = 'https://brandy.test/t/collections/Q72-brand/items?'
+        assert link['href'].startswith(prefix)
+        r = client.get('/collections/Q72-brand/items?' +
+                       link['href'].removeprefix(prefix))
+        assert [f['id'] for f in r.json['features']] == ['F2']
+        assert r.json['numberReturned'] == 1
+        assert r.json['links'] == []
+
+    def test_bad_limit(self, q72, client):
+        for limit in ['0', '-1', 'foo', '10001']:
+            r = client.get('/collections/Q72-brand/items?limit=' + limit)
+            assert r.status_code == HTTPStatus.BAD_REQUEST
+
+
+class TestItemsSince:
+    def test(self, q72, upload, client):
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1))
+        since = yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
+        r = client.get('/collections/Q72-brand/items?since=' + since)
+        assert r.status_code == HTTPStatus.OK
+        assert [f['id'] for f in r.json['features']] == ['F1', 'F2']
+        assert r.json['deleted'] == []
+        since = r.json['timeStamp']
+
+        r = client.get('/collections/Q72-brand/items?since=' + since)
+        assert r.json['features'] == [] and r.json['deleted'] == []
+        assert r.json['timeStamp'] == since
+
+        changed = copy.deepcopy(Q72_scraped)
+        changed['features'][0]['properties']['name'] = 'Changed'
+        del changed['features'][1]
+        assert upload(changed)['status'] == 'done'
+        r = client.get('/collections/Q72-brand/items?since=' + since)
+        assert [f['id'] for f in r.json['features']] == ['F1']
+        assert r.json['deleted'] == ['F2']
+        assert r.json['timeStamp'] > since
+
+        # Once F2 re-appears, it is not deleted anymore.
+        assert upload(Q72_scraped)['status'] == 'done'
+        r = client.get('/collections/Q72-brand/items?since=' + since)
+        assert [f['id'] for f in r.json['features']] == ['F1', 'F2']
+        assert r.json['deleted'] == []
+
+    def test_pagination(self, q72, client):
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1))
+        since = yesterday.strftime('%Y-%m-%dT%H:%M:%SZ')
+        r = client.get('/collections/Q72-brand/items?limit=1&since=' + since)
+        assert [f['id'] for f in r.json['features']] == ['F1']
+        assert r.json['deleted'] == []
+        [link] = r.json['links']
+        prefix = 'https://brandy.test/t/collections/Q72-brand/items?'
+        r = client.get('/collections/Q72-brand/items?' +
+                       link['href'].removeprefix(prefix))
+        assert [f['id'] for f in r.json['features']] == ['F2']
+        assert 'deleted' not in r.json
+        assert r.json['links'] == []
+
+    def test_too_old(self, q72, client):
+        r = client.get('/collections/Q72-brand/items?since=2000-01-01')
+        assert r.status_code == HTTPStatus.GONE
+
+    def test_bad_since(self, q72, client):
+        for since in ['foo', '2022-13-01']:
+            r = client.get('/collections/Q72-brand/items?since=' + since)
+            assert r.status_code == HTTPStatus.BAD_REQUEST
+
+
+class TestConditionalGet:
+    @pytest.mark.parametrize('path', [
+        '/collections',
+        '/collections/Q72-brand', '/collections/Q72-brand.json',
+        '/collections/Q72-brand.html',
+        '/collections/Q72-brand/items',
+        '/collections/Q72-brand/items?limit=1',
+    ])
+    def test_if_none_match(self, q72, client, path):
+        r = client.get(path)
+        assert r.status_code == HTTPStatus.OK
+        etag = r.headers['ETag']
+        r = client.get(path, headers={'If-None-Match': etag})
+        assert r.status_code == HTTPStatus.NOT_MODIFIED
+        assert r.headers['ETag'] == etag
+        assert r.data == b''
+
+    def test_etag_differs_by_representation(self, q72, client):
+        etags = {client.get(path).headers['ETag'] for path in [
+            '/collections/Q72-brand.json', '/collections/Q72-brand.html',
+            '/collections/Q72-brand/items',
+            '/collections/Q72-brand/items?limit=1']}
+        assert len(etags) == 4
+
+    def test_if_modified_since(self, q72, client):
+        r = client.get('/collections/Q72-brand/items')
+        last_modified = r.headers['Last-Modified']
+        assert last_modified.endswith(' GMT')
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'If-Modified-Since': last_modified})
+        assert r.status_code == HTTPStatus.NOT_MODIFIED
+
+    def test_changed(self, q72, upload, client):
+        etag = client.get('/collections/Q72-brand/items').headers['ETag']
+        changed = copy.deepcopy(Q72_scraped)
+        changed['features'][0]['properties']['name'] = 'Changed'
+        assert upload(changed)['status'] == 'done'
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'If-None-Match': etag})
+        assert r.status_code == HTTPStatus.OK
+        assert r.headers['ETag'] != etag
+
+
+class TestPrecompressedItems:
+    def test_gzip(self, q72, client):
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == HTTPStatus.OK
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert r.headers['Content-Type'] == 'application/geo+json'
+        assert r.headers['Vary'] == 'Accept-Encoding'
+        assert r.headers['ETag'].endswith('-gzip"')
+        assert json.loads(gzip.decompress(r.data)) == Q72_brand_items
+
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip',
+                                'If-None-Match': r.headers['ETag']})
+        assert r.status_code == HTTPStatus.NOT_MODIFIED
+
+    @pytest.mark.skipif(brandy.collections.brotli == None,
+                        reason='brotli not installed')
+    def test_brotli(self, q72, client):
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip, br'})
+        assert r.status_code == HTTPStatus.OK
+        assert r.headers['Content-Encoding'] == 'br'
+        data = brandy.collections.brotli.decompress(r.data)
+        assert json.loads(data) == Q72_brand_items
+
+    def test_identity(self, q72, client):
+        r = client.get('/collections/Q72-brand/items')
+        assert 'Content-Encoding' not in r.headers
+        assert r.headers['Vary'] == 'Accept-Encoding'
+        assert r.json == Q72_brand_items
+
+    def test_removed_concurrently(self, app, q72, client, monkeypatch):
+        # Another thread might remove the file, for example when storing
+        # a new scrape, while the response is being prepared.
+        not_modified = brandy.collections._not_modified
+        def remove_files(*args):
+            for filename in os.listdir(app.config['ITEMS_CACHE']):
+                os.remove(os.path.join(app.config['ITEMS_CACHE'], filename))
+            return not_modified(*args)
+        monkeypatch.setattr(brandy.collections, '_not_modified', remove_files)
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == HTTPStatus.OK
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert int(r.headers['Content-Length']) == len(r.data)
+        assert json.loads(gzip.decompress(r.data)) == Q72_brand_items
+
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in r.headers
+        assert r.json == Q72_brand_items
+
+    def test_query_not_precompressed(self, q72, client):
+        r = client.get('/collections/Q72-brand/items?limit=1',
+                       headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in r.headers
+        assert r.json['numberReturned'] == 1
+
+    def test_old_versions_removed(self, app, q72, upload, client):
+        changed = copy.deepcopy(Q72_scraped)
+        changed['features'][0]['properties']['name'] = 'Changed'
+        assert upload(changed)['status'] == 'done'
+        files = os.listdir(app.config['ITEMS_CACHE'])
+        assert len([f for f in files if f.endswith('.gz')]) == 1
+        r = client.get('/collections/Q72-brand/items',
+                       headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(r.data))
+        assert data['features'][0]['properties']['name'] == 'Changed'
+
 
 class TestPostItems:
     def test(self, basic_auth, client):
@@ -186,14 +433,132 @@ class TestPostItems:
         r = client.post(
             '/collections/Q72-brand/items', headers=basic_auth('testbot'),
             data = {'scraped': (scraped, 'file.json', 'application/geo+json')})
-        assert (r.text, r.status_code) == ('Created', HTTPStatus.CREATED)
+        assert r.status_code == HTTPStatus.ACCEPTED
+        job = r.json
+        assert job['collection'] == 'Q72-brand'
+        assert job['user'] == 'testbot'
+        assert job['status'] in ('queued', 'running', 'done')
         assert r.headers['Location'] == \
+            'https://brandy.test/t/jobs/%s' % job['id']
+        assert job['links'][1]['href'] == \
             'https://brandy.test/t/collections/Q72-brand/items'
+        app = client.application
+        app.extensions['ingest'].close()  # waits for the job to finish
+        r = client.get('/jobs/%s' % job['id'], headers=basic_auth('testbot'))
+        assert r.json['status'] == 'done'
+        assert r.json['features_processed'] == 2
+        assert r.json['rows_changed'] == 2
         r = client.get('/collections/Q72-brand',
                        headers={'Accept': 'application/json'})
         assert r.status_code == HTTPStatus.OK
         assert r.json == Q72_collection
 
+    def test_malformed(self, q72, upload, client):
+        for data, error in [
+                (b'{"features": [{"type": "Feature"', 'Malformed GeoJSON'),
+                (b'{"features": []}', 'No features')]:
+            job = upload(data)
+            assert job['status'] == 'failed'
+            assert job['error'].startswith(error)
+        # The previously stored features should still be there.
+        r = client.get('/collections/Q72-brand/items')
+        assert r.json == Q72_brand_items
+
+    def test_replace(self, q72, upload, client):
+        changed = copy.deepcopy(Q72_scraped)
+        del changed['features'][1]
+        assert upload(changed)['status'] == 'done'
+        r = client.get('/collections/Q72-brand/items')
+        assert [f['id'] for f in r.json['features']] == ['F1']
+
+    def test_unchanged_features_kept(self, app, q72, upload, client):
+        def stored():
+            with app.app_context():
+                return {f['feature_id']: tuple(f) for f in get_db().execute(
+                    'SELECT feature_id, internal_id, last_modified, hash_hi'
+                    ' FROM brand_feature')}
+        before = stored()
+        changed = copy.deepcopy(Q72_scraped)
+        changed['features'][0]['properties']['name'] = 'Changed'
+        changed['features'].append({
+            'type': 'Feature', 'id': 'F3',
+            'geometry': {'type': 'Point', 'coordinates': [8.7, 47.4]},
+        })
+        assert upload(changed)['status'] == 'done'
+        after = stored()
+        assert after['F2'] == before['F2']
+        assert after['F1'][1] == before['F1'][1]  # same internal_id
+        assert after['F1'][2:] != before['F1'][2:]
+        assert after['F3'][1] > before['F2'][1]
+        with app.app_context():
+            rtree = get_db().execute(
+                'SELECT internal_id FROM brand_feature_rtree'
+                ' ORDER BY internal_id').fetchall()
+        assert [r[0] for r in rtree] == sorted(f[1] for f in after.values())
+
+    def test_unchanged_upload(self, app, q72, upload, client):
+        def brand():
+            with app.app_context():
+                return tuple(get_db().execute(
+                    'SELECT last_checked, last_modified FROM brand').fetchone())
+        before = brand()
+        assert upload(Q72_scraped)['status'] == 'done'
+        after = brand()
+        assert after[0] > before[0]
+        assert after[1] == before[1]
+
+    def test_hash_covers_feature_id(self, app, upload, client):
+        scraped = copy.deepcopy(Q72_scraped)
+        scraped['features'][0]['id'] = 'F2'
+        scraped['features'][1]['id'] = 'F3'
+        scraped['features'][1]['geometry'] = \
+            scraped['features'][0]['geometry']
+        scraped['features'][1]['properties'] = \
+            scraped['features'][0]['properties']
+        assert upload(scraped)['status'] == 'done'
+        with app.app_context():
+            hashes = get_db().execute(
+                'SELECT hash_hi, hash_lo FROM brand_feature').fetchall()
+        assert len(set(tuple(h) for h in hashes)) == 2
+
+    @pytest.mark.skipif(brandy.codec.zstandard == None,
+                        reason='zstandard not installed')
+    def test_compression(self, app, upload, client, monkeypatch):
+        scraped = {'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature', 'id': 'F%d' % i,
+            'geometry': {'type': 'Point', 'coordinates': [8.5, 47.6]},
+            'properties': {'brand': 'Example', 'name': 'Example %d' % i,
+                           'opening_hours': 'Mo-Fr 08:00-%d:00' % (17 + i % 3)}
+        } for i in range(300)]}
+        def stored():
+            with app.app_context():
+                return [tuple(f) for f in get_db().execute(
+                    'SELECT substr(props, 1, 1), last_modified'
+                    ' FROM brand_feature ORDER BY internal_id')]
+
+        # Without zstandard, properties get stored with zlib.
+        with monkeypatch.context() as m:
+            m.setattr(brandy.codec, 'zstandard', None)
+            assert upload(scraped)['status'] == 'done'
+        before = stored()
+        assert set(codec for codec, _ in before) == {b'\x78'}
+
+        # When the brand gets uploaded again, unchanged features get
+        # re-compressed with a trained dictionary.
+        job = upload(scraped)
+        assert (job['status'], job['rows_changed']) == ('done', 0)
+        after = stored()
+        assert set(codec for codec, _ in after) == {b'\x01'}
+        assert [t for _, t in after] == [t for _, t in before]
+        r = client.get('/collections/Q72-brand/items')
+        assert [f['properties'] for f in r.json['features']] == \
+            [f['properties'] for f in scraped['features']]
+
+    def test_missing_file(self, basic_auth, client):
+        r = client.post('/collections/Q72-brand/items',
+                        headers=basic_auth('testbot'), data={})
+        assert r.status_code == HTTPStatus.BAD_REQUEST
+
     def test_unauthorized(self, client):
         r = client.post('/collections/Q72-brand/items', data={'scraped': '{}'})
         assert r.status_code == HTTPStatus.UNAUTHORIZED
@@ -1,23 +1,82 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
 
+import concurrent.futures
+import os
 import pytest
 import sqlite3
 
-from brandy.db import get_db, build_find_features_query
+from brandy.db import build_find_features_query, get_db, migrate_db
 
 # Within an application context, get_db should return
 # the same connection each time it’s called. After the context,
-# the connection should be closed.
+# uncommitted changes should be rolled back, but the connection
+# should stay open for re-use by the next context on the same thread.
 def test_get_close_db(app):
     with app.app_context():
         db = get_db()
         assert db is get_db()
+        assert get_db(readonly=True) is not db
+        db.execute("INSERT INTO scraper (name) VALUES ('uncommitted')")
+    with app.app_context():
+        assert get_db() is db
+        assert db.execute(
+            "SELECT COUNT(*) FROM scraper WHERE name = 'uncommitted'"
+        ).fetchone()[0] == 0
+    app.extensions['db'].close()
     with pytest.raises(sqlite3.ProgrammingError) as e:
         db.execute('SELECT 1')
     assert 'closed' in str(e.value)
 
 
+def test_readonly(app):
+    with app.app_context():
+        db = get_db(readonly=True)
+        with pytest.raises(sqlite3.OperationalError) as e:
+            db.execute("INSERT INTO scraper (name) VALUES ('foo')")
+        assert 'readonly' in str(e.value)
+
+
+def test_connection_per_thread(app):
+    def connect():
+        with app.app_context():
+            return get_db()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        other = executor.submit(connect).result()
+    assert other is not connect()
+    assert other.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_stats(app):
+    with app.app_context():
+        db = get_db(readonly=True)
+        for i in range(3):
+            db.execute('SELECT ?', (i,)).fetchone()
+        db.cursor().execute('SELECT ?', (i,)).fetchone()
+        stats = app.extensions['db'].stats()
+    assert stats['connections_open'] == 2
+    assert stats['statement_cache_hits'] >= 3
+    assert 0.0 < stats['statement_cache_hit_rate'] < 1.0
+
+
+# Each statement should be counted once, no matter whether it was
+# executed on the connection or on a cursor.
+def test_stats_exact(app):
+    with app.app_context():
+        db = get_db()
+        hits, misses = db.statement_cache_hits, db.statement_cache_misses
+        for i in range(3):
+            db.execute('SELECT %d' % i).fetchone()
+        db.cursor().execute('SELECT 3').fetchone()
+        db.executemany('INSERT INTO scraper (name) VALUES (?)', [('a',)])
+        assert db.statement_cache_misses - misses == 5
+        assert db.statement_cache_hits - hits == 0
+        db.execute('SELECT 0').fetchone()
+        db.cursor().execute('SELECT 3').fetchone()
+        assert db.statement_cache_misses - misses == 5
+        assert db.statement_cache_hits - hits == 2
+
+
 # The init-db command should call the init_db function and output a message.
 def test_init_db_command(runner, monkeypatch):
     class Recorder(object):
@@ -30,6 +89,62 @@ def test_init_db_command(runner, monkeypatch):
     assert Recorder.called
 
 
+def describe_schema(db):
+    # Column order may differ, since ALTER TABLE appends new columns.
+    schema = {}
+    for kind, name, sql in db.execute(
+            "SELECT type, name, sql FROM sqlite_master"
+            " WHERE name NOT LIKE 'sqlite_%'"):
+        if kind == 'trigger':
+            schema[(kind, name)] = sql
+            continue
+        if kind == 'table':
+            info = db.execute('PRAGMA table_xinfo(%s)' % name)
+        else:
+            info = db.execute('PRAGMA index_xinfo(%s)' % name)
+        schema[(kind, name)] = sorted(tuple(row)[1:] for row in info)
+    return schema
+
+
+def test_migrate_db(app):
+    path = os.path.join(os.path.dirname(__file__), 'schema_v0.sql')
+    with open(path, 'rb') as f:
+        schema_v0 = f.read().decode('utf-8')
+    with app.app_context():
+        db = get_db()
+        latest = db.execute('PRAGMA user_version').fetchone()[0]
+        assert latest >= 5
+        expected = describe_schema(db)
+        db.execute('DROP TABLE brand_feature_rtree')
+        for (name,) in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+                " AND name NOT LIKE 'sqlite_%'").fetchall():
+            db.execute('DROP TABLE %s' % name)
+        db.executescript(schema_v0)
+        db.execute('PRAGMA user_version = 0')
+        db.execute(
+            'INSERT INTO brand (wikidata_id, last_checked, last_modified,'
+            '    min_lng, min_lat, max_lng, max_lat)'
+            " VALUES (72, '2022-10-23 08:15:03', '2022-10-23 08:15:03',"
+            '    8.5, 47.3, 8.6, 47.6)')
+        db.commit()
+        applied = migrate_db()
+        assert applied[0] == '0001_brand_feature_indexes.sql'
+        assert len(applied) == latest
+        assert db.execute('PRAGMA user_version').fetchone()[0] == latest
+        assert describe_schema(db) == expected
+        assert [tuple(r) for r in db.execute(
+            'SELECT wikidata_id, content_hash FROM brand')] == [(72, None)]
+        assert migrate_db() == []
+
+
+def test_migrate_db_command(runner):
+    result = runner.invoke(args=['migrate-db'])
+    assert result.exit_code == 0, result.output
+    assert 'Applied' not in result.output
+    assert 'Database schema is at version' in result.output
+
+
 def test_build_find_features_query():
     t = lambda x: x[0].replace('?', '%s') % x[1]
     assert t(build_find_features_query(7272, bbox=None, limit=None)) == (
@@ -41,9 +156,36 @@ def test_build_find_features_query():
         ' LIMIT 10')
     assert t(build_find_features_query(7272, bbox=(1.1, 2.2, 3.3, 4.4), limit=10)) == (
         'SELECT f.feature_id, f.lng, f.lat, f.props'
-        ' FROM brand_feature AS f, brand_feature_rtree AS r'
+        ' FROM brand_feature_rtree AS r CROSS JOIN brand_feature AS f'
         ' WHERE f.brand_id=7272 AND f.internal_id=r.internal_id'
         ' AND r.min_lng>=1.1 AND r.max_lng<=3.3'
         ' AND r.min_lat>=2.2 AND r.max_lat<=4.4'
         ' AND r.brand_id=7272'
         ' LIMIT 10')
+    assert t(build_find_features_query(7272, limit=10, after=15,
+                                       columns=['f.internal_id'])) == (
+        'SELECT f.internal_id'
+        ' FROM brand_feature AS f WHERE f.brand_id=7272'
+        ' AND f.internal_id>15'
+        ' ORDER BY f.internal_id LIMIT 10')
+    assert t(build_find_features_query(7272, since='2022-10-23',
+                                       columns=['f.internal_id'])) == (
+        'SELECT f.internal_id FROM brand_feature AS f'
+        ' INDEXED BY brand_feature_last_modified'
+        ' WHERE f.brand_id=7272 AND f.last_modified>2022-10-23')
+
+
+# For queries with a bounding box, the spatial index must drive the join.
+# Otherwise, SQLite might walk all features of the brand with one of the
+# indexes on brand_id, and look up each of them in the rtree.
+def test_find_features_query_plan(app):
+    with app.app_context():
+        db = get_db(readonly=True)
+        for kwargs in [{}, {'limit': 10, 'after': 15},
+                       {'since': '2022-10-23'}]:
+            query, params = build_find_features_query(
+                7272, bbox=(1.1, 2.2, 3.3, 4.4), **kwargs)
+            plan = [r[3] for r in db.execute(
+                'EXPLAIN QUERY PLAN ' + query, params)]
+            assert plan[0].startswith('SCAN r VIRTUAL TABLE INDEX 2:'), plan
+            assert plan[1] == 'SEARCH f USING INTEGER PRIMARY KEY (rowid=?)'
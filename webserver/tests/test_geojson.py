@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+
+import io
+import json
+
+import pytest
+
+import brandy.geojson
+from brandy.geojson import iter_features
+
+
+def features(s):
+    return list(iter_features(io.BytesIO(s.encode('utf-8'))))
+
+
+def test_iter_features():
+    assert features('{"type": "FeatureCollection", "features": []}') == []
+    assert features('{}') == []
+    assert features(' { "features" : [ {"id": 1} , {"id": 2} ] } \n') == [
+        {'id': 1}, {'id': 2}]
+
+
+def test_iter_features_skips_other_members():
+    assert features(
+        '{"bbox": [1, 2, 3, 4], "features": [{"id": "a"}],'
+        ' "properties": {"features": [{"id": "b"}]}}') == [{'id': 'a'}]
+
+
+def test_iter_features_small_chunks(monkeypatch):
+    # Values that span chunk boundaries need to get decoded correctly,
+    # including numbers and multi-byte UTF-8 sequences.
+    monkeypatch.setattr(brandy.geojson, 'CHUNK_SIZE', 3)
+    collection = {
+        'type': 'FeatureCollection',
+        'features': [
+            {'id': 'F%d' % i, 'properties': {'name': 'Zürich 🏙️'},
+             'geometry': {'type': 'Point', 'coordinates': [8.54321, 47.36]}}
+            for i in range(20)
+        ],
+        'count': 1234567
+    }
+    s = json.dumps(collection, ensure_ascii=False)
+    assert features(s) == collection['features']
+    assert features('{"a": 12345678}') == []
+
+
+@pytest.mark.parametrize('s', [
+    '', '[]', '{"features": [{"id": 1}', '{"features": [{"id": 1}]',
+    '{"features": [1 2]}', '{1: 2}', '{"features": []} x'])
+def test_iter_features_malformed(s):
+    with pytest.raises(ValueError):
+        features(s)
@@ -4,19 +4,77 @@
 import pytest
 from pytest import approx
 
-from brandy.geometry import bbox, wgs84_to_tile, tile_to_wgs84
+import brandy.geometry
+from brandy.geometry import (
+    bbox, feature_bboxes, halve_pixels, marker_tiles, pixel_cells,
+    tile_to_wgs84, tiles_to_wgs84, union_bbox, wgs84_to_pixel,
+    wgs84_to_pixels, wgs84_to_tile, wgs84_to_tiles)
+
+
+# Batch functions get tested both with and without NumPy.
+@pytest.fixture(params=['numpy', 'python'])
+def batch(request, monkeypatch):
+    if request.param == 'numpy':
+        if brandy.geometry.numpy == None:
+            pytest.skip('numpy not installed')
+    else:
+        monkeypatch.setattr(brandy.geometry, 'numpy', None)
+    return request.param
 
 
 def test_wgs84_to_tile():
     assert wgs84_to_tile(8.4, 47.5, 9) == (267, 179)
 
 
+def test_wgs84_to_pixel():
+    assert wgs84_to_pixel(-180.0, 85.051129, 0) == approx((0.0, 0.0), abs=1e-4)
+    assert wgs84_to_pixel(8.4, 47.5, 9) == approx((68594.35, 45833.27), abs=0.01)
+
+
 def test_tile_to_wgs84():
     assert tile_to_wgs84(0, 0, 0) == approx((-180.0, +85.051129))
     assert tile_to_wgs84(0, 1, 1) == approx((+180.0, -85.051129))
     assert tile_to_wgs84(9, 268, 179) == approx((8.437500, 47.517201))
 
 
+def test_wgs84_to_tiles(batch):
+    xs, ys = wgs84_to_tiles([8.4, -180.0], [47.5, 85.0], 9)
+    assert list(xs) == [267, 0] and list(ys) == [179, 0]
+
+
+def test_wgs84_to_pixels(batch):
+    lngs, lats = [8.4, -180.0, 2.3], [47.5, 85.051129, 48.8]
+    xs, ys = wgs84_to_pixels(lngs, lats, 9)
+    for lng, lat, x, y in zip(lngs, lats, xs, ys):
+        assert (x, y) == approx(wgs84_to_pixel(lng, lat, 9))
+    assert [list(a) for a in wgs84_to_pixels([], [], 9)] == [[], []]
+
+
+def test_tiles_to_wgs84(batch):
+    lngs, lats = tiles_to_wgs84(9, [268, 0], [179, 0])
+    assert (lngs[0], lats[0]) == approx((8.437500, 47.517201))
+    assert (lngs[1], lats[1]) == approx((-180.0, +85.051129))
+
+
+def test_halve_pixels(batch):
+    xs, ys = halve_pixels(*wgs84_to_pixels([8.4], [47.5], 9))
+    assert (xs[0], ys[0]) == approx(wgs84_to_pixel(8.4, 47.5, 8))
+
+
+def test_marker_tiles(batch):
+    xs, ys = wgs84_to_pixels([8.5, 8.6, 2.3], [47.6, 47.3, 48.8], 9)
+    assert marker_tiles(xs, ys, 1, 9) == {(268, 178), (268, 179), (259, 176)}
+    xs, ys = wgs84_to_pixels([-180.0], [0.0], 1)
+    assert marker_tiles(xs, ys, 9, 1) == {(0, 0), (0, 1)}
+    assert marker_tiles(*wgs84_to_pixels([], [], 1), 9, 1) == set()
+
+
+def test_pixel_cells(batch):
+    xs, ys = wgs84_to_pixels([8.5, 8.6, 2.3], [47.6, 47.3, 48.8], 0)
+    assert pixel_cells(xs, ys) == {(134, 89): 2, (129, 88): 1}
+    assert pixel_cells(*wgs84_to_pixels([], [], 0)) == {}
+
+
 def test_bbox_for_geometry():
     assert bbox({
         'type': 'Point',
@@ -167,3 +225,19 @@ def test_bbox_for_junk():
     assert bbox(None) == None
     assert bbox([]) == None
     assert bbox('foo') == None
+
+
+def test_feature_bboxes():
+    assert feature_bboxes([
+        {'type': 'Feature',
+         'geometry': {'type': 'Point', 'coordinates': [8, 47]}},
+        {'type': 'Feature', 'geometry': None},
+        {'type': 'LineString', 'coordinates': [[10, 3], [-2, 2]]},
+    ]) == [(8, 47, 8, 47), None, (-2, 2, 10, 3)]
+    assert feature_bboxes([]) == []
+
+
+def test_union_bbox():
+    assert union_bbox([(1, 2, 3, 4), None, (0, 3, 2, 5)]) == (0, 2, 3, 5)
+    assert union_bbox([None]) == None
+    assert union_bbox([]) == None
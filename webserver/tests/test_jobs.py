@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests on url path /jobs/*
+
+import base64
+from http import HTTPStatus
+import json
+import os
+
+import pytest
+
+from brandy.db import create_user, get_db
+
+
+def basic_auth_header(username, password):
+    cred = '%s:%s' % (username, password)
+    cred = base64.b64encode(cred.encode('utf-8')).decode('utf-8')
+    return {'Authorization': 'Basic %s' % cred}
+
+
+@pytest.fixture
+def auth_header(app):
+    with app.app_context():
+        create_user('testbot', 'secret')
+        get_db().commit()
+    return basic_auth_header('testbot', 'secret')
+
+
+def test_not_found(auth_header, client):
+    r = client.get('/jobs/%s' % ('0' * 32), headers=auth_header)
+    assert r.status_code == HTTPStatus.NOT_FOUND
+    r = client.get('/jobs/..', headers=auth_header)
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_unauthorized(client):
+    r = client.get('/jobs/%s' % ('0' * 32))
+    assert r.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_resume(app, auth_header, client):
+    # Jobs that were queued by a previous server process should get
+    # processed once the server is up again.
+    spool = app.config['INGEST_SPOOL']
+    os.makedirs(spool)
+    job_id = 'a' * 32
+    with open(os.path.join(spool, job_id + '.geojson'), 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature', 'id': 'F1',
+            'geometry': {'type': 'Point', 'coordinates': [8.5, 47.6]},
+        }]}, f)
+    with open(os.path.join(spool, job_id + '.json'), 'w') as f:
+        json.dump({
+            'id': job_id, 'brand_id': 72, 'user': 'testbot',
+            'status': 'running', 'created': '2022-10-23T08:15:03+00:00',
+            'started': '2022-10-23T08:15:04+00:00', 'finished': None,
+            'features_processed': 0, 'rows_changed': 0, 'error': None,
+        }, f)
+    r = client.get('/jobs/%s' % job_id, headers=auth_header)
+    assert r.status_code == HTTPStatus.OK
+    app.extensions['ingest'].close()
+
+    # Other users should not see the job.
+    with app.app_context():
+        create_user('otherbot', 'other-secret')
+        get_db().commit()
+    r = client.get('/jobs/%s' % job_id,
+                   headers=basic_auth_header('otherbot', 'other-secret'))
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+    r = client.get('/jobs/%s' % job_id, headers=auth_header)
+    assert r.json['status'] == 'done'
+    assert r.json['features_processed'] == 1
+    assert not os.path.exists(os.path.join(spool, job_id + '.geojson'))
+    r = client.get('/collections/Q72-brand/items')
+    assert [f['id'] for f in r.json['features']] == ['F1']
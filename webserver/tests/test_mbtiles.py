@@ -0,0 +1,42 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for reading and writing MBTiles archives
+
+import os
+
+from brandy import mbtiles
+
+
+def test_write_and_read(tmp_path):
+    # Characters that have a special meaning in SQLite URIs.
+    path = os.path.join(tmp_path, 'odd?#%20name.mbtiles')
+    mbtiles.write(path, {'name': 'Q72-brand'}, [(9, 268, 179, b'png')])
+    archive = mbtiles.open_archive(path)
+    assert archive.metadata == {'name': 'Q72-brand'}
+    assert archive.get(9, 268, 179) == b'png'
+    assert archive.get(9, 268, 180) == None
+    archive.close()
+    assert mbtiles.open_archive(path + '.missing') == None
+
+
+def test_reader_cache(tmp_path):
+    path = os.path.join(tmp_path, 'Q72-brand.mbtiles')
+    cache = mbtiles.ReaderCache(max_entries=1)
+    assert cache.get(path) == None
+    mbtiles.write(path, {'version': '1'}, [])
+    reader = cache.get(path)
+    assert reader.metadata == {'version': '1'}
+    assert cache.get(path) is reader
+    # A re-rendered archive replaces the file, and its reader.
+    mbtiles.write(path, {'version': '2'}, [(0, 0, 0, b'png')])
+    reader = cache.get(path)
+    assert reader.metadata == {'version': '2'}
+    assert reader.get(0, 0, 0) == b'png'
+    # Only max_entries archives are kept open.
+    other = os.path.join(tmp_path, 'Q73-brand.mbtiles')
+    mbtiles.write(other, {'version': '3'}, [])
+    assert cache.get(other).metadata == {'version': '3'}
+    assert cache.get(path) is not reader
+    os.remove(path)
+    assert cache.get(path) == None
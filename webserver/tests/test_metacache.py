@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for the in-memory cache of collection metadata
+
+import sqlite3
+
+from brandy.metacache import MetadataCache
+
+
+def test_get():
+    cache = MetadataCache(max_entries=10)
+    assert cache.get(1, 'a', lambda: 'A1') == 'A1'
+    assert cache.get(1, 'a', lambda: 'not called on cache hits') == 'A1'
+    assert cache.get(2, 'a', lambda: 'A2') == 'A2'
+    # Requests that read an older version must not get newer values,
+    # nor replace them.
+    assert cache.get(1, 'a', lambda: 'A1') == 'A1'
+    assert cache.get(2, 'a', lambda: 'not called') == 'A2'
+    stats = cache.stats()
+    assert (stats['version'], stats['hits'], stats['misses']) == (2, 2, 3)
+
+
+def test_evict_least_recently_used():
+    cache = MetadataCache(max_entries=2)
+    cache.get(1, 'a', lambda: 'A')
+    cache.get(1, 'b', lambda: 'B')
+    cache.get(1, 'a', lambda: 'not called')
+    cache.get(1, 'c', lambda: 'C')
+    assert cache.get(1, 'a', lambda: 'not called') == 'A'
+    assert cache.get(1, 'b', lambda: 'B2') == 'B2'
+    assert cache.stats()['entries'] == 2
+
+
+def test_ttl():
+    cache = MetadataCache(max_entries=10, ttl=0)
+    assert cache.get(1, 'k', lambda: 'alice') == 'alice'
+    assert cache.get(1, 'k', lambda: None) == None
+    cache = MetadataCache(max_entries=10, ttl=60)
+    assert cache.get(1, 'k', lambda: None) == None
+    assert cache.get(1, 'k', lambda: 'not called') == None
+    assert cache.get(2, 'k', lambda: 'alice') == 'alice'
+
+
+def test_changes_by_other_process(app, client):
+    r = client.get('/collections')
+    assert r.json['collections'] == []
+    # A separate connection, like another server process would use.
+    db = sqlite3.connect(app.config['DATABASE'])
+    db.execute(
+        'INSERT INTO brand (wikidata_id, last_checked, last_modified,'
+        '    min_lng, min_lat, max_lng, max_lat)'
+        " VALUES (72, '2022-10-23 08:15:03', '2022-10-23 08:15:03',"
+        '    1, 2, 3, 4)')
+    db.commit()
+    r = client.get('/collections')
+    assert [c['id'] for c in r.json['collections']] == ['Q72-brand']
+    r = client.get('/collections/Q72-brand.json')
+    assert r.json['extent']['spatial']['bbox'] == [[1, 2, 3, 4]]
+    db.execute('UPDATE brand SET min_lng = 0')
+    db.commit()
+    db.close()
+    r = client.get('/collections/Q72-brand.json')
+    assert r.json['extent']['spatial']['bbox'] == [[0, 2, 3, 4]]
@@ -0,0 +1,59 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for the Mapbox Vector Tile encoder
+
+from brandy.mvt import Layer, encode_tile
+
+
+def decode_message(buf):
+    """Decode protocol buffer fields into a list of (field, value)."""
+    fields, pos = [], 0
+    def varint():
+        nonlocal pos
+        result, shift = 0, 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7F) << shift
+            shift += 7
+            if b < 0x80:
+                return result
+    while pos < len(buf):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            fields.append((field, varint()))
+        elif wire_type == 1:
+            fields.append((field, buf[pos:pos + 8]))
+            pos += 8
+        elif wire_type == 2:
+            n = varint()
+            fields.append((field, buf[pos:pos + n]))
+            pos += n
+    return fields
+
+
+def test_encode_empty_tile():
+    tile = decode_message(encode_tile([Layer('Q72-brand', extent=512)]))
+    assert len(tile) == 1 and tile[0][0] == 3
+    assert decode_message(tile[0][1]) == [
+        (15, 2), (1, b'Q72-brand'), (5, 512)]
+
+
+def test_encode_points():
+    layer = Layer('Q72-brand')
+    layer.add_point(25, 17, {'id': 'F1', 'open': True})
+    layer.add_point(3, 4095, {'id': 'F2', 'open': True, 'n': -2})
+    [(field, layer_buf)] = decode_message(encode_tile([layer]))
+    assert field == 3
+    layer = decode_message(layer_buf)
+    assert [v for k, v in layer if k == 3] == [b'id', b'open', b'n']
+    assert [decode_message(v) for k, v in layer if k == 4] == [
+        [(1, b'F1')], [(7, 1)], [(1, b'F2')], [(6, 3)]]
+    features = [decode_message(v) for k, v in layer if k == 2]
+    assert features == [
+        [(2, bytes([0, 0, 1, 1])), (3, 1), (4, bytes([9, 50, 34]))],
+        [(2, bytes([0, 2, 1, 1, 2, 3])), (3, 1),
+         (4, bytes([9, 6, 0xFE, 0x3F]))],
+    ]
@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for the in-memory cache of decoded feature properties
+
+import io
+import json
+import zlib
+
+from brandy.collections import store_scraped
+from brandy.db import get_db
+from brandy.propcache import PropertiesCache, get_properties_cache
+
+
+def blob(props):
+    return zlib.compress(json.dumps(props).encode('utf-8'))
+
+
+def test_get(app):
+    cache = PropertiesCache(max_bytes=10000)
+    with app.app_context():
+        assert cache.get_json(1, 2, 3, blob({'a': 1})) == '{"a": 1}'
+        props = cache.get(1, 2, 3, b'not consulted on cache hits')
+        assert props == {'a': 1}
+        assert cache.get(1, 2, 3, b'') is props
+        assert cache.get(1, 2, 4, blob({'a': 2})) == {'a': 2}
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert (stats['hits'], stats['misses']) == (2, 2)
+
+
+def test_evict_least_recently_used(app):
+    cache = PropertiesCache(max_bytes=150)
+    with app.app_context():
+        cache.get_json(1, 0, 0, blob({'a': 1}))
+        cache.get_json(2, 0, 0, blob({'b': 2}))
+        cache.get_json(1, 0, 0, b'')
+        cache.get_json(3, 0, 0, blob({'c': 3}))
+        assert cache.get_json(1, 0, 0, blob({'x': 0})) == '{"a": 1}'
+        assert cache.get_json(2, 0, 0, blob({'x': 0})) == '{"x": 0}'
+    assert cache.stats()['bytes'] <= 150
+
+
+def test_invalidate(app):
+    cache = PropertiesCache(max_bytes=10000)
+    with app.app_context():
+        cache.get(1, 2, 3, blob({'a': 1}))
+        cache.get(4, 5, 6, blob({'b': 2}))
+        cache.invalidate([(1, 2, 3), (7, 8, 9)])
+        assert cache.get(1, 2, 3, blob({'a': 2})) == {'a': 2}
+        assert cache.get(4, 5, 6, b'') == {'b': 2}
+
+
+def test_store_scraped_invalidates(app):
+    def scrape(name):
+        return io.BytesIO(json.dumps({
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature', 'id': 'F1',
+                'geometry': {'type': 'Point', 'coordinates': [8.5, 47.4]},
+                'properties': {'name': name}
+            }]
+        }).encode('utf-8'))
+
+    with app.app_context():
+        db = get_db()
+        store_scraped(db, 72, scrape('Old'))
+        f = db.execute('SELECT * FROM brand_feature').fetchone()
+        cache = get_properties_cache()
+        cache.get(f['internal_id'], f['hash_hi'], f['hash_lo'], f['props'])
+        assert cache.stats()['entries'] == 1
+        store_scraped(db, 72, scrape('New'))
+        assert cache.stats()['entries'] == 0
+        store_scraped(db, 72, scrape('New'))
+        db.rollback()
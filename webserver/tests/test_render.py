@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for the pool of rendertile processes
+
+import pytest
+
+from brandy.render import RenderError, RenderPool
+
+
+def test_render(rendertile):
+    pool = RenderPool(rendertile, size=2)
+    tile = {'zoom': 9, 'x': 268, 'y': 179}
+    layer = {'marker-fill': '#4287F5', 'marker-width': 6.0}
+    pid, cmds = pool.render(tile, layer, [(8.5, 47.6)]).split(b'\n', 1)
+    assert cmds == (
+        b'T {"zoom": 9, "x": 268, "y": 179}\n'
+        b'L {"marker-fill": "#4287F5", "marker-width": 6.0}\n'
+        b'P [8.5,47.6]\n')
+
+    # The process should get re-used for rendering the next tile.
+    pid2, cmds = pool.render(tile, layer, []).split(b'\n', 1)
+    assert pid2 == pid
+    assert not cmds.startswith(b'P')
+    pool.close()
+
+
+def test_restart_crashed(rendertile):
+    pool = RenderPool(rendertile, size=1)
+    tile = {'zoom': 0, 'x': 0, 'y': 0}
+    with pytest.raises(RenderError):
+        pool.render(tile, {}, [(666, 0)])
+    pid, cmds = pool.render(tile, {}, [(1, 2)]).split(b'\n', 1)
+    assert cmds.endswith(b'P [1.0,2.0]\n')
+    pool.close()
+
+
+def test_render_full_precision(rendertile):
+    # At zoom 18, rounding to 6 significant digits (as with %g) would
+    # move this point by about 77 pixels.
+    pool = RenderPool(rendertile, size=1)
+    tile = {'zoom': 18, 'x': 41928, 'y': 101324}
+    _pid, cmds = pool.render(tile, {}, [(-122.4194155, 37.7749295)]).split(
+        b'\n', 1)
+    assert cmds.endswith(b'P [-122.4194155,37.7749295]\n')
+    pool.close()
@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests on url path /search
+
+from http import HTTPStatus
+import io
+import json
+
+import pytest
+
+from brandy.collections import store_scraped
+from brandy.db import get_db
+from brandy.search import build_search_query
+
+
+def scrape(*features):
+    return io.BytesIO(json.dumps({
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature', 'id': feature_id,
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': {'name': feature_id}
+        } for feature_id, lng, lat in features]
+    }).encode('utf-8'))
+
+
+@pytest.fixture
+def features(app):
+    with app.app_context():
+        db = get_db()
+        store_scraped(db, 72, scrape(
+            ('A1', 8.51, 47.37), ('A2', 8.52, 47.38), ('A3', 9.5, 47.1)))
+        store_scraped(db, 73, scrape(('B1', 8.53, 47.36)))
+        store_scraped(db, 74, scrape(('C1', 8.54, 47.39)))
+        db.commit()
+
+
+def ids(response):
+    return {c['id']: [f['id'] for f in c['features']]
+            for c in response.json['collections']}
+
+
+def test_search(features, client):
+    r = client.get('/search?bbox=8.5,47.3,8.6,47.4')
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'application/json'
+    assert ids(r) == {
+        'Q72-brand': ['A1', 'A2'],
+        'Q73-brand': ['B1'],
+        'Q74-brand': ['C1'],
+    }
+    c = r.json['collections'][0]
+    assert c['type'] == 'FeatureCollection'
+    assert c['features'][0]['properties'] == {'name': 'A1'}
+    assert c['features'][0]['geometry']['coordinates'] == [8.51, 47.37]
+    assert r.json['numberReturned'] == 4
+    assert r.json['links'] == []
+
+
+def test_search_brands(features, client):
+    r = client.get('/search?bbox=8.5,47.3,8.6,47.4&brands=Q74,Q72-brand')
+    assert ids(r) == {'Q72-brand': ['A1', 'A2'], 'Q74-brand': ['C1']}
+
+
+def test_search_empty(features, client):
+    r = client.get('/search?bbox=1,2,3,4')
+    assert r.status_code == HTTPStatus.OK
+    assert r.json == {'collections': [], 'numberReturned': 0, 'links': []}
+
+
+def test_search_pagination(features, client):
+    pages, path = [], '/search?bbox=8.5,47.3,8.6,47.4&brands=Q72,Q73&limit=2'
+    while path != None:
+        r = client.get(path)
+        assert r.status_code == HTTPStatus.OK
+        pages.append(ids(r))
+        path = None
+        for link in r.json['links']:
+            assert link['rel'] == 'next'
+            path = link['href'].removeprefix('https://brandy.test/t')
+    assert pages == [{'Q72-brand': ['A1', 'A2']}, {'Q73-brand': ['B1']}]
+
+
+def test_search_bad_request(features, client):
+    for query in ['', 'bbox=1,2,3', 'bbox=1,2,3,4&brands=Q72,foo',
+                  'bbox=1,2,3,4&limit=0', 'bbox=1,2,3,4&limit=10001',
+                  'bbox=1,2,3,4&cursor=foo']:
+        r = client.get('/search?' + query)
+        assert r.status_code == HTTPStatus.BAD_REQUEST, query
+
+
+def test_search_query_plan(app):
+    with app.app_context():
+        query, params = build_search_query(
+            (8.5, 47.3, 8.6, 47.4), [72, 73], 10, (72, 5))
+        plan = [r[3] for r in get_db(readonly=True).execute(
+            'EXPLAIN QUERY PLAN ' + query, params)]
+    assert plan[0].startswith('SCAN r VIRTUAL TABLE INDEX 2:'), plan
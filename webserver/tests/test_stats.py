@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests on url path /stats
+
+import base64
+from http import HTTPStatus
+
+from brandy.db import create_user, get_db
+
+
+def basic_auth_header(username, password):
+    cred = '%s:%s' % (username, password)
+    cred = base64.b64encode(cred.encode('utf-8')).decode('utf-8')
+    return {'Authorization': 'Basic %s' % cred}
+
+
+def test_stats(app, client):
+    with app.app_context():
+        create_user('root', 'rootpass', is_admin=True)
+        create_user('alice', 'wonderland')
+        get_db().commit()
+    for _ in range(3):
+        client.get('/collections/Q72-brand.json')
+    r = client.get('/stats', headers=basic_auth_header('root', 'rootpass'))
+    assert r.status_code == HTTPStatus.OK
+    db = r.json['database']
+    assert db['connections_open'] == 2
+    assert db['statement_cache_hits'] > 0
+    assert r.json['properties_cache']['misses'] == 0
+
+    r = client.get('/stats', headers=basic_auth_header('alice', 'wonderland'))
+    assert r.status_code == HTTPStatus.FORBIDDEN
@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests for the cache of rendered map tiles
+
+import os
+import tempfile
+
+from brandy.tilecache import TileCache
+
+
+def test_get_put(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=100)
+    assert cache.get(72, 'v1', 9, 268, 179) == None
+    cache.put(72, 'v1', 9, 268, 179, b'png')
+    assert cache.get(72, 'v1', 9, 268, 179) == b'png'
+    assert cache.get(72, 'v2', 9, 268, 179) == None
+    assert os.path.exists(tmp_path / 'Q72' / 'v1' / '9' / '268' / '179.png')
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=25)
+    cache.put(72, 'v1', 1, 0, 0, b'0' * 10)
+    cache.put(72, 'v1', 1, 0, 1, b'1' * 10)
+    assert cache.get(72, 'v1', 1, 0, 0) == b'0' * 10
+    cache.put(72, 'v1', 1, 1, 0, b'2' * 10)
+    assert cache.get(72, 'v1', 1, 0, 0) == b'0' * 10
+    assert cache.get(72, 'v1', 1, 0, 1) == None
+    assert cache.get(72, 'v1', 1, 1, 0) == b'2' * 10
+    assert not os.path.exists(tmp_path / 'Q72' / 'v1' / '1' / '0' / '1.png')
+
+
+def test_invalidate(tmp_path):
+    cache = TileCache(str(tmp_path), max_bytes=100)
+    cache.put(72, 'v1', 9, 268, 179, b'png')
+    cache.put(73, 'v1', 9, 268, 179, b'png')
+    cache.invalidate(72)
+    assert cache.get(72, 'v1', 9, 268, 179) == None
+    assert cache.get(73, 'v1', 9, 268, 179) == b'png'
+    assert not os.path.exists(tmp_path / 'Q72')
+    assert os.listdir(tmp_path / '.trash') != []
+    cache.remove_trash()
+    assert os.listdir(tmp_path / '.trash') == []
+
+
+def test_put_after_invalidate(tmp_path, monkeypatch):
+    # A request thread might be storing a tile while the ingest thread
+    # moves the brand's tiles out of the way.
+    cache = TileCache(str(tmp_path), max_bytes=100)
+    cache.put(72, 'v1', 9, 268, 179, b'png')
+    mkstemp = tempfile.mkstemp
+    def invalidate_before_mkstemp(**kwargs):
+        cache.invalidate(72)
+        return mkstemp(**kwargs)
+    monkeypatch.setattr(tempfile, 'mkstemp', invalidate_before_mkstemp)
+    cache.put(72, 'v1', 9, 268, 180, b'png')
+    monkeypatch.undo()
+    assert cache.get(72, 'v1', 9, 268, 180) == None
+    cache.remove_trash()
+    assert not os.path.exists(tmp_path / 'Q72')
+
+
+def test_restart(tmp_path):
+    TileCache(str(tmp_path), max_bytes=100).put(72, 'v1', 0, 0, 0, b'png')
+    os.makedirs(tmp_path / '.trash' / 'Q73-leftover' / 'Q73')
+    cache = TileCache(str(tmp_path), max_bytes=100)
+    assert cache.get(72, 'v1', 0, 0, 0) == b'png'
+    assert not os.path.exists(tmp_path / '.trash')
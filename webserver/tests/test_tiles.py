@@ -0,0 +1,242 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2022 Sascha Brawer <sascha@brawer.ch>
+#
+# Tests on url path /tiles/*
+
+from http import HTTPStatus
+import json
+import zlib
+
+import pytest
+
+from brandy import mbtiles
+from brandy.db import get_db
+from brandy.render import RenderError, RenderPool
+from brandy.tiles import EMPTY_PNG, _mbtiles_path, is_tile_occupied, \
+    update_tile_index
+
+
+@pytest.fixture
+def features(app, rendertile):
+    app.config['RENDERTILE'] = rendertile
+    app.extensions['rendertile'] = RenderPool(rendertile, size=1)
+    features = [
+        (1, 'F1', 8.5, 47.6),  # in tile 9/268/178
+        (2, 'F2', 8.6, 47.3),  # in tile 9/268/179
+        (3, 'F3', 2.3, 48.8),  # in tile 9/259/176
+    ]
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            'INSERT INTO brand (wikidata_id, last_checked, last_modified,'
+            '    min_lng, min_lat, max_lng, max_lat)'
+            " VALUES (72, '2022-10-23 08:15:03', '2022-10-23 08:15:03',"
+            '    2.3, 47.3, 8.6, 48.8)')
+        for internal_id, feature_id, lng, lat in features:
+            props = zlib.compress(json.dumps({'ref': feature_id}).encode())
+            db.execute(
+                'INSERT INTO brand_feature (internal_id, brand_id, feature_id,'
+                '    lng, lat, hash_hi, hash_lo, last_modified, props)'
+                ' VALUES (?, 72, ?, ?, ?, 0, 0, CURRENT_TIMESTAMP, ?)',
+                (internal_id, feature_id, lng, lat, props))
+            db.execute(
+                'INSERT INTO brand_feature_rtree (internal_id,'
+                '    min_lng, max_lng, min_lat, max_lat, brand_id)'
+                ' VALUES (?, ?, ?, ?, ?, 72)',
+                (internal_id, lng, lng, lat, lat))
+        update_tile_index(db, 72)
+        db.commit()
+    yield features
+    app.extensions['rendertile'].close()
+
+
+def test_tile(app, features, client):
+    r = client.get('/tiles/Q72-brand/9/268/179.png')
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'image/png'
+    _pid, cmds = r.data.split(b'\n', 1)
+    points = [c for c in cmds.split(b'\n') if c.startswith(b'P')]
+    assert points == [b'P [8.6,47.3]']
+
+    # The second time, the tile should come from the cache.
+    app.extensions['rendertile'].close()
+    app.extensions['rendertile'] = RenderPool('/nonexistent', size=1)
+    r2 = client.get('/tiles/Q72-brand/9/268/179.png')
+    assert r2.status_code == HTTPStatus.OK
+    assert r2.data == r.data
+
+
+def test_tile_low_zoom(features, client):
+    # At low zoom levels, features get aggregated into pixel cells.
+    r = client.get('/tiles/Q72-brand/0/0/0.png')
+    assert r.status_code == HTTPStatus.OK
+    _pid, cmds = r.data.split(b'\n', 1)
+    points = [c for c in cmds.split(b'\n') if c.startswith(b'P')]
+    assert points == [b'P [2.109375,48.45835188280866,1]',
+                      b'P [9.140625,47.51720069783939,2]']
+
+
+def test_empty_tile(features, client):
+    r = client.get('/tiles/Q72-brand/9/100/100.png')
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'image/png'
+    assert r.headers['Cache-Control'] == 'public, max-age=86400'
+    assert r.data == EMPTY_PNG
+
+
+def test_is_tile_occupied(app, features):
+    with app.app_context():
+        db = get_db()
+        assert is_tile_occupied(db, 72, 0, 0, 0)
+        assert is_tile_occupied(db, 72, 9, 268, 179)
+        assert not is_tile_occupied(db, 72, 9, 268, 181)
+        assert is_tile_occupied(db, 72, 18, 137334, 91881)
+        assert not is_tile_occupied(db, 72, 18, 100 << 9, 100 << 9)
+
+        # Markers of features near tile boundaries reach into neighbors.
+        assert is_tile_occupied(db, 72, 7, 66, 44)
+        assert not is_tile_occupied(db, 72, 7, 66, 43)
+
+        # Brand 73 has not been indexed, so we cannot claim its
+        # tiles to be empty.
+        assert is_tile_occupied(db, 73, 9, 100, 100)
+
+
+def test_render_tiles_command(app, features, client, runner, rendertile):
+    result = runner.invoke(args=['render-tiles', 'Q72', '--max-zoom', '16'])
+    assert result.exit_code == 0, result.output
+    assert 'Rendered' in result.output
+
+    # Beyond the tile index, only tiles with markers get rendered,
+    # not all descendants of the occupied tiles at zoom 14.
+    with app.app_context():
+        archive = mbtiles.open_archive(_mbtiles_path(72))
+        counts = dict(archive.db.execute(
+            'SELECT zoom_level, COUNT(*) FROM tiles'
+            ' WHERE zoom_level > 14 GROUP BY zoom_level'))
+        total = archive.db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+        archive.close()
+    assert counts == {15: 3, 16: 3}
+    assert 'Rendered %d tiles' % total in result.output
+
+    # Tiles should now be served from the MBTiles archive.
+    app.extensions['rendertile'] = RenderPool('/nonexistent', size=1)
+    r = client.get('/tiles/Q72-brand/9/268/179.png')
+    assert r.status_code == HTTPStatus.OK
+    assert b'P [8.6,47.3]' in r.data
+    r = client.get('/tiles/Q72-brand/16/34333/22970.png')
+    assert r.status_code == HTTPStatus.OK
+    assert b'P [8.6,47.3]' in r.data
+    r = client.get('/tiles/Q72-brand/9/100/100.png')
+    assert r.data == EMPTY_PNG
+
+    # Once the brand data changes, the archive is outdated.
+    with app.app_context():
+        get_db().execute("UPDATE brand SET last_modified = '2022-11-01 00:00:00'")
+        get_db().commit()
+    with pytest.raises(RenderError):
+        client.get('/tiles/Q72-brand/9/268/179.png')
+
+
+def test_render_tiles_command_unindexed(app, features, client, runner):
+    # Brands stored before the tile index existed have no index yet.
+    # Rather than writing an archive of empty tiles, the command should
+    # index them first.
+    with app.app_context():
+        get_db().execute('DELETE FROM brand_tile')
+        get_db().execute('DELETE FROM brand_feature_cell')
+        get_db().commit()
+    result = runner.invoke(args=['render-tiles', 'Q72', '--max-zoom', '12'])
+    assert result.exit_code == 0, result.output
+    assert 'Building tile index for Q72' in result.output
+    with app.app_context():
+        assert is_tile_occupied(get_db(), 72, 9, 268, 179)
+        assert not is_tile_occupied(get_db(), 72, 9, 100, 100)
+    app.extensions['rendertile'] = RenderPool('/nonexistent', size=1)
+    r = client.get('/tiles/Q72-brand/9/268/179.png')
+    assert b'P [8.6,47.3]' in r.data
+
+
+def test_render_tiles_query_plan(app, features, runner):
+    # Above the zoom levels of the tile index, render-tiles looks up
+    # the features around every occupied tile at zoom 14. For large
+    # brands, that is many thousands of queries; each must be answered
+    # by the spatial index, not by walking all features of the brand.
+    statements = []
+    with app.app_context():
+        db = get_db(readonly=True)
+    db.set_trace_callback(statements.append)
+    try:
+        result = runner.invoke(
+            args=['render-tiles', 'Q72', '--max-zoom', '16'])
+    finally:
+        db.set_trace_callback(None)
+    assert result.exit_code == 0, result.output
+    queries = [s for s in statements if 'brand_feature_rtree AS r' in s]
+    assert len(queries) == 3  # one per occupied tile at zoom 14
+    for query in queries:
+        plan = [r[3] for r in db.execute('EXPLAIN QUERY PLAN ' + query)]
+        assert plan[0].startswith('SCAN r VIRTUAL TABLE INDEX 2:'), plan
+
+
+def test_vector_tile(features, client):
+    r = client.get('/tiles/Q72-brand/9/268/179.mvt?properties=ref,missing')
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'application/vnd.mapbox-vector-tile'
+    assert b'Q72-brand' in r.data
+    assert b'F2' in r.data and b'ref' in r.data
+    assert b'F1' not in r.data and b'missing' not in r.data
+
+    r = client.get('/tiles/Q72-brand/9/100/100.mvt')
+    assert r.status_code == HTTPStatus.OK
+    assert b'F' not in r.data
+
+    r = client.get('/tiles/Q404-brand/9/100/100.mvt')
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_tile_not_found(features, client):
+    r = client.get('/tiles/Q404-brand/9/268/179.png')
+    assert r.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_clicked_feature(features, client):
+    r = client.get('/tiles/Q72-brand/9/268/179/61/113.geojson')
+    assert r.status_code == HTTPStatus.OK
+    assert r.headers['Content-Type'] == 'application/geo+json'
+    assert [f['id'] for f in r.json['features']] == ['F2']
+
+
+def test_clicked_feature_nearest(features, client):
+    # At zoom 5, F1 is about 10 pixels north of F2.
+    r = client.get('/tiles/Q72-brand/5/16/11/195/55.geojson?k=2')
+    assert r.status_code == HTTPStatus.OK
+    assert [f['id'] for f in r.json['features']] == ['F2', 'F1']
+    r = client.get('/tiles/Q72-brand/5/16/11/195/55.geojson')
+    assert [f['id'] for f in r.json['features']] == ['F2']
+
+
+def test_clicked_feature_off(features, client):
+    # At zoom 9, F2 is at pixel (59, 117) of tile 268/179.
+    r = client.get('/tiles/Q72-brand/9/268/179/69/117.geojson')
+    assert [f['id'] for f in r.json['features']] == ['F2']
+    r = client.get('/tiles/Q72-brand/9/268/179/89/117.geojson')
+    assert r.json['features'] == []
+
+
+def test_clicked_feature_deleted(app, features, client):
+    # Simulates a scrape that deletes F2 between the search in the
+    # spatial index and fetching the found features.
+    with app.app_context():
+        db = get_db()
+        db.execute("DELETE FROM brand_feature WHERE feature_id = 'F2'")
+        db.commit()
+    r = client.get('/tiles/Q72-brand/5/16/11/195/55.geojson?k=2')
+    assert r.status_code == HTTPStatus.OK
+    assert [f['id'] for f in r.json['features']] == ['F1']
+
+
+def test_clicked_feature_bad_k(features, client):
+    for k in ['0', '11', 'foo']:
+        r = client.get('/tiles/Q72-brand/9/268/179/61/113.geojson?k=' + k)
+        assert r.status_code == HTTPStatus.BAD_REQUEST